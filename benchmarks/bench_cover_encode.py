@@ -0,0 +1,84 @@
+"""
+Benchmark of cover encoding on large JPEG sources:
+full decode + LANCZOS thumbnail (the previous approach)
+versus covers.encode_cover, which decodes JPEGs at a reduced scale.
+Test images are generated locally, so results are reproducible.
+
+Usage:
+    python benchmarks/bench_cover_encode.py [--sizes 2000 4000 6000] [--repeat 5]
+"""
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+from covers import COVER_SIZE, encode_cover  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def legacy_encode_cover(picture):
+    byteIO = io.BytesIO()
+    thumb = Image.open(picture)
+    thumb.thumbnail(COVER_SIZE, Image.Resampling.LANCZOS)
+    thumb.save(byteIO, format="JPEG")
+    return byteIO.getvalue()
+
+
+def make_test_image(path, size):
+    """Write a deterministic, photo-like (non-flat) JPEG of size x size pixels."""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size // 8, size // 8), 64).resize((size, size))
+    image = Image.merge(
+        "RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90))
+    )
+    image.save(path, format="JPEG", quality=90)
+
+
+def time_encoding(encode_function, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode_function(path)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 4000, 6000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(
+            "{:<12} {:>12} {:>12} {:>8}".format(
+                "source", "before (ms)", "after (ms)", "speedup"
+            )
+        )
+        for size in args.sizes:
+            path = os.path.join(directory, "source_{}.jpg".format(size))
+            make_test_image(path, size)
+            before = time_encoding(legacy_encode_cover, path, args.repeat) * 1e3
+            after = time_encoding(encode_cover, path, args.repeat) * 1e3
+            print(
+                "{:<12} {:>12.1f} {:>12.1f} {:>7.2f}x".format(
+                    "{0}x{0}".format(size), before, after, before / after
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
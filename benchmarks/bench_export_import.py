@@ -0,0 +1,138 @@
+"""
+Round trip check of the export and import commands.
+Fixtures of every supported container are tagged, including tags with several
+values, a track number with the total number of tracks and a backslash,
+then exported to a manifest of each format and imported back unedited.
+Every file must come back skipped, with the same tags; the time taken
+by the export and the import is reported.
+Results are written as JSON; the exit status is 1 if a file didn't round trip.
+
+Usage:
+    python benchmarks/bench_export_import.py --output results.json
+    python benchmarks/bench_export_import.py --formats m4a --count 100
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import cli  # noqa: E402
+import mutagen  # noqa: E402
+from engine import WriteResult, write_metadata  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from metadata_readers import read_metadata  # noqa: E402
+
+MANIFEST_FORMATS = ("jsonl", "csv")
+TAGS = {
+    "artist": ["Artist A", "Artist B"],
+    "album": "Album, with a comma",
+    "title": "Title \\ with a backslash",
+    "track_number": "3/12",
+    "recording_year": "2020",
+}
+
+
+def run_command(argv):
+    """Run a CLI command, returning (exit code, JSON lines printed, seconds)."""
+    stdout = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(stdout):
+        exit_code = cli.main(argv)
+    elapsed = time.perf_counter() - start
+    lines = [json.loads(line) for line in stdout.getvalue().splitlines() if line]
+    return exit_code, lines, elapsed
+
+
+def run_scenario(directory, extension, count, manifest_format):
+    fixtures_directory = os.path.join(directory, extension)
+    os.makedirs(fixtures_directory)
+    paths = write_fixtures(fixtures_directory, count=count, extensions=[extension])
+    problems = []
+    for path in paths:
+        result = write_metadata(path, TAGS)
+        if result.status != WriteResult.SAVED:
+            problems.append("{}: couldn't tag, {}".format(path, result.error))
+    tags = {path: read_metadata(path) for path in paths}
+    manifest_path = os.path.join(directory, "tags." + manifest_format)
+    exit_code, _, export_s = run_command(
+        ["export", fixtures_directory, "--output", manifest_path]
+    )
+    if exit_code:
+        problems.append("export failed")
+    exit_code, results, import_s = run_command(["import", manifest_path])
+    for result in results:
+        if result["status"] != WriteResult.SKIPPED:
+            problems.append("{path}: {status} {error}".format(**result).strip())
+    for path in paths:
+        if read_metadata(path) != tags[path]:
+            problems.append("{}: tags changed".format(path))
+    for path in paths + [manifest_path]:
+        os.remove(path)
+    os.rmdir(fixtures_directory)
+    return {
+        "format": extension,
+        "manifest_format": manifest_format,
+        "count": count,
+        "export_s": export_s,
+        "import_s": import_s,
+        "problems": problems,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--formats", nargs="+", default=list(FIXTURE_EXTENSIONS), help="extensions"
+    )
+    parser.add_argument("--count", type=int, default=10, help="files per format")
+    parser.add_argument("--output", help="JSON results path (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in args.formats:
+            for manifest_format in MANIFEST_FORMATS:
+                result = run_scenario(directory, extension, args.count, manifest_format)
+                print(
+                    "{format} {manifest_format}: export {export_s:.3f} s, "
+                    "import {import_s:.3f} s".format(**result),
+                    *result["problems"],
+                    sep="\n    ",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "mutagen": mutagen.version_string,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if any(result["problems"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of the per-file open latency when preparing a file for tagging:
+the previous approach (mutagen.File sniffing against every format, then
+reopening MP3 files as ID3) versus formats.open_for_tagging
+(extension-based fast path, single open).
+
+Usage:
+    python benchmarks/bench_format_dispatch.py [--count 200] [--payload-size 262144]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import mutagen  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from formats import open_for_tagging  # noqa: E402
+from metadata_setters import get_metadata_setter  # noqa: E402
+from mutagen.id3 import ID3, ID3NoHeaderError  # noqa: E402
+from mutagen.mp3 import MP3  # noqa: E402
+
+
+def legacy_open(filepath):
+    filething = mutagen.File(filepath)
+    if isinstance(filething, MP3) or filething.tags is None:
+        try:
+            filething = ID3(filepath)
+        except ID3NoHeaderError:
+            filething = ID3()
+    return filething
+
+
+def time_opens(open_function, paths):
+    timings = []
+    for path in paths:
+        start = time.perf_counter()
+        open_function(path)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=200, help="files per format")
+    parser.add_argument("--payload-size", type=int, default=256 * 1024)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(
+            "{:<6} {:>14} {:>14} {:>8}".format(
+                "format", "before (us)", "after (us)", "speedup"
+            )
+        )
+        for extension in FIXTURE_EXTENSIONS:
+            paths = write_fixtures(
+                os.path.join(directory, extension),
+                count=args.count,
+                payload_size=args.payload_size,
+                extensions=[extension],
+            )
+            # tag the fixtures first, so MP3 files have an ID3 header to find
+            for path in paths:
+                metadata_setter = get_metadata_setter(path, {"title": "Benchmark"})
+                metadata_setter.set_tags()
+                metadata_setter.save_tags_to_file()
+            # warm up the OS page cache, so both runs read from memory
+            time_opens(legacy_open, paths)
+            before = statistics.median(time_opens(legacy_open, paths)) * 1e6
+            after = statistics.median(time_opens(open_for_tagging, paths)) * 1e6
+            print(
+                "{:<6} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                    extension, before, after, before / after
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
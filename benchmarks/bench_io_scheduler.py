@@ -0,0 +1,312 @@
+"""
+Benchmark of the locality-aware write scheduler on simulated slow storage.
+Latency is injected into every open, read and write of the files mutagen
+opens, following a model of the storage:
+    - hdd: a single-head disk; operations are served one at a time,
+      each seeking from the previous one, for longer the farther apart
+      (in inode order) their files are;
+    - nas: a network mount; every operation costs a round trip,
+      and a limited number of operations are served at once.
+Metadata lookups (stat) aren't slowed down.
+Every strategy writes a title to all the fixtures, submitted in shuffled order
+(as files can be selected in the GUI) to a BatchWriter:
+    - unordered: as they come, to the whole worker pool;
+    - ordered: sorted by locality, to the whole worker pool;
+    - scheduled: sorted by locality, with an adaptive limit of files per device.
+Results are written as JSON, with the per-device limits the scheduler ended with.
+
+Usage:
+    python benchmarks/bench_io_scheduler.py --output results.json
+    python benchmarks/bench_io_scheduler.py --storage hdd --count 200 --workers 16
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import mutagen  # noqa: E402
+import mutagen._util  # noqa: E402
+from engine import DEFAULT_MAX_WORKERS, BatchWriter, WriteResult  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from scheduler import DEFAULT_MAX_IO_PER_DEVICE, iter_ordered_jobs  # noqa: E402
+
+STRATEGIES = ("unordered", "ordered", "scheduled")
+
+# latencies in seconds, bandwidth in bytes per second
+STORAGE_MODELS = {
+    "hdd": {
+        "latency": 0.0001,
+        "min_seek": 0.0005,
+        "max_seek": 0.008,
+        # files apart in inode order for a full seek
+        "seek_span": 64,
+        "bandwidth": 100 * 1024 * 1024,
+        "max_parallel": 1,
+    },
+    "nas": {
+        "latency": 0.002,
+        "min_seek": 0.0,
+        "max_seek": 0.0,
+        "seek_span": 1,
+        "bandwidth": 50 * 1024 * 1024,
+        "max_parallel": 16,
+    },
+}
+
+
+class SimulatedStorage:
+    """Latency model of a storage device, see STORAGE_MODELS."""
+
+    def __init__(
+        self,
+        paths,
+        latency,
+        min_seek,
+        max_seek,
+        seek_span,
+        bandwidth,
+        max_parallel,
+    ):
+        # position of the files on the device
+        self.positions = {
+            os.path.abspath(path): position
+            for position, path in enumerate(sorted(paths, key=get_inode))
+        }
+        self.latency = latency
+        self.min_seek = min_seek
+        self.max_seek = max_seek
+        self.seek_span = seek_span
+        self.bandwidth = bandwidth
+        self.operations = 0
+        self.seek_time = 0.0
+        self._slots = threading.BoundedSemaphore(max_parallel)
+        self._lock = threading.Lock()
+        # (file position, offset) the previous operation ended at
+        self._head = None
+
+    def get_seek(self, position, offset):
+        if self._head is None or not self.max_seek:
+            return 0.0
+        head_position, head_offset = self._head
+        if head_position == position:
+            return 0.0 if head_offset == offset else self.min_seek
+        distance = min(1.0, abs(head_position - position) / self.seek_span)
+        return self.min_seek + (self.max_seek - self.min_seek) * distance
+
+    def access(self, path, offset, size):
+        position = self.positions.get(path, 0)
+        with self._slots:
+            with self._lock:
+                seek = self.get_seek(position, offset)
+                self._head = (position, offset + size)
+                self.operations += 1
+                self.seek_time += seek
+            time.sleep(self.latency + seek + size / self.bandwidth)
+
+
+class SlowFile:
+    """File object wrapper going through a SimulatedStorage for every access."""
+
+    def __init__(self, fileobj, path, storage):
+        self._fileobj = fileobj
+        self._path = path
+        self._storage = storage
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._fileobj.close()
+
+    def read(self, size=-1):
+        offset = self._fileobj.tell()
+        data = self._fileobj.read(size)
+        self._storage.access(self._path, offset, len(data))
+        return data
+
+    def write(self, data):
+        self._storage.access(self._path, self._fileobj.tell(), len(data))
+        return self._fileobj.write(data)
+
+
+def get_inode(path):
+    return os.stat(path).st_ino
+
+
+def patch_open(storage):
+    """Make mutagen open files through the storage, returning the undo function."""
+
+    def slow_open(filename, *args, **kwargs):
+        path = os.path.abspath(filename)
+        # looking the file up
+        storage.access(path, 0, 0)
+        return SlowFile(open(filename, *args, **kwargs), path, storage)
+
+    mutagen._util.open = slow_open
+    return lambda: delattr(mutagen._util, "open")
+
+
+def write_titles(batch_writer, paths, variant):
+    jobs = [(path, {"title": "Title {}".format(variant)}) for path in paths]
+    batch_job = batch_writer.submit(jobs)
+    batch_job.wait()
+    for result in batch_job.results:
+        if result.status != WriteResult.SAVED:
+            raise RuntimeError(
+                "{}: {} {}".format(result.filepath, result.status, result.error)
+            )
+
+
+def make_batch_writer(strategy, max_workers, max_io_per_device):
+    if strategy == "scheduled":
+        return BatchWriter(max_workers=max_workers, max_io_per_device=max_io_per_device)
+    return BatchWriter(max_workers=max_workers)
+
+
+def run_scenario(directory, storage_name, args):
+    """Time the strategies on one storage model, yielding a result per strategy."""
+    paths = write_fixtures(
+        directory,
+        count=args.count,
+        payload_size=args.payload_size,
+        extensions=args.formats,
+    )
+    # the first write adds padding, so that all the timed writes are in place
+    batch_writer = BatchWriter(max_workers=args.workers)
+    write_titles(batch_writer, paths, 0)
+    batch_writer.shutdown()
+    shuffled_paths = list(paths)
+    random.Random(args.seed).shuffle(shuffled_paths)
+    ordered_paths = [
+        path for path, _ in iter_ordered_jobs((path, {}) for path in paths)
+    ]
+    storage = SimulatedStorage(paths, **STORAGE_MODELS[storage_name])
+    # kept across the passes, like the GUI's, so the scheduler's limits carry over
+    batch_writers = {
+        strategy: make_batch_writer(strategy, args.workers, args.io_per_device)
+        for strategy in STRATEGIES
+    }
+    timings = {strategy: [] for strategy in STRATEGIES}
+    operations = {strategy: [] for strategy in STRATEGIES}
+    seek_times = {strategy: [] for strategy in STRATEGIES}
+    undo_patch = patch_open(storage)
+    try:
+        variant = 1
+        for _ in range(args.repeat):
+            for strategy in STRATEGIES:
+                storage.operations = 0
+                storage.seek_time = 0.0
+                start = time.perf_counter()
+                write_titles(
+                    batch_writers[strategy],
+                    ordered_paths if strategy == "ordered" else shuffled_paths,
+                    variant,
+                )
+                timings[strategy].append(time.perf_counter() - start)
+                operations[strategy].append(storage.operations)
+                seek_times[strategy].append(storage.seek_time)
+                variant += 1
+    finally:
+        undo_patch()
+        for path in paths:
+            os.remove(path)
+    for strategy in STRATEGIES:
+        batch_writer = batch_writers[strategy]
+        limits = getattr(batch_writer.executor.executor, "limits", {})
+        batch_writer.shutdown()
+        median = statistics.median(timings[strategy])
+        yield {
+            "storage": storage_name,
+            "strategy": strategy,
+            "count": len(paths),
+            "repeat": args.repeat,
+            "median_s": median,
+            "min_s": min(timings[strategy]),
+            "files_per_s": len(paths) / median,
+            "operations": statistics.median(operations[strategy]),
+            "seek_s": statistics.median(seek_times[strategy]),
+            "device_limits": sorted(limits.values()),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--storage",
+        nargs="+",
+        choices=list(STORAGE_MODELS),
+        default=list(STORAGE_MODELS),
+        help="storage models",
+    )
+    parser.add_argument(
+        "--formats", nargs="+", default=list(FIXTURE_EXTENSIONS), help="extensions"
+    )
+    parser.add_argument("--count", type=int, default=20, help="files per format")
+    parser.add_argument(
+        "--payload-size", type=int, default=256 * 1024, help="audio payload, in bytes"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="passes per strategy")
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_MAX_WORKERS, help="worker pool size"
+    )
+    parser.add_argument(
+        "--io-per-device",
+        type=int,
+        default=DEFAULT_MAX_IO_PER_DEVICE,
+        help="max files per device of the scheduled strategy",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="shuffling seed")
+    parser.add_argument("--output", help="JSON results path (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for storage_name in args.storage:
+            for result in run_scenario(directory, storage_name, args):
+                print(
+                    "{storage}: {strategy:<10} {median_s:8.3f} s "
+                    "{files_per_s:8.1f} files/s, seeking {seek_s:6.3f} s, "
+                    "device limits {device_limits}".format(**result),
+                    file=sys.stderr,
+                )
+                results.append(result)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "mutagen": mutagen.version_string,
+        },
+        "storage_models": {name: STORAGE_MODELS[name] for name in args.storage},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
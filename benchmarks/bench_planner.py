@@ -0,0 +1,167 @@
+"""
+Accuracy check of the dry-run planner against real saves.
+For every supported container, a fixture goes through a sequence of writes:
+    - first_write: a title, on a file without tags or padding yet;
+    - no_op: the same title again;
+    - cover_embed: a cover, fitting in the padding the first write reserved;
+    - write_single: another title;
+    - overflow: an artist too long for the padding left.
+Every write is planned first (checking the plan doesn't modify the file),
+then made with write_metadata, counting the bytes written.
+A prediction is wrong when its action isn't what the save did, when an
+in place estimate isn't exact, or when a rewrite estimate is above the bytes
+actually written (rewrite estimates are a lower bound, see planner.estimate_save).
+Results are written as JSON; the exit status is 1 if a prediction is wrong.
+
+Usage:
+    python benchmarks/bench_planner.py --output results.json
+    python benchmarks/bench_planner.py --formats wav --sizes 65536
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import mutagen  # noqa: E402
+from bench_suite import make_cover  # noqa: E402
+from covers import MAX_COVER_BYTES  # noqa: E402
+from engine import WriteResult, write_metadata  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from planner import IN_PLACE, NO_OP, REWRITE, plan_write  # noqa: E402
+
+# longer than the padding reserved for a cover and the text tags
+OVERFLOW_ARTIST = "a" * 2 * MAX_COVER_BYTES
+
+
+def get_steps(cover):
+    return (
+        ("first_write", {"title": "Title 1"}),
+        ("no_op", {"title": "Title 1"}),
+        ("cover_embed", {"cover": cover}),
+        ("write_single", {"title": "Title 2"}),
+        ("overflow", {"artist": OVERFLOW_ARTIST}),
+    )
+
+
+def get_file_signature(filepath):
+    stat_result = os.stat(filepath)
+    with open(filepath, "rb") as file_:
+        return stat_result.st_size, stat_result.st_mtime_ns, hash(file_.read())
+
+
+def get_actual_action(result):
+    if result.status == WriteResult.SKIPPED:
+        return NO_OP
+    if result.status == WriteResult.SAVED:
+        return result.write_mode
+    return result.status
+
+
+def check_step(filepath, metadata_changes):
+    """Plan then make a write, returning the comparison and the problems found."""
+    signature = get_file_signature(filepath)
+    plan = plan_write(filepath, metadata_changes)
+    result = write_metadata(filepath, metadata_changes, instrument=True)
+    actual_action = get_actual_action(result)
+    actual_bytes = result.timings.bytes_written
+    problems = []
+    if get_file_signature(filepath) == signature and actual_action != NO_OP:
+        problems.append("the file wasn't written")
+    if plan.error or result.error:
+        problems.append(plan.error or result.error)
+    if plan.action != actual_action:
+        problems.append("planned {}, was {}".format(plan.action, actual_action))
+    elif plan.action == IN_PLACE and plan.estimated_bytes != actual_bytes:
+        problems.append("in place estimate isn't exact")
+    elif plan.action == REWRITE and plan.estimated_bytes > actual_bytes:
+        problems.append("rewrite estimate is above the bytes written")
+    return {
+        "planned_action": plan.action,
+        "actual_action": actual_action,
+        "estimated_bytes": plan.estimated_bytes,
+        "actual_bytes": actual_bytes,
+        "ratio": plan.estimated_bytes / actual_bytes if actual_bytes else None,
+        "problems": problems,
+    }
+
+
+def run_scenario(directory, extension, payload_size, cover):
+    (filepath,) = write_fixtures(
+        directory, payload_size=payload_size, extensions=[extension]
+    )
+    try:
+        for step, metadata_changes in get_steps(cover):
+            result = {"format": extension, "payload_size": payload_size, "step": step}
+            result.update(check_step(filepath, metadata_changes))
+            yield result
+    finally:
+        os.remove(filepath)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--formats", nargs="+", default=list(FIXTURE_EXTENSIONS), help="extensions"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[64 * 1024, 4 * 1024 * 1024],
+        help="audio payload sizes, in bytes",
+    )
+    parser.add_argument("--output", help="JSON results path (default: stdout)")
+    args = parser.parse_args(argv)
+
+    cover = make_cover((200, 40, 40))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in args.formats:
+            for payload_size in args.sizes:
+                for result in run_scenario(directory, extension, payload_size, cover):
+                    print(
+                        "{format} {payload_size}: {step:<12} planned {planned_action} "
+                        "{estimated_bytes} bytes, was {actual_action} "
+                        "{actual_bytes} bytes{problems}".format(
+                            **dict(
+                                result,
+                                problems="".join(
+                                    " - " + problem for problem in result["problems"]
+                                ),
+                            )
+                        ),
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "mutagen": mutagen.version_string,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if any(result["problems"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
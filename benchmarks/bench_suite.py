@@ -0,0 +1,269 @@
+"""
+Reproducible benchmark suite of the tag read and write paths.
+For every supported container, deterministic fixtures are generated
+at each payload size and file count, and the suite times, over all the files:
+    - read: reading the displayed tags, as MetadataDisplayPanel.get_metadata
+      does on a TagCache miss;
+    - read_cached: the same lookup on a TagCache hit;
+    - write_single: setting one tag with the metadata setters;
+    - write_multi: setting all the text tags in one open/save;
+    - cover_embed: embedding a cover.
+Writes alternate between two sets of values, so no write is skipped as a no-op.
+Results are written as JSON, and can be compared with the results of an earlier
+run to spot regressions.
+
+Usage:
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --counts 1 10000 --sizes 65536 --repeat 3
+    python benchmarks/bench_suite.py --output new.json --compare results.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import mutagen  # noqa: E402
+from engine import WriteResult, write_metadata  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from metadata_readers import read_metadata  # noqa: E402
+from PIL import Image  # noqa: E402
+from tag_cache import TagCache  # noqa: E402
+
+OPERATIONS = ("read", "read_cached", "write_single", "write_multi", "cover_embed")
+# fixtures of a scenario (one format, size and count) are skipped above this size
+DEFAULT_MAX_SCENARIO_BYTES = 1024**3
+
+
+def make_cover(color):
+    """Deterministic JPEG cover, about the size of an encoded 400x400 cover."""
+    image = Image.linear_gradient("L").resize((400, 400)).convert("RGB")
+    image.paste(color, (0, 0, 200, 200))
+    byteIO = io.BytesIO()
+    image.save(byteIO, format="JPEG", quality=75)
+    return byteIO.getvalue()
+
+
+def get_write_changes(operation, variant, covers):
+    if operation == "write_single":
+        return {"title": "Title {}".format(variant)}
+    if operation == "write_multi":
+        return {
+            "artist": "Artist {}".format(variant),
+            "album": "Album {}".format(variant),
+            "title": "Title {}".format(variant),
+            "track_number": str(variant + 1),
+            "recording_year": str(2000 + variant),
+        }
+    return {"cover": covers[variant]}
+
+
+def time_pass(function, paths):
+    start = time.perf_counter()
+    for path in paths:
+        function(path)
+    return time.perf_counter() - start
+
+
+def time_operation(operation, paths, repeat, covers):
+    """Return the durations of `repeat` passes of an operation over all the paths."""
+    timings = []
+    if operation in ("read", "read_cached"):
+        tag_cache = TagCache(max_size=len(paths), loader=read_metadata)
+        if operation == "read_cached":
+            time_pass(tag_cache.get, paths)
+        for _ in range(repeat):
+            if operation == "read":
+                tag_cache.clear()
+            timings.append(time_pass(tag_cache.get, paths))
+        return timings
+    # the first pass brings every file to the same state,
+    # e.g. a cover already embedded, and is left out of the timings
+    for iteration in range(repeat + 1):
+        metadata_changes = get_write_changes(operation, iteration % 2, covers)
+
+        def write(path):
+            result = write_metadata(path, metadata_changes)
+            if result.status != WriteResult.SAVED:
+                raise RuntimeError(
+                    "{} of {}: {} {}".format(
+                        operation, path, result.status, result.error
+                    )
+                )
+
+        duration = time_pass(write, paths)
+        if iteration:
+            timings.append(duration)
+    return timings
+
+
+def run_scenario(directory, extension, payload_size, count, repeat, covers):
+    paths = write_fixtures(
+        directory, count=count, payload_size=payload_size, extensions=(extension,)
+    )
+    try:
+        for operation in OPERATIONS:
+            timings = time_operation(operation, paths, repeat, covers)
+            median = statistics.median(timings)
+            yield {
+                "format": extension,
+                "payload_size": payload_size,
+                "count": count,
+                "operation": operation,
+                "repeat": repeat,
+                "median_s": median,
+                "min_s": min(timings),
+                "per_file_us": median / count * 1e6,
+            }
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def get_result_key(result):
+    return (
+        result["format"],
+        result["payload_size"],
+        result["count"],
+        result["operation"],
+    )
+
+
+def compare(results, baseline_results, threshold):
+    """
+    Print the per-file time of every case relative to the baseline, to stderr.
+    Returns the number of cases slower than the baseline by more than threshold.
+    """
+    baseline = {get_result_key(result): result for result in baseline_results}
+    regressions = 0
+    print(
+        "{:<6} {:>10} {:>7} {:<13} {:>14} {:>14} {:>7}".format(
+            "format", "size", "files", "operation", "baseline (us)", "now (us)", "ratio"
+        ),
+        file=sys.stderr,
+    )
+    for result in results:
+        baseline_result = baseline.get(get_result_key(result))
+        if baseline_result is None:
+            continue
+        ratio = result["per_file_us"] / baseline_result["per_file_us"]
+        regressed = ratio > 1 + threshold
+        regressions += regressed
+        print(
+            "{:<6} {:>10} {:>7} {:<13} {:>14.1f} {:>14.1f} {:>6.2f}x{}".format(
+                *get_result_key(result),
+                baseline_result["per_file_us"],
+                result["per_file_us"],
+                ratio,
+                " REGRESSION" if regressed else "",
+            ),
+            file=sys.stderr,
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--formats", nargs="+", default=list(FIXTURE_EXTENSIONS), help="extensions"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[64 * 1024, 4 * 1024 * 1024],
+        help="audio payload sizes, in bytes",
+    )
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[1, 10000], help="files per scenario"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="passes per operation")
+    parser.add_argument(
+        "--max-scenario-bytes",
+        type=int,
+        default=DEFAULT_MAX_SCENARIO_BYTES,
+        help="skip scenarios whose fixtures would take more disk space",
+    )
+    parser.add_argument("--output", help="JSON results path (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown reported as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    covers = (make_cover((200, 40, 40)), make_cover((40, 40, 200)))
+    results = []
+    skipped = []
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in args.formats:
+            for payload_size in args.sizes:
+                for count in args.counts:
+                    scenario = {
+                        "format": extension,
+                        "payload_size": payload_size,
+                        "count": count,
+                    }
+                    if payload_size * count > args.max_scenario_bytes:
+                        skipped.append(scenario)
+                        continue
+                    print(
+                        "{format}: {count} files of {payload_size} bytes".format(
+                            **scenario
+                        ),
+                        file=sys.stderr,
+                    )
+                    results.extend(
+                        run_scenario(
+                            directory,
+                            extension,
+                            payload_size,
+                            count,
+                            args.repeat,
+                            covers,
+                        )
+                    )
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "mutagen": mutagen.version_string,
+        },
+        "skipped": skipped,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline_results = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline_results, args.threshold)
+        if regressions:
+            print("{} regressions".format(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Benchmark and consistency check of the SQLite tag index.
+Times, over synthetic fixtures of every supported container:
+    - scan: indexing a directory tree from scratch;
+    - rescan: scanning it again, with no file changed;
+    - tag: writing a title to every file by a path relative to the working
+      directory, the index being updated after every saved file
+      (as `cli.py tag --database` does);
+    - rescan_after_tag: scanning once more.
+The index must end with a single row per file, holding the written title,
+and the last scan must find every file unchanged.
+Results are written as JSON; the exit status is 1 if a check fails.
+
+Usage:
+    python benchmarks/bench_tag_index.py --output results.json
+    python benchmarks/bench_tag_index.py --count 1000
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+import mutagen  # noqa: E402
+from engine import WriteResult, iter_write_results  # noqa: E402
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from tag_index import TagIndex  # noqa: E402
+
+TITLE = "Indexed title"
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run(directory, args):
+    library = os.path.join(directory, "library")
+    os.makedirs(library)
+    paths = write_fixtures(library, count=args.count, payload_size=args.payload_size)
+    tag_index = TagIndex(os.path.join(directory, "tags.sqlite3"))
+    timings = {}
+    problems = []
+    timings["scan"], _ = timed(tag_index.scan, library)
+    timings["rescan"], _ = timed(tag_index.scan, library)
+    working_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        jobs = [(os.path.relpath(path, directory), {"title": TITLE}) for path in paths]
+        timings["tag"], results = timed(
+            list, iter_write_results(jobs, tag_index=tag_index)
+        )
+    finally:
+        os.chdir(working_directory)
+    for result in results:
+        if result.status != WriteResult.SAVED:
+            problems.append("{}: {}".format(result.filepath, result.status))
+    timings["rescan_after_tag"], scan_result = timed(tag_index.scan, library)
+    if scan_result.unchanged != len(paths):
+        problems.append("last scan: {}".format(scan_result))
+    rows = list(tag_index.query())
+    if len(rows) != len(paths):
+        problems.append("{} rows for {} files".format(len(rows), len(paths)))
+    for row in rows:
+        if row["title"] != TITLE:
+            problems.append("{}: title {!r}".format(row["path"], row["title"]))
+    tag_index.close()
+    return {"count": len(paths), "timings_s": timings, "problems": problems}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=20, help="files per format")
+    parser.add_argument(
+        "--payload-size", type=int, default=64 * 1024, help="audio payload, in bytes"
+    )
+    parser.add_argument("--output", help="JSON results path (default: stdout)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        result = run(directory, args)
+    for name, seconds in result["timings_s"].items():
+        print("{:<17} {:8.3f} s".format(name, seconds), file=sys.stderr)
+    for problem in result["problems"]:
+        print(problem, file=sys.stderr)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "mutagen": mutagen.version_string,
+        },
+        "formats": list(FIXTURE_EXTENSIONS),
+        "result": result,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if result["problems"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of reading the displayed metadata tags of a file:
+mutagen.File with easy tags (which also parses the audio stream info)
+versus the tag-only reader used by metadata_readers.read_file_info.
+Runs on synthetic fixtures, or on the audio files of a local corpus directory.
+
+Usage:
+    python benchmarks/bench_tag_read.py [--count 200] [--payload-size 4194304]
+    python benchmarks/bench_tag_read.py --corpus ~/Music
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "src",
+        "mutagen_ez_gui",
+    ),
+)
+
+from fixtures import FIXTURE_EXTENSIONS, write_fixtures  # noqa: E402
+from metadata_readers import read_file_info, read_file_info_with_mutagen  # noqa: E402
+from metadata_setters import get_metadata_setter  # noqa: E402
+from tag_index import iter_audio_files  # noqa: E402
+from tag_reader import UnsupportedTags, read_tags  # noqa: E402
+
+
+def time_reads(read_function, paths):
+    timings = []
+    for path in paths:
+        start = time.perf_counter()
+        read_function(path)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def write_tagged_fixtures(directory, count, payload_size):
+    paths = write_fixtures(directory, count=count, payload_size=payload_size)
+    for path in paths:
+        metadata_setter = get_metadata_setter(
+            path,
+            {
+                "artist": "Benchmark Artist",
+                "album": "Benchmark Album",
+                "title": os.path.basename(path),
+                "track_number": "1",
+                "recording_year": "2020",
+            },
+        )
+        metadata_setter.set_tags()
+        metadata_setter.save_tags_to_file()
+    return paths
+
+
+def run(paths):
+    paths_by_extension = defaultdict(list)
+    for path in paths:
+        paths_by_extension[os.path.splitext(path)[1].lower()].append(path)
+    print(
+        "{:<6} {:>7} {:>10} {:>14} {:>14} {:>8}".format(
+            "format", "files", "fallbacks", "mutagen (us)", "tag-only (us)", "speedup"
+        )
+    )
+    for extension, extension_paths in sorted(paths_by_extension.items()):
+        fallbacks = 0
+        for path in extension_paths:
+            try:
+                read_tags(path)
+            except (UnsupportedTags, OSError):
+                fallbacks += 1
+        # warm up the OS page cache, so both runs read from memory
+        time_reads(read_file_info_with_mutagen, extension_paths)
+        before = statistics.median(
+            time_reads(read_file_info_with_mutagen, extension_paths)
+        )
+        after = statistics.median(time_reads(read_file_info, extension_paths))
+        print(
+            "{:<6} {:>7} {:>10} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                extension,
+                len(extension_paths),
+                fallbacks,
+                before * 1e6,
+                after * 1e6,
+                before / after,
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--corpus", help="directory of audio files to read")
+    parser.add_argument("--count", type=int, default=200, help="files per format")
+    parser.add_argument("--payload-size", type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        run([path for path, _ in iter_audio_files(args.corpus)])
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        print(
+            "{} synthetic files per format ({}), {} bytes of audio payload".format(
+                args.count, ", ".join(FIXTURE_EXTENSIONS), args.payload_size
+            )
+        )
+        run(write_tagged_fixtures(directory, args.count, args.payload_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Deterministic synthetic audio fixtures.
+The generated files contain valid container structures (headers, metadata
+blocks and silent/zeroed audio payload) so mutagen can parse and tag them,
+without requiring any audio encoder to be installed.
+"""
+
+import os
+import struct
+
+from mutagen.ogg import OggPage
+
+FIXTURE_EXTENSIONS = ("mp3", "flac", "ogg", "opus", "m4a", "wav")
+
+# MPEG-1 Layer III, 128 kbps, 44100 Hz, no padding, joint stereo
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+
+
+def _pad_payload(payload_size):
+    return b"\x00" * payload_size
+
+
+def make_mp3(payload_size):
+    frame = MP3_FRAME_HEADER + b"\x00" * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    frame_count = max(payload_size // MP3_FRAME_SIZE, 8)
+    return frame * frame_count
+
+
+def make_flac(payload_size):
+    sample_rate, channels, bits_per_sample, total_samples = 44100, 2, 16, 44100
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6
+    packed = (
+        (sample_rate << 44)
+        | ((channels - 1) << 41)
+        | ((bits_per_sample - 1) << 36)
+        | total_samples
+    )
+    streaminfo += struct.pack(">Q", packed) + b"\x00" * 16
+    # last-metadata-block flag set, block type 0 (STREAMINFO)
+    header = bytes([0x80]) + struct.pack(">I", len(streaminfo))[1:]
+    # the frame payload is never decoded by mutagen, only skipped
+    return b"fLaC" + header + streaminfo + _pad_payload(payload_size)
+
+
+def _ogg_pages(serial, header_packets, payload_size):
+    pages = []
+    for sequence, packets in enumerate(header_packets):
+        page = OggPage()
+        page.serial = serial
+        page.sequence = sequence
+        page.position = 0
+        page.first = sequence == 0
+        page.packets = packets
+        pages.append(page)
+    chunk_size = 4000
+    remaining = max(payload_size, chunk_size)
+    sequence = len(pages)
+    position = 0
+    while remaining > 0:
+        page = OggPage()
+        page.serial = serial
+        page.sequence = sequence
+        position += 48000
+        page.position = position
+        page.packets = [_pad_payload(min(chunk_size, remaining))]
+        remaining -= chunk_size
+        sequence += 1
+        pages.append(page)
+    pages[-1].last = True
+    return b"".join(page.write() for page in pages)
+
+
+def make_ogg(payload_size):
+    identification = (
+        b"\x01vorbis"
+        + struct.pack("<IBI", 0, 2, 44100)
+        + struct.pack("<iii", 0, 128000, 0)
+        + b"\xb8\x01"
+    )
+    vendor = b"mutagen-ez-gui fixtures"
+    comment = b"\x03vorbis" + struct.pack("<I", len(vendor)) + vendor
+    comment += struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\x00" * 32
+    return _ogg_pages(1, [[identification], [comment, setup]], payload_size)
+
+
+def make_opus(payload_size):
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+    vendor = b"mutagen-ez-gui fixtures"
+    tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor
+    tags += struct.pack("<I", 0)
+    return _ogg_pages(2, [[head], [tags]], payload_size)
+
+
+def _atom(name, data):
+    return struct.pack(">I", len(data) + 8) + name + data
+
+
+def make_m4a(payload_size):
+    ftyp = _atom(b"ftyp", b"M4A \x00\x00\x02\x00M4A mp42isom")
+    # version 0 mvhd: times, timescale 44100, duration 1s, remaining defaults
+    mvhd = _atom(
+        b"mvhd",
+        b"\x00\x00\x00\x00"
+        + struct.pack(">IIII", 0, 0, 44100, 44100)
+        + b"\x00\x01\x00\x00\x01\x00"
+        + b"\x00" * 70
+        + struct.pack(">I", 2),
+    )
+    moov = _atom(b"moov", mvhd)
+    mdat = _atom(b"mdat", _pad_payload(payload_size))
+    return ftyp + moov + mdat
+
+
+def make_wav(payload_size):
+    sample_rate, channels, bits_per_sample = 44100, 2, 16
+    block_align = channels * bits_per_sample // 8
+    fmt = struct.pack(
+        "<HHIIHH",
+        1,
+        channels,
+        sample_rate,
+        sample_rate * block_align,
+        block_align,
+        bits_per_sample,
+    )
+    data_size = max(payload_size - payload_size % block_align, block_align)
+    chunks = (
+        b"WAVE" + _riff_chunk(b"fmt ", fmt) + _riff_chunk(b"data", b"\x00" * data_size)
+    )
+    return b"RIFF" + struct.pack("<I", len(chunks)) + chunks
+
+
+def _riff_chunk(name, data):
+    chunk = name + struct.pack("<I", len(data)) + data
+    if len(data) % 2:
+        chunk += b"\x00"
+    return chunk
+
+
+FIXTURE_FACTORIES = {
+    "mp3": make_mp3,
+    "flac": make_flac,
+    "ogg": make_ogg,
+    "opus": make_opus,
+    "m4a": make_m4a,
+    "wav": make_wav,
+}
+
+
+def write_fixtures(directory, count=1, payload_size=64 * 1024, extensions=None):
+    """
+    Write `count` fixtures per extension into `directory`
+    and return the list of created paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for extension in extensions or FIXTURE_EXTENSIONS:
+        content = FIXTURE_FACTORIES[extension](payload_size)
+        for index in range(count):
+            path = os.path.join(directory, "fixture_{:05d}.{}".format(index, extension))
+            with open(path, "wb") as fileobj:
+                fileobj.write(content)
+            paths.append(path)
+    return paths
@@ -0,0 +1,435 @@
+"""
+Virtualized audio file browser.
+An alternative to Kivy's FileChooserIconView for directories with tens of thousands
+of entries: the directory is listed lazily with os.scandir on a background thread,
+filtered to audio files, and shown in a RecycleView, which only builds
+widgets for the visible rows.
+Rows show the files' embedded covers, see CoverThumbnail.
+The directory is watched for changes made by other programs,
+which are applied to the rows without listing the directory again.
+Entry widget styles are defined in styles.py.
+"""
+
+import heapq
+import logging
+import os
+import threading
+from functools import partial
+
+from kivy.clock import Clock
+from kivy.properties import BooleanProperty, NumericProperty, StringProperty
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.image import Image
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.scrollview import ScrollView
+from metadata_readers import is_audio_file
+from selection import SelectionModel, format_size
+from thumbnails import thumbnail_loader
+from watcher import watch_directory
+
+# number of entries posted to the view at once
+FIRST_CHUNK_SIZE = 200
+CHUNK_SIZE = 2000
+# shown for directories, files without cover and until a cover is loaded
+DEFAULT_ICON = "assets/folder-img.png"
+
+logger = logging.getLogger(__name__)
+
+
+def list_directory(path):
+    """
+    List the subdirectories and audio files of a directory, without stat calls.
+    Returns (name, path, is_dir) tuples, directories first, sorted by name.
+    """
+    entries = []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            if entry.name.startswith("."):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir or is_audio_file(entry.name):
+                entries.append((entry.name, entry.path, is_dir))
+    entries.sort(key=lambda entry: get_sort_key(entry[0], entry[2]))
+    return entries
+
+
+def get_sort_key(name, is_dir):
+    """Directories first, then by name."""
+    return (not is_dir, name.lower())
+
+
+def get_row_sort_key(row):
+    return get_sort_key(os.path.basename(row["path"]), row["is_dir"])
+
+
+def make_entry_data(name, path, is_dir):
+    """Build a RecycleView data row; stats the file, so it's done off the main thread."""
+    size = mtime_ns = 0
+    if not is_dir:
+        try:
+            stat_result = os.stat(path)
+            size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        except OSError:
+            pass
+    return {
+        "name": name + os.sep if is_dir else name,
+        "path": path,
+        "is_dir": is_dir,
+        "file_size": size,
+        "size_text": "" if is_dir else format_size(size),
+        "mtime_ns": mtime_ns,
+        "selected": False,
+    }
+
+
+class DirectoryWatchMixin:
+    """
+    Watches the directory shown by a browser widget (its `path` property)
+    for files added, removed or modified by other programs, see watcher.py.
+    The thumbnails of the changed files are dropped, and the changes
+    are posted to on_directory_changes on the main thread.
+    """
+
+    watcher = None
+    _watching = False
+    # incremented for every watcher, so that changes posted by a stopped one are dropped
+    _watch_generation = 0
+
+    def start_watching(self):
+        """Watch the current directory, and the directories browsed next."""
+        if not self._watching:
+            self._watching = True
+            self.fbind("path", self._watch_path)
+            self._watch_path(self, self.path)
+
+    def stop_watching(self):
+        if self._watching:
+            self._watching = False
+            self.funbind("path", self._watch_path)
+            self._stop_watcher()
+
+    def _stop_watcher(self):
+        self._watch_generation += 1
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def _watch_path(self, instance, path):
+        self._stop_watcher()
+        try:
+            self.watcher = watch_directory(
+                path, partial(self._on_watcher_changes, self._watch_generation)
+            )
+        except OSError as error:
+            logger.warning("Couldn't watch %s for changes: %s", path, error)
+
+    def _on_watcher_changes(self, generation, changes):
+        # called from the watcher thread
+        for path in changes.modified + changes.removed:
+            thumbnail_loader.cache.invalidate(path)
+        prepared = self.prepare_directory_changes(changes)
+        Clock.schedule_once(
+            partial(self._dispatch_directory_changes, generation, changes, prepared)
+        )
+
+    def _dispatch_directory_changes(self, generation, changes, prepared, *args):
+        if generation == self._watch_generation:
+            self.on_directory_changes(changes, prepared)
+
+    def prepare_directory_changes(self, changes):
+        """
+        Called from the watcher thread, e.g. to stat the changed files,
+        returns the `prepared` argument of on_directory_changes.
+        """
+        return None
+
+    def on_directory_changes(self, changes, prepared):
+        """Called on the main thread with a batch of watcher.DirectoryChanges."""
+        pass
+
+
+class FileChooserWatchMixin(DirectoryWatchMixin):
+    """
+    Directory watching for Kivy's file choosers.
+    They can only list a whole directory, so it's listed again when files
+    are added or removed, but files modified in place only reload their thumbnail.
+    """
+
+    def on_directory_changes(self, changes, prepared):
+        super().on_directory_changes(changes, prepared)
+        removed = set(changes.removed)
+        if removed.intersection(self.selection):
+            self.selection = [path for path in self.selection if path not in removed]
+        if changes.rescan or changes.added or removed:
+            self._trigger_update()
+            return
+        modified = set(changes.modified)
+        # the entry widgets of the current listing
+        for entry in self._items:
+            if entry.path in modified:
+                for widget in entry.walk(restrict=True):
+                    if isinstance(widget, CoverThumbnail):
+                        widget.reload()
+
+
+class CoverThumbnail(Image):
+    """
+    Image of the cover embedded in an audio file, or of the default icon.
+    The thumbnail is only requested once the widget is scrolled into view,
+    and the request is cancelled if it's scrolled out (or recycled
+    for another file) before the thumbnail was loaded.
+    Used by the browser rows and the file chooser's FileIconEntry template.
+    """
+
+    audio_path = StringProperty("")
+    # changing it reloads the thumbnail, e.g. after the file was modified
+    audio_mtime_ns = NumericProperty(0)
+    loader = thumbnail_loader
+
+    def __init__(self, **kwargs):
+        # path of the pending thumbnail request
+        self._requested_path = None
+        # path whose thumbnail (or lack of) is shown
+        self._loaded_path = None
+        self._check_visibility_trigger = Clock.create_trigger(self.check_visibility)
+        super().__init__(**kwargs)
+        self.source = DEFAULT_ICON
+        # scrolling moves the entries, so the position tells when they come into view
+        self.bind(
+            pos=self._check_visibility_trigger, size=self._check_visibility_trigger
+        )
+
+    def on_audio_path(self, instance, audio_path):
+        self.reload()
+
+    def on_audio_mtime_ns(self, instance, audio_mtime_ns):
+        self.reload()
+
+    def reload(self):
+        self.cancel_request()
+        self._loaded_path = None
+        self.source = DEFAULT_ICON
+        self._check_visibility_trigger()
+
+    def cancel_request(self):
+        if self._requested_path is not None:
+            self.loader.cancel(self._requested_path, self._on_thumbnail_loaded)
+            self._requested_path = None
+
+    def get_scroll_view(self):
+        widget = self.parent
+        while widget is not None and not isinstance(widget, ScrollView):
+            widget = widget.parent
+        return widget
+
+    def is_visible(self):
+        if self.get_root_window() is None:
+            return False
+        scroll_view = self.get_scroll_view()
+        if scroll_view is None:
+            return True
+        x, y = self.to_window(*self.pos)
+        view_x, view_y = scroll_view.to_window(*scroll_view.pos)
+        return (
+            x < view_x + scroll_view.width
+            and view_x < x + self.width
+            and y < view_y + scroll_view.height
+            and view_y < y + self.height
+        )
+
+    def check_visibility(self, *args):
+        if not self.audio_path or not is_audio_file(self.audio_path):
+            return
+        if self._loaded_path == self.audio_path:
+            return
+        if not self.is_visible():
+            self.cancel_request()
+        elif self._requested_path is None:
+            self._requested_path = self.audio_path
+            self.loader.request(self.audio_path, self._on_thumbnail_loaded)
+
+    def _on_thumbnail_loaded(self, filepath, thumbnail_path):
+        # called from a loader thread
+        Clock.schedule_once(partial(self._set_thumbnail, filepath, thumbnail_path))
+
+    def _set_thumbnail(self, filepath, thumbnail_path, *args):
+        if filepath != self._requested_path:
+            return
+        self._requested_path = None
+        self._loaded_path = filepath
+        if thumbnail_path is not None:
+            self.source = thumbnail_path
+
+
+class BrowserEntry(RecycleDataViewBehavior, BoxLayout):
+    """A row of the browser. Instances are recycled as the view scrolls."""
+
+    name = StringProperty("")
+    path = StringProperty("")
+    file_size = NumericProperty(0)
+    size_text = StringProperty("")
+    mtime_ns = NumericProperty(0)
+    is_dir = BooleanProperty(False)
+    selected = BooleanProperty(False)
+    index = None
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.index = index
+        return super().refresh_view_attrs(rv, index, data)
+
+    def on_touch_down(self, touch):
+        if not self.collide_point(*touch.pos):
+            return super().on_touch_down(touch)
+        browser = self.parent.recycleview.browser
+        if self.is_dir:
+            browser.open_directory(self.path)
+        else:
+            browser.toggle_selection(self.index)
+            self.selected = not self.selected
+        return True
+
+
+class BrowserRecycleView(RecycleView):
+    def __init__(self, browser, **kwargs):
+        self.browser = browser
+        super().__init__(**kwargs)
+
+
+class AudioFileBrowser(DirectoryWatchMixin, BoxLayout):
+    """
+    Browser listing the subdirectories and audio files of a directory.
+    Exposes a `path` property like Kivy's file choosers;
+    the selected files are kept in a SelectionModel, updated incrementally.
+    Changes of the directory's files are applied to the listed entries.
+    """
+
+    path = StringProperty(os.getcwd())
+    loading = BooleanProperty(False)
+    selection_model = None
+
+    def __init__(self, **kwargs):
+        selection_model = kwargs.pop("selection_model", None)
+        if selection_model is not None:
+            self.selection_model = selection_model
+        elif self.selection_model is None:
+            self.selection_model = SelectionModel()
+        super().__init__(**kwargs)
+        self.orientation = "vertical"
+        self.recycle_view = BrowserRecycleView(self, viewclass="BrowserEntry")
+        self.add_widget(self.recycle_view)
+        self._generation = 0
+        # changes which came while the directory was being listed
+        self._deferred_changes = []
+        self.open_directory(self.path)
+        self.start_watching()
+
+    def open_directory(self, path):
+        """Start listing a directory in the background, replacing the current entries."""
+        self._generation += 1
+        self._deferred_changes = []
+        self.path = os.path.abspath(path)
+        self.selection_model.clear()
+        parent = os.path.dirname(self.path)
+        self.recycle_view.data = (
+            [make_entry_data("..", parent, True)] if parent != self.path else []
+        )
+        self.loading = True
+        threading.Thread(
+            target=self._list_in_background,
+            args=(self._generation, self.path),
+            daemon=True,
+        ).start()
+
+    def toggle_selection(self, index):
+        entry = self.recycle_view.data[index]
+        entry["selected"] = not entry["selected"]
+        if entry["selected"]:
+            self.selection_model.add(entry["path"], entry["file_size"])
+        else:
+            self.selection_model.remove(entry["path"])
+
+    def _list_in_background(self, generation, path):
+        try:
+            entries = list_directory(path)
+        except OSError:
+            entries = []
+        # a small first chunk, so the first rows show up quickly
+        start, chunk_size = 0, FIRST_CHUNK_SIZE
+        while start < len(entries):
+            # a newer directory was opened, stop listing this one
+            if generation != self._generation:
+                return
+            end = start + chunk_size
+            chunk = [make_entry_data(*entry) for entry in entries[start:end]]
+            Clock.schedule_once(partial(self._add_entries, generation, chunk))
+            start, chunk_size = end, CHUNK_SIZE
+        Clock.schedule_once(partial(self._finish_listing, generation))
+
+    def _add_entries(self, generation, chunk, *args):
+        if generation == self._generation:
+            self.recycle_view.data.extend(chunk)
+
+    def _finish_listing(self, generation, *args):
+        if generation == self._generation:
+            self.loading = False
+            deferred_changes, self._deferred_changes = self._deferred_changes, []
+            for changes, rows in deferred_changes:
+                self.apply_directory_changes(changes, rows)
+
+    def prepare_directory_changes(self, changes):
+        """Build the rows of the added and modified entries, in the watcher thread."""
+        rows = {}
+        for path in changes.added + changes.modified:
+            name = os.path.basename(path)
+            if name.startswith("."):
+                continue
+            is_dir = os.path.isdir(path)
+            if is_dir or is_audio_file(name):
+                rows[path] = make_entry_data(name, path, is_dir)
+        return rows
+
+    def on_directory_changes(self, changes, rows):
+        super().on_directory_changes(changes, rows)
+        if changes.rescan:
+            self.open_directory(self.path)
+        elif self.loading:
+            # the listing may or may not include these changes
+            self._deferred_changes.append((changes, rows))
+        else:
+            self.apply_directory_changes(changes, rows)
+
+    def apply_directory_changes(self, changes, rows):
+        """
+        Update the entries without listing the directory again:
+        removed entries are dropped, added ones are merged in at their sorted
+        position and modified ones replaced, keeping their selection.
+        Adding an entry which is already listed replaces it.
+        """
+        removed = set(changes.removed)
+        if not removed and not rows:
+            return
+        for path in removed:
+            self.selection_model.remove(path)
+        rows = dict(rows)
+        data = self.recycle_view.data
+        # the parent directory entry stays first
+        has_parent_row = bool(data) and data[0]["name"] == ".." + os.sep
+        parent_rows = data[:1] if has_parent_row else []
+        kept_rows = []
+        for row in data[has_parent_row:]:
+            path = row["path"]
+            if path in removed:
+                continue
+            new_row = rows.pop(path, None)
+            if new_row is not None:
+                new_row["selected"] = row["selected"]
+                row = new_row
+            kept_rows.append(row)
+        added_rows = sorted(rows.values(), key=get_row_sort_key)
+        self.recycle_view.data = parent_rows + list(
+            heapq.merge(kept_rows, added_rows, key=get_row_sort_key)
+        )
@@ -0,0 +1,659 @@
+"""
+Headless command line interface for bulk tagging (mutagen-ez).
+Doesn't import Kivy, so it can run on servers without a display.
+
+Usage:
+    python src/mutagen_ez_gui/cli.py export ~/Music --output tags.csv
+    python src/mutagen_ez_gui/cli.py tag tags.csv
+    python src/mutagen_ez_gui/cli.py autotag "%tracknumber% - %title%" ~/Music/Album
+    python src/mutagen_ez_gui/cli.py index ~/Music --database tags.sqlite3
+    python src/mutagen_ez_gui/cli.py tag tags.csv --journal job.journal
+    python src/mutagen_ez_gui/cli.py revert job.journal
+    python src/mutagen_ez_gui/cli.py tag tags.csv --stats stats.json --profile tag.prof
+    python src/mutagen_ez_gui/cli.py tag tags.csv --dry-run --plan job.plan
+    python src/mutagen_ez_gui/cli.py run-plan job.plan
+    python src/mutagen_ez_gui/cli.py tag tags.csv --io-per-device 2 --io-order path
+
+A manifest lists one file per row, with the path and the tags to set,
+using the metadata setters' input keys (artist, album, title, track_number,
+recording_year, cover - the path of a picture to embed).
+It can be a JSON lines file:
+    {"path": "/music/01.mp3", "artist": "Artist", "track_number": "1"}
+or a CSV file with a header row, where empty cells are left unchanged:
+    path,artist,track_number
+    /music/01.mp3,Artist,1
+Tags with several values are JSON arrays, e.g. {"artist": ["A", "B"]}, or in CSV
+cells, values separated by a backslash (A\\B), a backslash in a value being doubled.
+Rows of the same path are merged, later values taking precedence.
+The export command writes the current tags of files in the same formats,
+so they can be edited, e.g. in a spreadsheet, and imported back.
+With a journal, running the same command again after an interruption
+only writes the files left, and revert sets back the original tags.
+A dry run predicts, for every file, whether it would be left as it is,
+written in place or rewritten, and how many bytes would be written;
+the plan can be saved and run later.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from covers import COVER_QUALITY, COVER_SIZE, cover_cache
+from engine import DEFAULT_MAX_WORKERS, iter_write_results
+from filename_patterns import FilenamePattern, format_plan_preview, plan_track_numbers
+from instrumentation import NULL_TIMER, BatchProfiler, BatchStats
+from journal import JobJournal
+from metadata_readers import INPUT_METADATA_KEY_TO_METADATA_KEY, read_metadata
+from metadata_setters import BaseMetadataSetter
+from planner import (
+    FAILED,
+    IN_PLACE,
+    REWRITE,
+    PlanTotals,
+    PlanWriter,
+    iter_plan_jobs,
+    iter_plans,
+    read_plan,
+)
+from scheduler import DEFAULT_MAX_IO_PER_DEVICE, INODE_ORDER, ORDERS
+from selection import format_size
+from tag_index import UNKNOWN, TagIndex, iter_audio_files
+
+# exported columns, covers can't be exported as text
+EXPORT_KEYS = tuple(
+    key
+    for key in BaseMetadataSetter.input_metadata_key_to_target_tag_map
+    if key in INPUT_METADATA_KEY_TO_METADATA_KEY
+)
+# separates the values of a tag in CSV cells
+VALUE_SEPARATOR = "\\"
+
+
+def join_values(value):
+    """Write a tag value, or a list of values, to a CSV cell."""
+    values = value if isinstance(value, list) else [value]
+    escaped_separator = VALUE_SEPARATOR * 2
+    return VALUE_SEPARATOR.join(
+        item.replace(VALUE_SEPARATOR, escaped_separator) for item in values
+    )
+
+
+def split_values(cell):
+    """
+    Read a CSV cell written by join_values,
+    returning a string, or a list of them if there are several values.
+    """
+    values = [""]
+    position = 0
+    while position < len(cell):
+        if cell.startswith(VALUE_SEPARATOR * 2, position):
+            values[-1] += VALUE_SEPARATOR
+            position += 2
+        elif cell[position] == VALUE_SEPARATOR:
+            values.append("")
+            position += 1
+        else:
+            values[-1] += cell[position]
+            position += 1
+    return values[0] if len(values) == 1 else values
+
+
+def read_manifest(
+    fileobj, manifest_format="jsonl", cover_options=None, timer=NULL_TIMER
+):
+    """
+    Lazily yield (filepath, metadata_changes) pairs from a manifest.
+    Cover pictures are encoded once, however many files they are set on,
+    with the given cover_options (size, quality, progressive),
+    timing the encoding with the timer, e.g. the batch's BatchStats.
+    """
+    cover_options = cover_options or {}
+    supported_keys = BaseMetadataSetter.input_metadata_key_to_target_tag_map
+    if manifest_format == "csv":
+        rows = csv.DictReader(fileobj)
+    else:
+        rows = (json.loads(line) for line in fileobj if line.strip())
+    for row in rows:
+        filepath = row.pop("path")
+        metadata_changes = {}
+        for key, value in row.items():
+            if key not in supported_keys:
+                raise ValueError("Unsupported manifest column: {}".format(key))
+            if value in ("", None):
+                continue
+            if key == "cover":
+                metadata_changes[key] = cover_cache.get_cover(
+                    value, timer=timer, **cover_options
+                )
+            elif isinstance(value, list):
+                metadata_changes[key] = [str(item) for item in value]
+            elif manifest_format == "csv":
+                metadata_changes[key] = split_values(value)
+            else:
+                metadata_changes[key] = str(value)
+        yield filepath, metadata_changes
+
+
+def group_changes_by_path(jobs, deferred):
+    """
+    Lazily merge consecutive (filepath, metadata_changes) pairs of the same path,
+    so a file is written once with all its changes.
+    Changes to a path which was already yielded are merged into the deferred
+    dict instead, to be written once the first pass is over, so that a file
+    is never written by two workers at once.
+    Only the paths are kept in memory, not their changes.
+    """
+    seen_paths = set()
+    current_path = current_changes = None
+    for filepath, metadata_changes in jobs:
+        if filepath == current_path:
+            current_changes.update(metadata_changes)
+            continue
+        if current_path is not None:
+            yield current_path, current_changes
+            current_path = None
+        key = os.path.abspath(filepath)
+        if key in seen_paths:
+            deferred.setdefault(filepath, {}).update(metadata_changes)
+            continue
+        seen_paths.add(key)
+        current_path, current_changes = filepath, dict(metadata_changes)
+    if current_path is not None:
+        yield current_path, current_changes
+
+
+def read_export_row(filepath):
+    """
+    Read the tags of a file as a manifest row of input metadata keys,
+    tags with several values as lists.
+    """
+    tags = read_metadata(filepath)
+    row = {"path": filepath}
+    for key in EXPORT_KEYS:
+        value = tags.get(INPUT_METADATA_KEY_TO_METADATA_KEY[key], UNKNOWN)
+        if value == UNKNOWN or not value:
+            value = ""
+        elif isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        row[key] = value
+    return row
+
+
+def iter_export_rows(filepaths, max_workers=None):
+    """
+    Lazily yield (filepath, row or exception) for the paths, in order,
+    reading the files in a thread pool.
+    At most a few reads per worker are queued, so memory use stays constant
+    regardless of the number of files.
+    """
+    max_workers = max_workers or DEFAULT_MAX_WORKERS
+    max_pending = max_workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filepath in filepaths:
+            pending.append((filepath, executor.submit(read_export_row, filepath)))
+            if len(pending) >= max_pending:
+                yield get_export_row(*pending.popleft())
+        while pending:
+            yield get_export_row(*pending.popleft())
+
+
+def get_export_row(filepath, future):
+    try:
+        return filepath, future.result()
+    except Exception as exc:
+        return filepath, exc
+
+
+def write_export(rows, fileobj, manifest_format="jsonl"):
+    """Write manifest rows to a file object, one at a time."""
+    if manifest_format == "csv":
+        writer = csv.DictWriter(fileobj, fieldnames=("path", *EXPORT_KEYS))
+        writer.writeheader()
+
+        def write_row(row):
+            writer.writerow(
+                {
+                    key: value if key == "path" else join_values(value)
+                    for key, value in row.items()
+                }
+            )
+
+    else:
+
+        def write_row(row):
+            fileobj.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    for row in rows:
+        write_row(row)
+
+
+def open_manifest(path, mode="r"):
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def get_manifest_format(args, path=None):
+    if args.format:
+        return args.format
+    path = path or args.manifest
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def write_jobs(job_passes, args, journal=None, statuses=None, stats=None):
+    """
+    Write passes of (filepath, metadata_changes) pairs in parallel,
+    one pass after the other, printing a JSON result per file and a summary.
+    statuses can be given to count files the caller reported itself,
+    and stats to record the stages the caller runs, e.g. encoding covers.
+    Returns the exit code.
+    """
+    tag_index = None
+    if args.database:
+        tag_index = TagIndex(args.database)
+    if stats is None and args.stats:
+        stats = BatchStats()
+    profiler = BatchProfiler() if args.profile else None
+    if statuses is None:
+        statuses = Counter()
+    for jobs in job_passes:
+        write_pass(jobs, args, tag_index, statuses, journal, stats, profiler)
+    if stats is not None:
+        stats.write_json(args.stats)
+    if profiler is not None:
+        profiler.dump(args.profile)
+    if journal is not None and journal.resumed:
+        statuses["done before resuming"] = journal.resumed
+    print(
+        ", ".join("{}: {}".format(status, count) for status, count in statuses.items())
+        or "No files to tag",
+        file=sys.stderr,
+    )
+    return 1 if statuses["failed"] else 0
+
+
+def write_pass(
+    jobs, args, tag_index, statuses, journal=None, stats=None, profiler=None
+):
+    for result in iter_write_results(
+        jobs,
+        max_workers=args.workers,
+        use_processes=args.processes,
+        tag_index=tag_index,
+        journal=journal,
+        stats=stats,
+        profiler=profiler,
+        max_io_per_device=args.io_per_device,
+        io_order=args.io_order,
+    ):
+        statuses[result.status] += 1
+        if result.write_mode:
+            statuses[result.write_mode] += 1
+        print(
+            json.dumps(
+                {
+                    "path": result.filepath,
+                    "status": result.status,
+                    "error": result.error,
+                    "write_mode": result.write_mode,
+                }
+            )
+        )
+
+
+def write_journaled_jobs(job_passes, args, statuses=None, stats=None):
+    """Like write_jobs, recording the job in the journal given in the arguments."""
+    if not args.journal:
+        return write_jobs(job_passes, args, statuses=statuses, stats=stats)
+    with JobJournal(args.journal, sync=not args.no_sync) as journal:
+        return write_jobs(job_passes, args, journal, statuses, stats)
+
+
+def plan_jobs(job_passes, args):
+    """
+    Plan passes of (filepath, metadata_changes) pairs without writing the files,
+    printing a JSON prediction per file and the totals,
+    and saving the plan if a path is given in the arguments.
+    A file changed in several passes is planned against its current tags
+    in each of them. Returns the exit code.
+    """
+    totals = PlanTotals()
+    plan_file = open(args.plan, "w", encoding="utf-8") if args.plan else None
+    plan_writer = PlanWriter(plan_file) if plan_file else None
+    try:
+        for jobs in job_passes:
+            for file_plan in iter_plans(jobs, max_workers=args.workers):
+                totals.add(file_plan)
+                if plan_writer is not None:
+                    plan_writer.write(file_plan)
+                print(
+                    json.dumps(
+                        {
+                            "path": file_plan.filepath,
+                            "action": file_plan.action,
+                            "estimated_bytes": file_plan.estimated_bytes,
+                            "error": file_plan.error,
+                        }
+                    )
+                )
+    finally:
+        if plan_file is not None:
+            plan_file.close()
+    print(format_plan_totals(totals), file=sys.stderr)
+    return 1 if totals.files[FAILED] else 0
+
+
+def format_plan_totals(totals):
+    parts = []
+    for action, count in totals.files.items():
+        if action in (IN_PLACE, REWRITE):
+            parts.append(
+                "{}: {} ({})".format(
+                    action, count, format_size(totals.estimated_bytes[action])
+                )
+            )
+        else:
+            parts.append("{}: {}".format(action, count))
+    if not parts:
+        return "No files to tag"
+    summary = ", ".join(parts)
+    summary += "; estimated writes: {}".format(
+        format_size(totals.total_estimated_bytes)
+    )
+    if totals.rewritten_file_bytes:
+        summary += ", rewriting {} of files".format(
+            format_size(totals.rewritten_file_bytes)
+        )
+    return summary
+
+
+def run_jobs(job_passes, args, stats=None):
+    """Write the jobs, or only plan them with --dry-run or --plan."""
+    if args.dry_run or args.plan:
+        return plan_jobs(job_passes, args)
+    return write_journaled_jobs(job_passes, args, stats=stats)
+
+
+def tag_command(args):
+    deferred = {}
+    # created before the manifest is read, to time the cover encoding
+    stats = BatchStats() if args.stats else None
+    with open_manifest(args.manifest) as manifest:
+        jobs = read_manifest(
+            manifest,
+            get_manifest_format(args),
+            cover_options={
+                "size": (args.cover_size, args.cover_size),
+                "quality": args.cover_quality,
+                "progressive": args.progressive,
+            },
+            timer=NULL_TIMER if stats is None else stats,
+        )
+        # the deferred changes are only complete once the manifest was read
+        return run_jobs(
+            (group_changes_by_path(jobs, deferred), deferred.items()), args, stats
+        )
+
+
+def export_command(args):
+    failed = 0
+    manifest_format = get_manifest_format(args, args.output)
+
+    def iter_rows():
+        nonlocal failed
+        filepaths = iter_input_paths(args.paths)
+        for filepath, row in iter_export_rows(filepaths, max_workers=args.workers):
+            if isinstance(row, Exception):
+                failed += 1
+                print("Couldn't read {}: {}".format(filepath, row), file=sys.stderr)
+            else:
+                yield row
+
+    output = open_manifest(args.output, "w")
+    try:
+        write_export(iter_rows(), output, manifest_format)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
+
+
+def iter_input_paths(paths):
+    """Yield the given files, and the audio files under the given directories."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from (filepath for filepath, _ in iter_audio_files(path))
+        else:
+            yield path
+
+
+def autotag_command(args):
+    filepaths = list(iter_input_paths(args.paths))
+    if args.pattern:
+        plan = FilenamePattern(args.pattern).plan(
+            filepaths, number_tracks=args.number, first_track_number=args.first_track
+        )
+    else:
+        plan = plan_track_numbers(filepaths, first_track_number=args.first_track)
+    if args.preview:
+        print(format_plan_preview(plan, limit=len(plan.jobs)))
+        return 0
+    for filepath in plan.unmatched:
+        print("Doesn't match the pattern: {}".format(filepath), file=sys.stderr)
+    return run_jobs((plan.jobs,), args)
+
+
+def revert_command(args):
+    if not os.path.exists(args.journal):
+        print("No such journal: {}".format(args.journal), file=sys.stderr)
+        return 1
+    with JobJournal(args.journal) as journal:
+        # reverting isn't journaled itself, running it again is harmless
+        return write_jobs((journal.iter_revert_jobs(),), args)
+
+
+def run_plan_command(args):
+    statuses = Counter()
+
+    def on_stale(file_plan):
+        statuses["failed"] += 1
+        print(
+            json.dumps(
+                {
+                    "path": file_plan.filepath,
+                    "status": "failed",
+                    "error": "modified since it was planned",
+                    "write_mode": "",
+                }
+            )
+        )
+
+    deferred = {}
+    with open(args.plan, encoding="utf-8") as plan_file:
+        jobs = iter_plan_jobs(read_plan(plan_file), on_stale)
+        return write_journaled_jobs(
+            (group_changes_by_path(jobs, deferred), deferred.items()), args, statuses
+        )
+
+
+def index_command(args):
+    tag_index = TagIndex(
+        args.database, max_workers=args.workers, use_processes=args.processes
+    )
+    for root in args.roots:
+        print("{}: {}".format(root, tag_index.scan(root)), file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="mutagen-ez", description="Bulk audio file tagging, without a GUI."
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="log debugging messages"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tag_parser = subparsers.add_parser(
+        "tag", aliases=["import"], help="set tags on the files listed in a manifest"
+    )
+    tag_parser.add_argument("manifest", help="manifest path, or - for stdin")
+    tag_parser.add_argument(
+        "--cover-size",
+        type=int,
+        default=COVER_SIZE[0],
+        help="max width and height of embedded covers, in pixels",
+    )
+    tag_parser.add_argument(
+        "--cover-quality",
+        type=int,
+        default=COVER_QUALITY,
+        help="JPEG quality of covers",
+    )
+    tag_parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="encode covers as progressive instead of baseline JPEG",
+    )
+    tag_parser.set_defaults(handler=tag_command)
+
+    autotag_parser = subparsers.add_parser(
+        "autotag", help="set tags parsed from file names, or number tracks"
+    )
+    autotag_parser.add_argument(
+        "pattern",
+        help='file name pattern, e.g. "%%tracknumber%% - %%artist%% - %%title%%", '
+        'or "" to only number the tracks',
+    )
+    autotag_parser.add_argument(
+        "paths", nargs="+", help="files, or directories to tag the audio files of"
+    )
+    autotag_parser.add_argument(
+        "--number",
+        action="store_true",
+        help="number the tracks sequentially, in natural file name order",
+    )
+    autotag_parser.add_argument(
+        "--first-track", type=int, default=1, help="first track number"
+    )
+    autotag_parser.add_argument(
+        "--preview", action="store_true", help="print the changes without writing"
+    )
+    autotag_parser.set_defaults(handler=autotag_command)
+
+    export_parser = subparsers.add_parser(
+        "export", help="write the tags of audio files to a manifest"
+    )
+    export_parser.add_argument(
+        "paths", nargs="+", help="files, or directories to export the audio files of"
+    )
+    export_parser.add_argument(
+        "--output", default="-", help="manifest path, or - for stdout (default)"
+    )
+    export_parser.add_argument("--workers", type=int, help="number of parallel readers")
+    export_parser.set_defaults(handler=export_command)
+
+    for subparser in (tag_parser, export_parser):
+        subparser.add_argument(
+            "--format",
+            choices=("jsonl", "csv"),
+            help="manifest format (default: by extension)",
+        )
+
+    run_plan_parser = subparsers.add_parser(
+        "run-plan", help="write the files of a plan saved by a dry run, as planned"
+    )
+    run_plan_parser.add_argument("plan", help="plan path")
+    run_plan_parser.set_defaults(handler=run_plan_command)
+
+    revert_parser = subparsers.add_parser(
+        "revert", help="set back the tags a journaled job overwrote"
+    )
+    revert_parser.add_argument("journal", help="journal of the job to revert")
+    revert_parser.set_defaults(handler=revert_command)
+
+    index_parser = subparsers.add_parser(
+        "index", help="incrementally index the tags of audio files in directories"
+    )
+    index_parser.add_argument("roots", nargs="+", help="directories to scan")
+    index_parser.add_argument("--database", required=True, help="tag index path")
+    index_parser.set_defaults(handler=index_command)
+
+    for subparser in (tag_parser, autotag_parser):
+        subparser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="predict the writes (no-op, in place or rewrite) and bytes written, "
+            "without writing",
+        )
+        subparser.add_argument(
+            "--plan",
+            help="save the dry run's plan, to run it later (implies --dry-run)",
+        )
+    for subparser in (tag_parser, autotag_parser, run_plan_parser):
+        subparser.add_argument(
+            "--journal",
+            help="job journal, to resume the job after an interruption or revert it",
+        )
+        subparser.add_argument(
+            "--no-sync",
+            action="store_true",
+            help="don't sync the journal to disk before every write (faster, "
+            "but original tags may be lost in a system crash)",
+        )
+    for subparser in (tag_parser, autotag_parser, run_plan_parser, revert_parser):
+        subparser.add_argument("--database", help="tag index to update after writing")
+        subparser.add_argument(
+            "--stats",
+            help="write per-stage timing histograms and I/O totals to a JSON file",
+        )
+        subparser.add_argument(
+            "--profile", help="profile the batch with cProfile, into a pstats file"
+        )
+        subparser.add_argument(
+            "--io-per-device",
+            type=int,
+            default=DEFAULT_MAX_IO_PER_DEVICE,
+            help="max files written at once per device, adapted to its latency "
+            "(default: %(default)s, 0 writes files in any order, without limit)",
+        )
+        subparser.add_argument(
+            "--io-order",
+            choices=ORDERS,
+            default=INODE_ORDER,
+            help="order of the files of a directory (default: %(default)s, "
+            "path suits network mounts)",
+        )
+    for subparser in (
+        tag_parser,
+        autotag_parser,
+        run_plan_parser,
+        revert_parser,
+        index_parser,
+    ):
+        subparser.add_argument("--workers", type=int, help="number of parallel workers")
+        subparser.add_argument(
+            "--processes",
+            action="store_true",
+            help="use a process pool instead of threads",
+        )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(levelname)s %(name)s: %(message)s",
+    )
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
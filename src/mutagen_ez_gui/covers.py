@@ -0,0 +1,153 @@
+"""
+Album cover processing.
+Encoded covers are cached by source picture, so a cover applied to many files
+(or selected again) is only decoded and encoded once.
+Pillow is imported only when a cover is actually encoded,
+so tools which never touch covers don't pay for importing it.
+"""
+
+import hashlib
+import io
+import os
+import struct
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from instrumentation import NULL_TIMER
+
+COVER_SIZE = (400, 400)
+COVER_QUALITY = 75
+# upper bound of the size of a cover encoded with the default settings
+# (pure noise compresses to about 5 bits per pixel),
+# used to reserve room for a cover in the tags
+MAX_COVER_BYTES = COVER_SIZE[0] * COVER_SIZE[1] * 5 // 8
+
+# JPEG start-of-frame markers, holding the image dimensions
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def encode_cover(picture, size=COVER_SIZE, quality=COVER_QUALITY, progressive=False):
+    """
+    Load a picture (path or file object), scale it down to fit in the given size
+    and return it encoded as JPEG bytes, ready to be embedded in audio files.
+    JPEG sources are decoded at a reduced scale (Pillow's draft mode),
+    which is much faster and lighter than decoding e.g. a 6000x6000 scan fully.
+    """
+    from PIL import Image
+
+    byteIO = io.BytesIO()
+    thumb = Image.open(picture)
+    # picks the smallest DCT scale (1/2, 1/4 or 1/8) still at least the target size,
+    # no-op for other formats
+    thumb.draft("RGB", size)
+    thumb.thumbnail(size, Image.Resampling.LANCZOS)
+    # JPEG doesn't support transparency or palettes
+    if thumb.mode not in ("RGB", "L"):
+        thumb = thumb.convert("RGB")
+    thumb.save(byteIO, format="JPEG", quality=quality, progressive=progressive)
+    return byteIO.getvalue()
+
+
+@lru_cache(maxsize=64)
+def get_jpeg_info(data):
+    """
+    Read (width, height, colour depth in bits) from the header of JPEG data,
+    without decoding it. Returns None if the data isn't a readable JPEG.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        # fill bytes and markers without a length field
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            offset += 2
+            continue
+        (segment_length,) = struct.unpack_from(">H", data, offset + 2)
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 10 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            components = data[offset + 9]
+            return width, height, components * 8
+        offset += 2 + segment_length
+    return None
+
+
+@lru_cache(maxsize=64)
+def cover_digest(data):
+    """
+    Content hash of cover image data.
+    Memoized, so hashing the same cover bytes object
+    for every file of a batch only costs one pass over the data.
+    """
+    return hashlib.sha256(data).digest()
+
+
+def is_same_cover(current_data, new_data):
+    """Whether an embedded cover's data is identical to the cover being set."""
+    if current_data is None or len(current_data) != len(new_data):
+        return False
+    return cover_digest(bytes(current_data)) == cover_digest(new_data)
+
+
+class CoverCache:
+    """
+    LRU cache of encoded covers, keyed by
+    (source path, source mtime, target size, quality, progressive).
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cover(
+        self,
+        picture_path,
+        size=COVER_SIZE,
+        quality=COVER_QUALITY,
+        progressive=False,
+        timer=NULL_TIMER,
+    ):
+        """
+        Return the encoded cover for a picture, encoding it only on a cache miss.
+        The encoding is timed as the timer's cover_encode stage, e.g. a BatchStats.
+        """
+        picture_path = os.path.abspath(picture_path)
+        key = (
+            picture_path,
+            os.stat(picture_path).st_mtime_ns,
+            tuple(size),
+            quality,
+            progressive,
+        )
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        with timer.stage("cover_encode"):
+            byteimage = encode_cover(picture_path, size, quality, progressive)
+        with self._lock:
+            self._entries[key] = byteimage
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return byteimage
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# cache shared by the GUI and the CLI
+cover_cache = CoverCache()
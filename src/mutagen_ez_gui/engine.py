@@ -0,0 +1,384 @@
+"""
+Tag writing engine.
+Dispatches the per-file open/set/save work to a thread or process pool,
+so that a GUI (or any other caller) doesn't block while files are written.
+This module doesn't depend on Kivy, so it can be used headless:
+    - BatchWriter reports results and progress through plain callbacks,
+      which run in the pool's threads;
+    - iter_write_results streams (filepath, metadata_changes) pairs in
+      and yields results out, in constant memory.
+Both can record their work in a JobJournal (see journal.py),
+so that an interrupted batch resumes where it stopped and can be reverted,
+aggregate per-file stage timings in BatchStats, and profile the workers
+with a BatchProfiler (see instrumentation.py).
+With max_io_per_device, files are written in locality order, and only a few
+files of a device at once, adapted to its latency (see scheduler.py).
+"""
+
+import logging
+import os
+import threading
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    CancelledError,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from functools import partial
+
+from instrumentation import NULL_TIMER, FileTimer
+from metadata_setters import get_metadata_setter
+from scheduler import INODE_ORDER, IOScheduler, PathSerializer, iter_ordered_jobs
+
+DEFAULT_MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+logger = logging.getLogger(__name__)
+
+
+def get_executor_class(use_processes):
+    """
+    Pool class for the workers; multiprocessing is only imported
+    when a process pool is actually used.
+    """
+    if use_processes:
+        from concurrent.futures import ProcessPoolExecutor
+
+        return ProcessPoolExecutor
+    return ThreadPoolExecutor
+
+
+def make_executor(max_workers, use_processes, max_io_per_device=None):
+    """
+    Worker pool, wrapped by an IOScheduler limiting the files written at once
+    per device if max_io_per_device is given.
+    """
+    executor = get_executor_class(use_processes)(max_workers=max_workers)
+    if max_io_per_device:
+        return IOScheduler(executor, max_per_device=max_io_per_device)
+    return executor
+
+
+@dataclass
+class WriteResult:
+    """Outcome of writing metadata to a single file."""
+
+    SAVED = "saved"
+    # the file already had all the requested values, so it wasn't written
+    SKIPPED = "skipped"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    filepath: str
+    status: str
+    error: str = ""
+    # for saved files, whether the tags were written in place
+    # or the whole file was rewritten, see BaseMetadataSetter.save_tags_to_file
+    write_mode: str = ""
+    # instrumentation.FileTimings, when the write was instrumented
+    timings: object = None
+
+    @property
+    def ok(self):
+        return self.status in (self.SAVED, self.SKIPPED)
+
+
+def write_metadata(filepath, metadata_changes, before_save=None, instrument=False):
+    """
+    Open a file, set the given tags and save the file.
+    Files which already hold all the requested values aren't written.
+    before_save(metadata_setter) is called once the tags are set,
+    e.g. to journal the original values before the file is modified.
+    With instrument, the result carries the FileTimings of the write.
+    Errors are reported in the returned result instead of being raised,
+    so that one broken file doesn't stop a whole batch.
+    """
+    timer = FileTimer(filepath) if instrument else NULL_TIMER
+    try:
+        metadata_setter = get_metadata_setter(filepath, metadata_changes, timer)
+        metadata_setter.set_tags()
+        if before_save is not None and metadata_setter.changed_keys:
+            before_save(metadata_setter)
+        saved = metadata_setter.save_tags_to_file()
+    except Exception as exc:
+        logger.debug("Couldn't write %s", filepath, exc_info=True)
+        return WriteResult(
+            filepath, WriteResult.FAILED, str(exc), timings=timer.timings
+        )
+    if not saved:
+        return WriteResult(filepath, WriteResult.SKIPPED, timings=timer.timings)
+    if instrument:
+        timer.timings.write_mode = metadata_setter.write_mode
+    return WriteResult(
+        filepath,
+        WriteResult.SAVED,
+        write_mode=metadata_setter.write_mode,
+        timings=timer.timings,
+    )
+
+
+def update_tag_index(tag_index, filepath):
+    """
+    Index the tags of a saved file as they were written, e.g. track numbers
+    as the format stores them, rather than as they were requested.
+    """
+    try:
+        tag_index.update_file(filepath)
+    except Exception as exc:
+        logger.warning("Couldn't update tag index for %s: %s", filepath, exc)
+
+
+def check_thread_support(use_processes, journal=None, profiler=None):
+    if use_processes and journal is not None:
+        raise ValueError("Journaled batches can only be written by threads")
+    if use_processes and profiler is not None:
+        raise ValueError("Profiled batches can only be written by threads")
+
+
+def submit_write(
+    executor, filepath, metadata_changes, journal=None, stats=None, profiler=None
+):
+    """
+    Submit a file for writing, recording its plan in the journal if there's one.
+    Returns None for files an earlier run of the journaled job already wrote.
+    """
+    write = write_metadata if profiler is None else profiler.wrap(write_metadata)
+    before_save = job_id = None
+    if journal is not None:
+        job_id = journal.plan(filepath, metadata_changes)
+        if job_id is None:
+            return None
+        before_save = partial(journal.record_original, job_id)
+    future = executor.submit(
+        write, filepath, metadata_changes, before_save, stats is not None
+    )
+    future.job_id = job_id
+    return future
+
+
+def iter_write_results(
+    jobs,
+    max_workers=None,
+    use_processes=False,
+    max_pending=None,
+    tag_index=None,
+    journal=None,
+    stats=None,
+    profiler=None,
+    max_io_per_device=None,
+    io_order=INODE_ORDER,
+):
+    """
+    Write metadata for a (possibly lazy and unbounded) iterable of
+    (filepath, metadata_changes) pairs in a worker pool,
+    yielding a WriteResult for every file as soon as it is processed.
+    At most max_pending files are queued at once, so memory use stays constant
+    regardless of the number of files.
+    With a journal, files it marks as done are skipped without a result
+    (counted in journal.resumed), and every other file is journaled.
+    With stats (an instrumentation.BatchStats), every write is timed.
+    With max_io_per_device, the jobs are reordered by locality (io_order,
+    see scheduler.iter_ordered_jobs) and at most that many files
+    of a device are written at once.
+    """
+    check_thread_support(use_processes, journal, profiler)
+    max_workers = max_workers or DEFAULT_MAX_WORKERS
+    max_pending = max_pending or max_workers * 4
+    if max_io_per_device:
+        jobs = iter_ordered_jobs(jobs, io_order)
+    with make_executor(max_workers, use_processes, max_io_per_device) as executor:
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                pending.remove(future)
+                result = future.result()
+                if journal is not None:
+                    journal.record_result(future.job_id, result)
+                if stats is not None:
+                    stats.add(result)
+                if result.status == WriteResult.SAVED and tag_index is not None:
+                    update_tag_index(tag_index, result.filepath)
+                yield result
+
+        for filepath, metadata_changes in jobs:
+            future = submit_write(
+                executor, filepath, metadata_changes, journal, stats, profiler
+            )
+            if future is None:
+                continue
+            pending.add(future)
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+
+
+class BatchJob:
+    """
+    Handle to a batch submitted to a BatchWriter.
+    Keeps track of progress and allows cancelling the files not written yet.
+    """
+
+    def __init__(self, total, on_result=None, on_progress=None, on_complete=None):
+        self.total = total
+        self.done = 0
+        self.results = []
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.futures = []
+        self.cancel_event = threading.Event()
+        self.finished_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """Cancel all the files which haven't started being written yet."""
+        self.cancel_event.set()
+        for future in self.futures:
+            future.cancel()
+
+    def wait(self, timeout=None):
+        return self.finished_event.wait(timeout)
+
+    def count_statuses(self):
+        """Return a Counter of result status -> number of files, e.g. skipped files."""
+        with self._lock:
+            return Counter(result.status for result in self.results)
+
+    def count_write_modes(self):
+        """Return a Counter of write mode -> number of saved files."""
+        with self._lock:
+            return Counter(
+                result.write_mode for result in self.results if result.write_mode
+            )
+
+    def _record(self, result):
+        with self._lock:
+            self.done += 1
+            self.results.append(result)
+            done = self.done
+        if self.on_result:
+            self.on_result(result)
+        if self.on_progress:
+            self.on_progress(done, self.total)
+        if done == self.total:
+            self.finished_event.set()
+            if self.on_complete:
+                self.on_complete(self)
+
+
+class BatchWriter:
+    """
+    Writes metadata to many files in parallel.
+    Uses a thread pool by default, which suits the I/O bound work of saving tags;
+    a process pool can be used instead when parsing is the bottleneck.
+    With max_io_per_device, the files of a batch are written in locality order
+    (io_order), and only a few files of a device at once, see scheduler.py.
+    A file submitted again while an earlier batch still has it pending is only
+    written once that batch is done with it, in submission order.
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        use_processes=False,
+        tag_index=None,
+        max_io_per_device=None,
+        io_order=INODE_ORDER,
+    ):
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.use_processes = use_processes
+        # optional TagIndex, updated after every saved file
+        self.tag_index = tag_index
+        self.max_io_per_device = max_io_per_device
+        self.io_order = io_order
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = PathSerializer(
+                make_executor(
+                    self.max_workers, self.use_processes, self.max_io_per_device
+                )
+            )
+        return self._executor
+
+    def submit(
+        self,
+        jobs,
+        on_result=None,
+        on_progress=None,
+        on_complete=None,
+        journal=None,
+        stats=None,
+        profiler=None,
+    ):
+        """
+        Submit an iterable of (filepath, metadata_changes) pairs for writing.
+        Returns a BatchJob straight away; callbacks are invoked from worker threads:
+            - on_result(result) for every file,
+            - on_progress(done, total) after every file,
+            - on_complete(batch_job) once all files are processed.
+        With a journal, files an earlier run already wrote aren't submitted again.
+        With stats (an instrumentation.BatchStats), every write is timed.
+        """
+        check_thread_support(self.use_processes, journal, profiler)
+        if self.max_io_per_device:
+            # batches are bounded, they're sorted as a whole
+            jobs = iter_ordered_jobs(jobs, self.io_order, window=None)
+        futures = []
+        for filepath, metadata_changes in jobs:
+            future = submit_write(
+                self.executor, filepath, metadata_changes, journal, stats, profiler
+            )
+            if future is None:
+                continue
+            future.filepath = filepath
+            future.journal = journal
+            future.stats = stats
+            futures.append(future)
+        batch_job = BatchJob(len(futures), on_result, on_progress, on_complete)
+        batch_job.futures = futures
+        if not futures:
+            batch_job.finished_event.set()
+            if on_complete:
+                on_complete(batch_job)
+            return batch_job
+        for future in futures:
+            future.add_done_callback(
+                lambda future: self._on_future_done(batch_job, future)
+            )
+        return batch_job
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def _on_future_done(self, batch_job, future):
+        result = self._get_result(future)
+        if future.journal is not None:
+            future.journal.record_result(future.job_id, result)
+        if future.stats is not None:
+            future.stats.add(result)
+        if result.status == WriteResult.SAVED and self.tag_index is not None:
+            update_tag_index(self.tag_index, future.filepath)
+        batch_job._record(result)
+
+    @staticmethod
+    def _get_result(future):
+        try:
+            return future.result()
+        except CancelledError:
+            return WriteResult(future.filepath, WriteResult.CANCELLED)
+        except Exception as exc:
+            return WriteResult(future.filepath, WriteResult.FAILED, str(exc))
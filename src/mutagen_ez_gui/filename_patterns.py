@@ -0,0 +1,197 @@
+"""
+Tagging files from their paths, e.g. with the pattern
+"%tracknumber% - %artist% - %title%", "01 - Artist - Song.mp3" gets
+its track number, artist and title set.
+A pattern is compiled once into a regular expression, which is matched
+against all the paths in a single pass over their joined text.
+The per-file metadata changes can be previewed, then written with the batch writer.
+This module doesn't depend on Kivy.
+"""
+
+import os
+import re
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+from metadata_readers import INPUT_METADATA_KEY_TO_METADATA_KEY
+
+FIELD_PATTERN = re.compile(r"%(\w+)%")
+# pattern field names -> metadata setters' input keys,
+# both the displayed names (e.g. "tracknumber") and the input keys are accepted
+FIELD_TO_INPUT_METADATA_KEY = {
+    **{key: key for key in INPUT_METADATA_KEY_TO_METADATA_KEY},
+    **{value: key for key, value in INPUT_METADATA_KEY_TO_METADATA_KEY.items()},
+}
+# regular expression of each field's value, fields never span directories
+FIELD_REGEXES = {
+    "track_number": r"[0-9]+",
+    "recording_year": r"[0-9]{4}",
+}
+TEXT_FIELD_REGEX = r"[^/\n]+?"
+# matches a field which is skipped, e.g. "%tracknumber% - %ignore% - %title%"
+IGNORED_FIELD = "ignore"
+
+
+@dataclass
+class PatternPlan:
+    """Metadata changes parsed from a list of paths."""
+
+    # (filepath, metadata_changes) pairs, ready for the batch writer
+    jobs: list = field(default_factory=list)
+    # paths which don't match the pattern
+    unmatched: list = field(default_factory=list)
+
+
+def natural_sort_key(filepath):
+    """Sort key ordering e.g. "2 - a.mp3" before "10 - b.mp3"."""
+    return [
+        int(part) if part.isdigit() else part.lower()
+        for part in re.split(r"([0-9]+)", filepath)
+    ]
+
+
+def normalize_track_number(value):
+    # "01" and "1" are the same track
+    return str(int(value))
+
+
+class FilenamePattern:
+    """
+    A compiled filename pattern.
+    Fields are written as %name%, with name one of the displayed metadata keys
+    (artist, album, title, date, tracknumber), a metadata setter input key
+    (e.g. track_number), or "ignore" to skip a part of the name.
+    The pattern is matched against the end of the path, without the extension,
+    so it can include parent directories, e.g. "%artist%/%album%/%title%".
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.input_metadata_keys = []
+        regex_parts = []
+        position = 0
+        for match in FIELD_PATTERN.finditer(pattern):
+            literal_end = match.start()
+            regex_parts.append(self.escape_literal(pattern[position:literal_end]))
+            regex_parts.append(self.compile_field(match.group(1)))
+            position = match.end()
+        regex_parts.append(self.escape_literal(pattern[position:]))
+        if not self.input_metadata_keys:
+            raise ValueError("Pattern has no fields: {}".format(pattern))
+        # anchored to whole path components at the end of each line
+        self.regex = re.compile(
+            r"(?:^|(?<=/)){}$".format("".join(regex_parts)), re.MULTILINE
+        )
+
+    @staticmethod
+    def escape_literal(text):
+        return re.escape(text.replace(os.sep, "/"))
+
+    def compile_field(self, name):
+        if name == IGNORED_FIELD:
+            return TEXT_FIELD_REGEX
+        input_metadata_key = FIELD_TO_INPUT_METADATA_KEY.get(name)
+        if input_metadata_key is None:
+            raise ValueError(
+                "Unknown pattern field %{}%. Supported fields: {}".format(
+                    name, ", ".join(sorted(FIELD_TO_INPUT_METADATA_KEY))
+                )
+            )
+        if input_metadata_key in self.input_metadata_keys:
+            raise ValueError("Pattern field %{}% used twice".format(name))
+        self.input_metadata_keys.append(input_metadata_key)
+        return "(?P<{}>{})".format(
+            input_metadata_key, FIELD_REGEXES.get(input_metadata_key, TEXT_FIELD_REGEX)
+        )
+
+    def parse(self, filepaths):
+        """
+        Parse the values of the pattern's fields out of the paths.
+        Returns a list with, for every path, a dict of input metadata key -> value,
+        or None when the path doesn't match.
+        """
+        filepaths = list(filepaths)
+        lines = [
+            os.path.splitext(filepath)[0].replace(os.sep, "/").replace("\n", " ")
+            for filepath in filepaths
+        ]
+        line_starts = []
+        position = 0
+        for line in lines:
+            line_starts.append(position)
+            position += len(line) + 1
+        # a single regex pass over all the paths
+        values = [None] * len(filepaths)
+        for match in self.regex.finditer("\n".join(lines)):
+            line_index = bisect_right(line_starts, match.start()) - 1
+            values[line_index] = {
+                key: value.strip() for key, value in match.groupdict().items()
+            }
+        return values
+
+    def plan(self, filepaths, number_tracks=False, first_track_number=1):
+        """
+        Build the per-file metadata changes for the paths.
+        With number_tracks, the paths are sorted naturally and their
+        track numbers are set sequentially from first_track_number,
+        instead of being parsed.
+        """
+        filepaths = list(filepaths)
+        if number_tracks:
+            filepaths.sort(key=natural_sort_key)
+        plan = PatternPlan()
+        for filepath, metadata_changes in zip(filepaths, self.parse(filepaths)):
+            if metadata_changes is None:
+                plan.unmatched.append(filepath)
+            else:
+                plan.jobs.append((filepath, metadata_changes))
+        if number_tracks:
+            number_tracks_in_order(plan.jobs, first_track_number)
+        else:
+            for filepath, metadata_changes in plan.jobs:
+                if "track_number" in metadata_changes:
+                    metadata_changes["track_number"] = normalize_track_number(
+                        metadata_changes["track_number"]
+                    )
+        return plan
+
+
+def number_tracks_in_order(jobs, first_track_number=1):
+    """Set sequential track numbers in the metadata changes of the jobs."""
+    for track_number, (filepath, metadata_changes) in enumerate(
+        jobs, start=first_track_number
+    ):
+        metadata_changes["track_number"] = str(track_number)
+
+
+def plan_track_numbers(filepaths, first_track_number=1):
+    """Number the tracks of the paths sequentially, in natural sort order."""
+    plan = PatternPlan(
+        jobs=[(filepath, {}) for filepath in sorted(filepaths, key=natural_sort_key)]
+    )
+    number_tracks_in_order(plan.jobs, first_track_number)
+    return plan
+
+
+def format_plan_preview(plan, limit=100):
+    """Human readable preview of the first changes of a plan."""
+    lines = []
+    for filepath, metadata_changes in plan.jobs[:limit]:
+        lines.append(
+            "{}: {}".format(
+                os.path.basename(filepath),
+                ", ".join(
+                    "{}={}".format(key, value)
+                    for key, value in metadata_changes.items()
+                ),
+            )
+        )
+    if len(plan.jobs) > limit:
+        lines.append("... and {} more files".format(len(plan.jobs) - limit))
+    if plan.unmatched:
+        lines.append(
+            "{} files don't match the pattern, e.g. {}".format(
+                len(plan.unmatched), os.path.basename(plan.unmatched[0])
+            )
+        )
+    return "\n".join(lines)
@@ -0,0 +1,132 @@
+"""
+Fast format resolution for tagging.
+mutagen.File probes a file against every registered format before opening it,
+so the file's extension is tried first, and content sniffing is only used
+when the file doesn't match the format its extension suggests.
+Formats are named "module:class" and only imported when first used,
+so e.g. tagging MP3 files never imports mutagen's MP4 or Ogg modules.
+"""
+
+import importlib
+import os
+import sys
+import threading
+from functools import lru_cache
+
+import mutagen
+from instrumentation import NULL_TIMER
+from mutagen import MutagenError
+
+ID3_FORMAT = "mutagen.id3:ID3"
+MP3_FORMAT = "mutagen.mp3:MP3"
+FLAC_FORMAT = "mutagen.flac:FLAC"
+OGG_VORBIS_FORMAT = "mutagen.oggvorbis:OggVorbis"
+OGG_OPUS_FORMAT = "mutagen.oggopus:OggOpus"
+MP4_FORMAT = "mutagen.mp4:MP4"
+WAVE_FORMAT = "mutagen.wave:WAVE"
+
+# MP3 files are opened as bare ID3 tags - tagging doesn't need the stream info,
+# which would cost a search for the first MPEG frame
+EXTENSION_TO_FORMAT = {
+    ".mp3": ID3_FORMAT,
+    ".flac": FLAC_FORMAT,
+    ".ogg": OGG_VORBIS_FORMAT,
+    ".oga": OGG_VORBIS_FORMAT,
+    ".opus": OGG_OPUS_FORMAT,
+    ".m4a": MP4_FORMAT,
+    ".mp4": MP4_FORMAT,
+    ".wav": WAVE_FORMAT,
+}
+
+# formats sniffed when a file doesn't match its extension
+SNIFFED_FORMATS = (
+    MP3_FORMAT,
+    FLAC_FORMAT,
+    OGG_VORBIS_FORMAT,
+    OGG_OPUS_FORMAT,
+    MP4_FORMAT,
+    WAVE_FORMAT,
+)
+
+# leading bytes of the non-MP3 containers, used to tell an untagged MP3
+# from a file with a misleading extension
+CONTAINER_MAGIC_NUMBERS = (b"fLaC", b"OggS", b"RIFF")
+
+
+# mutagen's modules import each other, and importing them from several
+# worker threads at once can expose partially initialized modules
+_import_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def load_class(qualified_name):
+    """
+    Return the class named "module:class", e.g. a format,
+    importing its module on first use.
+    """
+    module_name, class_name = qualified_name.split(":")
+    with _import_lock:
+        return getattr(importlib.import_module(module_name), class_name)
+
+
+def is_instance(obj, format_name):
+    """
+    isinstance check against a "module:class" name which doesn't import the module:
+    an object can't be an instance of a class whose module was never imported.
+    """
+    module_name, class_name = format_name.split(":")
+    # the module may be being imported by another thread, without the class yet
+    format_class = getattr(sys.modules.get(module_name), class_name, None)
+    return format_class is not None and isinstance(obj, format_class)
+
+
+def is_other_container(filepath):
+    with open(filepath, "rb") as fileobj:
+        header = fileobj.read(12)
+    return header.startswith(CONTAINER_MAGIC_NUMBERS) or header[4:8] == b"ftyp"
+
+
+def open_for_tagging(filepath, timer=NULL_TIMER):
+    """
+    Open a file with the mutagen format matching its extension,
+    falling back to mutagen's content sniffing on a mismatch.
+    Returns a mutagen FileType, or an ID3 instance for MP3 files.
+    Raises MutagenError if the file can't be opened as any supported format.
+    The timer (see instrumentation.FileTimer) records the parsing time
+    under "parse", and the time spent finding the format under "detect".
+    """
+    with timer.stage("detect"):
+        format_name = EXTENSION_TO_FORMAT.get(os.path.splitext(filepath)[1].lower())
+    sniffed_formats = None
+    if format_name == ID3_FORMAT:
+        ID3 = load_class(ID3_FORMAT)
+        ID3NoHeaderError = load_class("mutagen.id3:ID3NoHeaderError")
+        try:
+            with timer.stage("parse"), timer.open(filepath) as filething:
+                return ID3(filething)
+        except ID3NoHeaderError:
+            with timer.stage("detect"):
+                other_container = is_other_container(filepath)
+            if not other_container:
+                return ID3()
+        except MutagenError:
+            pass
+        sniffed_formats = [option for option in SNIFFED_FORMATS if option != MP3_FORMAT]
+    elif format_name is not None:
+        format_class = load_class(format_name)
+        try:
+            with timer.stage("parse"), timer.open(filepath) as filething:
+                return format_class(filething)
+        except MutagenError:
+            pass
+        # the extension would make mutagen favour the format which just failed
+        sniffed_formats = [
+            option for option in SNIFFED_FORMATS if option != format_name
+        ]
+    with timer.stage("detect"), timer.open(filepath) as filething:
+        if sniffed_formats is not None:
+            sniffed_formats = [load_class(option) for option in sniffed_formats]
+        filething = mutagen.File(filething, options=sniffed_formats)
+    if filething is None:
+        raise MutagenError("Unsupported file type: {}".format(filepath))
+    return filething
@@ -0,0 +1,261 @@
+"""
+Timing instrumentation of tag writes.
+A FileTimer records, for one file, the time spent in each stage of a write:
+    - detect: resolving the file's format, including content sniffing;
+    - parse: reading the tags;
+    - mutate: setting the text tags;
+    - cover_embed: embedding the cover into the tags;
+    - save: writing the file;
+along with the bytes read and written and whether the tags were saved in place.
+BatchStats aggregates the timings of a batch into histograms,
+which can be exported as JSON. It also times the stages run once per batch
+rather than per file: cover_encode, scaling and encoding a cover picture.
+When instrumentation is off, NULL_TIMER stands in for the timer,
+so the disabled path is a couple of no-op calls.
+BatchProfiler runs cProfile in every worker thread of a single batch.
+"""
+
+import json
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+
+STAGES = ("detect", "parse", "mutate", "cover_encode", "cover_embed", "save")
+
+
+@dataclass
+class FileTimings:
+    """Per-stage timings of writing a single file, in seconds."""
+
+    filepath: str
+    stages: dict = field(default_factory=dict)
+    bytes_read: int = 0
+    bytes_written: int = 0
+    write_mode: str = ""
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+
+class CountingFile:
+    """File object wrapper counting the bytes read and written through it."""
+
+    def __init__(self, fileobj, timings):
+        self._fileobj = fileobj
+        self._timings = timings
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._fileobj.close()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._timings.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        written = self._fileobj.write(data)
+        self._timings.bytes_written += written
+        return written
+
+
+class Stage:
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.stages[self.name] = self.stages.get(self.name, 0) + elapsed
+
+
+class FileTimer:
+    """Records the FileTimings of a file, see STAGES for the stage names."""
+
+    def __init__(self, filepath):
+        self.timings = FileTimings(filepath)
+
+    def stage(self, name):
+        """Context manager adding the time spent in it to a stage."""
+        return Stage(self.timings.stages, name)
+
+    def open(self, filepath, mode="rb"):
+        """
+        Open a file for mutagen, counting the bytes read and written.
+        Returns a context manager giving the file object.
+        """
+        return CountingFile(open(filepath, mode), self.timings)
+
+
+class NullTimer:
+    """Timer which doesn't record anything, mutagen opens the file by path."""
+
+    timings = None
+    _null_stage = nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def open(self, filepath, mode="rb"):
+        return nullcontext(filepath)
+
+
+NULL_TIMER = NullTimer()
+
+
+class Histogram:
+    """
+    Histogram of durations, in power of two buckets of microseconds,
+    so that it takes constant memory however many files are recorded.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        # bucket upper bound (microseconds) -> number of durations
+        self.buckets = Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        microseconds = max(seconds * 1e6, 1)
+        self.buckets[2 ** math.ceil(math.log2(microseconds))] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0,
+            "min_s": self.min if self.count else 0,
+            "max_s": self.max,
+            "buckets_us": {
+                "<={}".format(bound): self.buckets[bound]
+                for bound in sorted(self.buckets)
+            },
+        }
+
+
+class BatchStats:
+    """Aggregated timings of a batch, fed with WriteResults from any thread."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.statuses = Counter()
+        self.write_modes = Counter()
+        # stage name (or "total") -> Histogram
+        self.stages = defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        timings = result.timings
+        with self._lock:
+            self.statuses[result.status] += 1
+            if timings is None:
+                return
+            self.files += 1
+            self.bytes_read += timings.bytes_read
+            self.bytes_written += timings.bytes_written
+            if timings.write_mode:
+                self.write_modes[timings.write_mode] += 1
+            for name, seconds in timings.stages.items():
+                self.stages[name].add(seconds)
+            self.stages["total"].add(timings.total)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the time spent in it to a stage's histogram,
+        for the stages not part of a file's write, see covers.CoverCache.get_cover.
+        """
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stages[name].add(elapsed)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "files": self.files,
+                "statuses": dict(self.statuses),
+                "write_modes": dict(self.write_modes),
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "stages": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(
+                        self.stages.items(), key=lambda item: get_stage_order(item[0])
+                    )
+                },
+            }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2)
+
+
+def get_stage_order(name):
+    return STAGES.index(name) if name in STAGES else len(STAGES)
+
+
+class BatchProfiler:
+    """
+    cProfile hook for a single batch.
+    cProfile only follows the thread it was enabled in, so wrap() profiles
+    each call in a profiler of the worker thread running it,
+    and dump() merges the profiles of all the threads.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get_profile(self):
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            import cProfile
+
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self.profiles.append(profile)
+        return profile
+
+    def wrap(self, function):
+        def profiled_function(*args, **kwargs):
+            return self.get_profile().runcall(function, *args, **kwargs)
+
+        return profiled_function
+
+    def get_stats(self):
+        with self._lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        import pstats
+
+        return pstats.Stats(*profiles)
+
+    def dump(self, path):
+        """Write the merged profile, to be read with pstats or e.g. snakeviz."""
+        stats = self.get_stats()
+        if stats is not None:
+            stats.dump_stats(path)
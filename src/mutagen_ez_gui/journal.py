@@ -0,0 +1,287 @@
+"""
+Write-ahead journal of batch tagging jobs.
+An append-only JSON lines file recording, for every file of a job:
+    - the planned changes, when the file is queued;
+    - the original values of the tags about to change, written (and synced
+      to disk) by the worker after reading the file and before saving it;
+    - a completion marker once the file was saved, skipped or failed.
+Running a job again with the same journal only writes the files which
+aren't marked as done, so a job interrupted by a crash resumes where it
+stopped, and a finished job can be reverted to the original values.
+Covers are stored once per distinct image, and referenced by content hash.
+The GUI keeps a journal per batch in a JournalDirectory, to offer resuming
+or reverting the batches interrupted when it's started again.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+
+from covers import cover_digest
+
+PLANNED = "planned"
+ORIGINAL = "original"
+DONE = "done"
+FAILED = "failed"
+COVER = "cover"
+
+# suffixes of the journals of a JournalDirectory
+RUNNING_SUFFIX = ".journal"
+FINISHED_SUFFIX = ".finished"
+# number of finished journals kept, to revert the last batches with `cli.py revert`
+DEFAULT_KEPT_JOURNALS = 20
+
+
+def get_job_id(filepath, encoded_changes):
+    """Identify a file's planned changes, so that changed plans aren't resumed."""
+    key = json.dumps([os.path.abspath(filepath), encoded_changes], sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class JobJournal:
+    """
+    Append-only journal of a batch job, safe to use from the writer's threads.
+    The existing records are read when the journal is opened,
+    keeping the ids of the completed files, the first original values recorded
+    for every file, and the offsets of the covers - not their data.
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        # fsync the original values before the file is saved,
+        # so that a crash can't lose the values to revert to
+        self.sync = sync
+        self.done_ids = set()
+        # abspath -> (filepath, {input metadata key: encoded original value})
+        self.original_values = {}
+        # cover digest -> offset of its record in the journal
+        self.cover_offsets = {}
+        # number of files skipped because an earlier run completed them
+        self.resumed = 0
+        self._lock = threading.Lock()
+        # covers being reverted are usually shared by the files of an album
+        self._read_cover = lru_cache(maxsize=16)(self._read_cover)
+        complete = True
+        if os.path.exists(path):
+            complete = self._load()
+        self._file = open(path, "ab")
+        if not complete:
+            # don't append to a record cut short by a crash
+            self._file.write(b"\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _load(self):
+        """Read the existing records, returning whether the last one is complete."""
+        line = b""
+        with open(self.path, "rb") as journal_file:
+            offset = 0
+            for line in journal_file:
+                line_offset, offset = offset, offset + len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a record cut short by a crash
+                    continue
+                event = record["event"]
+                if event == COVER:
+                    self.cover_offsets[record["digest"]] = line_offset
+                elif event == ORIGINAL:
+                    key = os.path.abspath(record["path"])
+                    _, values = self.original_values.setdefault(
+                        key, (record["path"], {})
+                    )
+                    # the first recorded values predate every write of this journal
+                    for input_metadata_key, value in record["values"].items():
+                        values.setdefault(input_metadata_key, value)
+                elif event == DONE:
+                    self.done_ids.add(record["id"])
+        return not line or line.endswith(b"\n")
+
+    def _append(self, record, sync=False):
+        """Append a record, returning its offset. Callers hold the lock."""
+        offset = self._file.tell()
+        self._file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        return offset
+
+    def _encode_changes(self, metadata_changes):
+        """Replace cover data with its digest, journaling each cover once."""
+        encoded_changes = {}
+        for input_metadata_key, value in metadata_changes.items():
+            if input_metadata_key == "cover" and value is not None:
+                digest = cover_digest(bytes(value)).hex()
+                if digest not in self.cover_offsets:
+                    self.cover_offsets[digest] = self._append(
+                        {
+                            "event": COVER,
+                            "digest": digest,
+                            "data": base64.b64encode(value).decode("ascii"),
+                        }
+                    )
+                value = {COVER: digest}
+            encoded_changes[input_metadata_key] = value
+        return encoded_changes
+
+    def _read_cover(self, digest):
+        with open(self.path, "rb") as journal_file:
+            journal_file.seek(self.cover_offsets[digest])
+            return base64.b64decode(json.loads(journal_file.readline())["data"])
+
+    def _decode_changes(self, encoded_changes):
+        metadata_changes = {}
+        for input_metadata_key, value in encoded_changes.items():
+            # other dicts are the exact values of tags, see get_original_value
+            if input_metadata_key == "cover" and isinstance(value, dict):
+                value = self._read_cover(value[COVER])
+            metadata_changes[input_metadata_key] = value
+        return metadata_changes
+
+    def plan(self, filepath, metadata_changes):
+        """
+        Record a file's planned changes before it is written.
+        Returns the job id to pass to the other record methods,
+        or None if an earlier run already completed the same changes.
+        """
+        with self._lock:
+            encoded_changes = self._encode_changes(metadata_changes)
+            job_id = get_job_id(filepath, encoded_changes)
+            if job_id in self.done_ids:
+                self.resumed += 1
+                return None
+            self._append(
+                {
+                    "event": PLANNED,
+                    "id": job_id,
+                    "path": filepath,
+                    "changes": encoded_changes,
+                }
+            )
+        return job_id
+
+    def record_original(self, job_id, metadata_setter):
+        """
+        Record the values the setter is about to overwrite,
+        called by write_metadata before the file is saved.
+        """
+        if not metadata_setter.original_values:
+            return
+        filepath = metadata_setter.filepath
+        with self._lock:
+            encoded_values = self._encode_changes(metadata_setter.original_values)
+            self._append(
+                {
+                    "event": ORIGINAL,
+                    "id": job_id,
+                    "path": filepath,
+                    "values": encoded_values,
+                },
+                sync=self.sync,
+            )
+            _, values = self.original_values.setdefault(
+                os.path.abspath(filepath), (filepath, {})
+            )
+            for input_metadata_key, value in encoded_values.items():
+                values.setdefault(input_metadata_key, value)
+
+    def record_result(self, job_id, result):
+        """Mark a file as completed, or record why it failed."""
+        if result.ok:
+            record = {"event": DONE, "status": result.status}
+        else:
+            record = {"event": FAILED, "status": result.status, "error": result.error}
+        record.update(id=job_id, path=result.filepath)
+        with self._lock:
+            self._append(record)
+            if result.ok:
+                self.done_ids.add(job_id)
+
+    def iter_revert_jobs(self):
+        """
+        Yield (filepath, metadata_changes) pairs setting back the original
+        values of every file the journal recorded as about to be written.
+        Tags which didn't exist before are removed.
+        """
+        for filepath, encoded_values in self.original_values.values():
+            yield filepath, self._decode_changes(encoded_values)
+
+    def get_pending_jobs(self):
+        """
+        Return the list of (filepath, metadata_changes) pairs planned
+        and not completed, to resume an interrupted job without its input.
+        The records are read before returning, as resuming appends new ones.
+        """
+        pending = {}
+        with open(self.path, "rb") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record["event"] == PLANNED and record["id"] not in self.done_ids:
+                    pending.setdefault(record["id"], record)
+        return [
+            (record["path"], self._decode_changes(record["changes"]))
+            for record in pending.values()
+        ]
+
+
+class JournalDirectory:
+    """
+    Directory of the journals of the batches of a long-lived writer, the GUI.
+    Every batch gets a new journal, renamed once the batch is finished;
+    the journals left running were interrupted, e.g. by a crash.
+    The last finished journals are kept, the older ones are removed.
+    """
+
+    def __init__(self, directory, keep=DEFAULT_KEPT_JOURNALS, sync=True):
+        self.directory = directory
+        self.keep = keep
+        self.sync = sync
+
+    def open(self):
+        """Open the journal of a new batch."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, "{}{}".format(time.time_ns(), RUNNING_SUFFIX)
+        )
+        return JobJournal(path, sync=self.sync)
+
+    def finish(self, journal):
+        """Close the journal of a finished batch, and remove the oldest ones."""
+        journal.close()
+        os.replace(journal.path, journal.path + FINISHED_SUFFIX)
+        finished = self._list(RUNNING_SUFFIX + FINISHED_SUFFIX)
+        while len(finished) > self.keep:
+            os.remove(finished.pop(0))
+
+    def discard(self, journal):
+        journal.close()
+        os.remove(journal.path)
+
+    def get_interrupted(self):
+        """Return the paths of the journals of the batches which didn't finish."""
+        return self._list(RUNNING_SUFFIX)
+
+    def _list(self, suffix):
+        """Return the paths of the journals with a suffix, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        # named after their creation time, in nanoseconds
+        names = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(suffix)
+        )
+        return [os.path.join(self.directory, name) for name in names]
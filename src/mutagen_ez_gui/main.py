@@ -1,89 +1,166 @@
-import io
-
-import mutagen
-from kivy.app import App
-from kivy.core.window import Window
-from kivy.lang import Builder
-from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.button import Button
-from kivy.uix.filechooser import FileChooserIconView
-from kivy.uix.gridlayout import GridLayout
-from kivy.uix.label import Label
-from kivy.uix.popup import Popup
-from kivy.uix.textinput import TextInput
-from metadata_setters import ID3MetadataSetter, MP4MetadataSetter, VorbisMetadataSetter
-from mutagen.id3 import ID3, ID3NoHeaderError
-from mutagen.mp3 import MP3, HeaderNotFoundError
-from mutagen.mp4 import MP4
-from mutagen.wave import WAVE, _WaveID3
-from PIL import Image
-from styles import file_chooser_file_icon_entry_styles
-
-# Load custom styles
-Builder.load_string(file_chooser_file_icon_entry_styles)
+import time
+
+# taken before the imports, so that the startup time includes them
+PROCESS_START = time.perf_counter()
+
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+from functools import partial  # noqa: E402
+
+from browser import AudioFileBrowser, FileChooserWatchMixin  # noqa: E402
+from covers import COVER_QUALITY, COVER_SIZE, cover_cache  # noqa: E402
+from engine import BatchWriter  # noqa: E402
+from filename_patterns import (  # noqa: E402
+    FilenamePattern,
+    PatternPlan,
+    format_plan_preview,
+    plan_track_numbers,
+)
+from journal import JobJournal, JournalDirectory  # noqa: E402
+from kivy.app import App  # noqa: E402
+from kivy.clock import Clock  # noqa: E402
+from kivy.core.window import Window  # noqa: E402
+from kivy.lang import Builder  # noqa: E402
+from kivy.uix.boxlayout import BoxLayout  # noqa: E402
+from kivy.uix.button import Button  # noqa: E402
+from kivy.uix.filechooser import FileChooserIconView  # noqa: E402
+from kivy.uix.gridlayout import GridLayout  # noqa: E402
+from kivy.uix.label import Label  # noqa: E402
+from kivy.uix.popup import Popup  # noqa: E402
+from kivy.uix.progressbar import ProgressBar  # noqa: E402
+from kivy.uix.textinput import TextInput  # noqa: E402
+from kivy.uix.togglebutton import ToggleButton  # noqa: E402
+from metadata_readers import METADATA_KEYS, read_metadata  # noqa: E402
+from metadata_summary import MetadataSummarizer  # noqa: E402
+from scheduler import DEFAULT_MAX_IO_PER_DEVICE  # noqa: E402
+from selection import SelectionModel  # noqa: E402
+from styles import (  # noqa: E402
+    audio_file_browser_styles,
+    file_chooser_file_icon_entry_styles,
+)
+from tag_cache import TagCache  # noqa: E402
+from tag_index import TagIndex  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# set to print the startup timings as JSON and quit once the first frame is drawn
+STARTUP_TIME_ENV_VAR = "MUTAGEN_EZ_STARTUP_TIME"
+_styles_loaded = False
+
+
+def load_styles():
+    """Load the custom kv styles, once, before the first widgets are built."""
+    global _styles_loaded
+    if not _styles_loaded:
+        Builder.load_string(file_chooser_file_icon_entry_styles)
+        Builder.load_string(audio_file_browser_styles)
+        _styles_loaded = True
+
+
+def run_on_main_thread(callback):
+    """
+    Wrap a callback so that, when called from a worker thread,
+    it is scheduled to run on the Kivy main thread instead.
+    """
+
+    def scheduled_callback(*args):
+        Clock.schedule_once(lambda dt: callback(*args))
+
+    return scheduled_callback
 
 
 class BaseMutagenMetadataInputGroup:
     metadata_key = ""
-    selection = []
     cover_selection = []
     is_cover = False
 
     def __init__(self, metadata_key, **kwargs):
         self.metadata_display_panel = kwargs.pop("metadata_display_panel", None)
+        # shared by all the groups, so that the writes of a file run in submission
+        # order whichever group submitted them, see engine.BatchWriter
+        self.batch_writer = kwargs.pop("batch_writer")
+        self.batch_progress_panel = kwargs.pop("batch_progress_panel", None)
+        # optional JournalDirectory, to journal every batch
+        self.journal_directory = kwargs.pop("journal_directory", None)
+        # files to write to, shared with the file explorer
+        self.selection_model = kwargs.pop("selection_model", None)
+        if self.selection_model is None:
+            self.selection_model = SelectionModel()
         super().__init__(**kwargs)
 
     def set_metadata(self, custom_selection=None):
         """
-        Try to open the selected files with mutagen,
-        guess their type and set the tag using the appropriate metadata setter.
+        Write the tags to the selected files in the background,
+        using the batch writer's worker pool to open the files with mutagen,
+        guess their type and set the tags with the appropriate metadata setter.
+        Every file is opened and saved once, no matter how many tags are set.
+        Progress and results are posted back to the main thread.
         """
-        print("custom? ", custom_selection)
-        print("original? ", self.selection)
-        for filepath in custom_selection or self.selection:
-            print("setting for ", filepath)
-            try:
-                filething = mutagen.File(filepath)
-                if isinstance(filething, WAVE):
-                    if filething.tags is None:
-                        filething.add_tags()
-                    metadata_setter = ID3MetadataSetter(
-                        filething, filepath, self.metadata_key
-                    )
-                elif isinstance(filething, MP4):
-                    metadata_setter = MP4MetadataSetter(
-                        filething, filepath, self.metadata_key
-                    )
-                elif isinstance(
-                    filething.tags,
-                    (
-                        mutagen.oggvorbis.OggVCommentDict,
-                        mutagen.oggopus.OggOpusVComment,
-                        mutagen.flac.VCFLACDict,
-                    ),
-                ):
-                    metadata_setter = VorbisMetadataSetter(
-                        filething, filepath, self.metadata_key
-                    )
-                elif isinstance(filething, MP3) or filething.tags is None:
-                    try:
-                        filething = ID3(filepath)
-                    except ID3NoHeaderError:
-                        filething = ID3()
-                    metadata_setter = ID3MetadataSetter(
-                        filething, filepath, self.metadata_key
-                    )
-            except Exception as exc:
-                print("Couldn't open file {}, exception: {}".format(filepath, exc))
-                continue
-            tag_value = self.get_value_to_save_in_tag()
-            if self.metadata_key == "cover":
-                metadata_setter.set_cover(tag_value)
-            else:
-                metadata_setter.set_tag(tag_value)
-            metadata_setter.save_tags_to_file()
-        if self.metadata_display_panel and len(self.selection) == 1:
-            self.metadata_display_panel.set_metadata_labels(self.selection[0])
+        jobs = self.get_jobs(list(custom_selection or self.selection_model))
+        if not jobs:
+            return
+        journal = self.journal_directory.open() if self.journal_directory else None
+        self.submit_jobs(jobs, journal=journal)
+
+    def submit_jobs(self, jobs, journal=None, on_finished=None):
+        """
+        Write (filepath, metadata_changes) pairs in the background,
+        recording them in the journal if given, which is finished with the batch;
+        on_finished(batch_job) is then called on the main thread.
+        """
+
+        def on_complete(batch_job):
+            if journal is not None:
+                self.journal_directory.finish(journal)
+            if on_finished is not None:
+                on_finished(batch_job)
+            self.on_write_complete(batch_job)
+
+        batch_job = self.batch_writer.submit(
+            jobs,
+            on_result=run_on_main_thread(self.on_write_result),
+            on_complete=run_on_main_thread(on_complete),
+            journal=journal,
+        )
+        if self.batch_progress_panel:
+            self.batch_progress_panel.track(batch_job)
+
+    def on_write_result(self, result):
+        if self.metadata_display_panel:
+            self.metadata_display_panel.invalidate_metadata(result.filepath)
+        if not result.ok:
+            logger.warning(
+                "Couldn't set metadata for file %s: %s %s",
+                result.filepath,
+                result.status,
+                result.error,
+            )
+
+    def on_write_complete(self, batch_job):
+        if self.batch_progress_panel:
+            self.batch_progress_panel.show_summary(batch_job)
+        if not self.metadata_display_panel:
+            return
+        filepath = self.selection_model.single_path
+        if filepath:
+            self.metadata_display_panel.set_metadata_labels(filepath)
+        elif self.selection_model:
+            self.metadata_display_panel.set_summary_labels(self.selection_model)
+
+    def get_jobs(self, selection):
+        """
+        Return the list of (filepath, metadata_changes) pairs to write,
+        by default the same changes for every selected file.
+        """
+        metadata_changes = self.get_metadata_changes()
+        if not metadata_changes:
+            return []
+        return [(filepath, metadata_changes) for filepath in selection]
+
+    def get_metadata_changes(self):
+        """Return a dict of metadata key -> value to save in the selected files."""
+        return {self.metadata_key: self.get_value_to_save_in_tag()}
 
     def get_value_to_save_in_tag(self):
         raise NotImplementedError(
@@ -122,35 +199,191 @@ class MutagenMetadataInputGroup(BaseMutagenMetadataInputGroup, BoxLayout):
         return self.metadata_input.text
 
 
-class FileExplorer(FileChooserIconView):
-    """File explorer widget, linked to metadata display"""
+class FilenamePatternInputGroup(BaseMutagenMetadataInputGroup, BoxLayout):
+    """
+    Widget for tagging the selected files from their names,
+    with a pattern such as "%tracknumber% - %artist% - %title%",
+    so that every file gets its own values.
+    Can also number the tracks sequentially, in the files' natural order.
+    The changes can be previewed before they're written.
+    """
 
-    def __init__(self, input_groups, metadata_display, file_selection_label, **kwargs):
+    metadata_key = "pattern"
+
+    def __init__(self, **kwargs):
+        super().__init__(self.metadata_key, **kwargs)
+        self.orientation = "horizontal"
+        self.pattern_input = TextInput(
+            hint_text="%tracknumber% - %artist% - %title%", multiline=False
+        )
+        self.number_tracks_button = ToggleButton(
+            text="Number", size_hint_x=None, width=70
+        )
+        self.preview_button = Button(text="Preview", size_hint_x=None, width=70)
+        self.preview_button.on_press = self.show_preview
+        self.apply_button = Button(
+            halign="center",
+            text="Tag from names",
+            text_size=(120, None),
+            size_hint_x=None,
+            width=120,
+        )
+        self.apply_button.on_press = self.set_metadata
+        self.add_widget(self.pattern_input)
+        self.add_widget(self.number_tracks_button)
+        self.add_widget(self.preview_button)
+        self.add_widget(self.apply_button)
+
+    def get_plan(self, selection):
+        """Parse the selected paths. Raises ValueError if the pattern is invalid."""
+        number_tracks = self.number_tracks_button.state == "down"
+        pattern = self.pattern_input.text.strip()
+        if not pattern:
+            if number_tracks:
+                return plan_track_numbers(selection)
+            return PatternPlan()
+        return FilenamePattern(pattern).plan(selection, number_tracks=number_tracks)
+
+    def get_jobs(self, selection):
+        try:
+            return self.get_plan(selection).jobs
+        except ValueError as exc:
+            logger.warning("Invalid filename pattern: %s", exc)
+            return []
+
+    def show_preview(self):
+        try:
+            preview = format_plan_preview(self.get_plan(list(self.selection_model)))
+        except ValueError as exc:
+            preview = "Invalid filename pattern: {}".format(exc)
+        Popup(
+            title="Filename pattern preview",
+            content=TextInput(text=preview or "Nothing to tag", readonly=True),
+            size_hint=(0.8, 0.8),
+        ).open()
+
+
+class ApplyAllMetadataButton(BaseMutagenMetadataInputGroup, Button):
+    """
+    Button which sets the values of all non-empty input groups at once,
+    opening and saving each selected file only once.
+    """
+
+    metadata_key = "all"
+
+    def __init__(self, input_groups, **kwargs):
+        super().__init__(self.metadata_key, **kwargs)
+        self.input_groups = input_groups
+        self.on_press = self.set_metadata
+
+    def get_metadata_changes(self):
+        return {
+            input_group.metadata_key: input_group.get_value_to_save_in_tag()
+            for input_group in self.input_groups
+            if input_group.get_value_to_save_in_tag()
+        }
+
+
+class FileSelectionMixin:
+    """
+    Links the selection model of a file explorer widget
+    to the input groups, the selected files label and the metadata display.
+    The input groups share the selection model, so a click only costs
+    an incremental update of the model and of the label's summary;
+    the metadata display refresh is debounced over quick successive clicks.
+    """
+
+    # delay before refreshing the metadata display after a selection change
+    metadata_display_delay = 0.15
+
+    def __init__(
+        self,
+        input_groups,
+        metadata_display,
+        file_selection_label,
+        selection_model=None,
+        **kwargs,
+    ):
+        self.selection_model = selection_model
+        if self.selection_model is None:
+            self.selection_model = SelectionModel()
         super().__init__(**kwargs)
         self.input_groups = input_groups
         self.metadata_display = metadata_display
         self.file_selection_label = file_selection_label
-        self.multiselect = True
+        self.refresh_metadata_display_trigger = Clock.create_trigger(
+            self.refresh_metadata_display, self.metadata_display_delay
+        )
+        self.selection_model.bind(self.on_selection_model_change)
+        self.on_selection_model_change(self.selection_model)
 
     def on_selection(self, instance, value):
         """
-        callback which runs on selecting/deselecting a file in the explorer
+        callback which runs on selecting/deselecting a file in Kivy's file chooser
         """
-        filenames = [path.split("/")[-1] for path in value]
-        self.file_selection_label.text = f"Selected: {', '.join(filenames)}"
-        for input_group in self.input_groups:
-            input_group.selection = value
-        # Display metadata info only when one file is selected
-        if len(value) == 1:
-            self.metadata_display.set_metadata_labels(value[0])
+        self.selection_model.replace(value)
+
+    def on_selection_model_change(self, selection_model):
+        self.file_selection_label.text = "Selected: " + selection_model.summary()
+        self.refresh_metadata_display_trigger()
+
+    def refresh_metadata_display(self, *args):
+        # Display the metadata of a single selected file,
+        # or a summary of the metadata of several files
+        filepath = self.selection_model.single_path
+        if filepath:
+            self.metadata_display.set_metadata_labels(filepath)
+        elif self.selection_model:
+            self.metadata_display.set_summary_labels(self.selection_model)
         else:
             self.metadata_display.clear_metadata_labels()
 
+    def on_directory_changes(self, changes, prepared):
+        """
+        Drop the cached tags of the files changed by other programs,
+        and refresh the metadata display if some of them are selected.
+        """
+        for path in changes.modified + changes.removed:
+            self.metadata_display.invalidate_metadata(path)
+        if any(path in self.selection_model for path in changes.modified):
+            self.refresh_metadata_display_trigger()
+        super().on_directory_changes(changes, prepared)
+
+    def unlink_selection_model(self):
+        """Stop following the selection model, e.g. when the explorer is replaced."""
+        self.selection_model.unbind(self.on_selection_model_change)
+        self.refresh_metadata_display_trigger.cancel()
+
+
+class FileExplorer(FileSelectionMixin, FileChooserWatchMixin, FileChooserIconView):
+    """File explorer widget, linked to metadata display"""
+
+    def __init__(self, input_groups, metadata_display, file_selection_label, **kwargs):
+        super().__init__(input_groups, metadata_display, file_selection_label, **kwargs)
+        self.multiselect = True
+        self.start_watching()
+
+
+class AudioFileExplorer(FileSelectionMixin, AudioFileBrowser):
+    """
+    Virtualized file explorer, linked to metadata display.
+    Lists only directories and audio files, and only builds widgets
+    for the visible rows, so it stays fast on directories with many files.
+    """
+
+    pass
 
-class ArtCoverExplorer(FileChooserIconView, BaseMutagenMetadataInputGroup):
+
+class ArtCoverExplorer(
+    FileChooserWatchMixin, FileChooserIconView, BaseMutagenMetadataInputGroup
+):
     """Art cover explorer widget, used to select a picture to set as an album cover"""
 
     metadata_key = "cover"
+    # encoding settings of the embedded covers
+    cover_size = COVER_SIZE
+    cover_quality = COVER_QUALITY
+    cover_progressive = False
 
     def __init__(self, music_file_explorer, **kwargs):
         super().__init__(**kwargs)
@@ -160,19 +393,14 @@ class ArtCoverExplorer(FileChooserIconView, BaseMutagenMetadataInputGroup):
     def get_value_to_save_in_tag(self):
         return self.raw_cover_data
 
-    def convert_to_jpeg(self, image):
-        pass
-
     def get_raw_cover_data(self, picture):
-        # picture = picture[0]
-        byteIO = io.BytesIO()
-        print("picture path: ", picture)
-        thumb = Image.open(picture)
-        thumb.thumbnail((400, 400), Image.Resampling.LANCZOS)
-        thumb.save(byteIO, format="JPEG")
-        byteimage = byteIO.getvalue()
-
-        return byteimage
+        logger.debug("Cover picture path: %s", picture)
+        return cover_cache.get_cover(
+            picture,
+            size=self.cover_size,
+            quality=self.cover_quality,
+            progressive=self.cover_progressive,
+        )
 
     def on_selection(self, instance, value):
         """
@@ -180,15 +408,14 @@ class ArtCoverExplorer(FileChooserIconView, BaseMutagenMetadataInputGroup):
         """
         try:
             self.raw_cover_data = self.get_raw_cover_data(value[0])
-            print(
-                "selection: ",
-                self.music_file_explorer.selection,
-                "setting pic: ",
-                self.raw_cover_data[:10],
-            )
-            self.set_metadata(custom_selection=self.music_file_explorer.selection)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Setting cover on %s",
+                    self.music_file_explorer.selection_model.summary(),
+                )
+            self.set_metadata(custom_selection=self.music_file_explorer.selection_model)
         except IndexError:
-            print(f"cannot parse selection: {value} - aborting cover setting")
+            logger.warning("Cannot parse selection: %s - aborting cover setting", value)
 
 
 class BorderedBox:
@@ -228,11 +455,100 @@ class FileSelectionLabel(BorderedBox, Label):
     pass
 
 
+class BatchProgressPanel(BorderedBox, BoxLayout):
+    """
+    Shows the progress of the tag writing running in the background,
+    with a button to cancel the files which haven't been written yet.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = "horizontal"
+        self.padding = (5, 5)
+        self.batch_job = None
+        self.progress_bar = ProgressBar(max=1, value=0)
+        self.progress_label = Label(
+            text="Idle",
+            size_hint_x=None,
+            width=200,
+            text_size=(200, None),
+            halign="center",
+        )
+        self.cancel_button = Button(
+            text="Cancel", size_hint_x=None, width=80, disabled=True
+        )
+        self.cancel_button.on_press = self.cancel
+        self.add_widget(self.progress_bar)
+        self.add_widget(self.progress_label)
+        self.add_widget(self.cancel_button)
+
+    def track(self, batch_job):
+        """
+        Show the progress of a batch from now on; the updates still coming
+        from the batches tracked before are ignored.
+        """
+        self.batch_job = batch_job
+        # set once the batch is submitted, the files written until then
+        # are counted in batch_job.done
+        batch_job.on_progress = run_on_main_thread(
+            partial(self.set_progress, batch_job)
+        )
+        self.set_progress(batch_job, batch_job.done, batch_job.total)
+
+    def set_progress(self, batch_job, done, total):
+        if batch_job is not self.batch_job:
+            return
+        self.progress_bar.max = max(total, 1)
+        self.progress_bar.value = done
+        self.progress_label.text = "{}/{}".format(done, total)
+        running = (
+            self.batch_job is not None and self.batch_job.done < self.batch_job.total
+        )
+        self.cancel_button.disabled = not running
+
+    def show_summary(self, batch_job):
+        """
+        Show how many files were saved, skipped as unchanged, failed etc.,
+        and how many had to be rewritten whole to fit their new tags.
+        """
+        if batch_job is not self.batch_job:
+            return
+        summary = ", ".join(
+            "{} {}".format(count, status)
+            for status, count in sorted(batch_job.count_statuses().items())
+        )
+        rewritten = batch_job.count_write_modes()["rewrite"]
+        if rewritten:
+            summary += " ({} rewritten)".format(rewritten)
+        self.progress_label.text = summary
+
+    def cancel(self):
+        if self.batch_job:
+            self.batch_job.cancel()
+            self.progress_label.text = "Cancelling"
+
+
 class MetadataDisplayPanel(GridLayout):
-    metadata_keys = ("artist", "album", "title", "date", "tracknumber")
+    """
+    Panel displaying the metadata of the selected file.
+    Reads go through a tag cache, so revisiting an unchanged file
+    doesn't parse it again.
+    When several files are selected, shows for each tag the value they share,
+    or how many distinct values they have. The summary is computed in
+    a worker pool and filled in as files are read.
+    """
+
+    metadata_keys = METADATA_KEYS
     metadata_widgets = dict()
 
     def __init__(self, **kwargs):
+        self.tag_cache = kwargs.pop("tag_cache", None)
+        if self.tag_cache is None:
+            self.tag_cache = TagCache()
+        self.summarizer = kwargs.pop("summarizer", None)
+        if self.summarizer is None:
+            self.summarizer = MetadataSummarizer(loader=self.tag_cache.get)
+        self.summary_job = None
         super().__init__(**kwargs)
         self.rows = 5
         self.cols = 1
@@ -244,51 +560,14 @@ class MetadataDisplayPanel(GridLayout):
             self.add_widget(display_widget)
 
     def get_metadata(self, filepath):
-        try:
-            filething = mutagen.File(filepath, easy=True)
-            # edge case:
-            # _WaveID3 doesn't seem to implement the mutagen easy tag functionality
-            if isinstance(filething.tags, _WaveID3):
-                artist = ", ".join(
-                    getattr(filething.get("TPE1", None), "text", ["Unknown"])
-                )
-                album = ", ".join(
-                    getattr(filething.get("TALB", None), "text", ["Unknown"])
-                )
-                title = ", ".join(
-                    getattr(filething.get("TIT2", None), "text", ["Unknown"])
-                )
-                date_stringified = [
-                    str(timestamp)
-                    for timestamp in getattr(
-                        filething.get("TDRC", None), "text", ["Unknown"]
-                    )
-                ]
-                date = ", ".join(date_stringified)
-                tracknumber = ", ".join(
-                    getattr(filething.get("TRCK", None), "text", ["Unknown"])
-                )
-            else:
-                artist = filething.get("artist", "Unknown")
-                album = filething.get("album", "Unknown")
-                title = filething.get("title", "Unknown")
-                date = filething.get("date", "Unknown")
-                tracknumber = filething.get("tracknumber", "Unknown")
-        except (HeaderNotFoundError, AttributeError):
-            artist = "Unknown"
-            album = "Unknown"
-            title = "Unknown"
-            date = "Unknown"
-            tracknumber = "Unknown"
-        return {
-            "artist": artist,
-            "album": album,
-            "title": title,
-            "date": date,
-            "tracknumber": tracknumber,
-        }
+        return self.tag_cache.get(filepath)
+
+    def invalidate_metadata(self, filepath):
+        """Drop cached metadata of a file, e.g. after its tags were written."""
+        self.tag_cache.invalidate(filepath)
 
     def set_metadata_labels(self, filepath):
+        self.cancel_summary()
         tags = self.get_metadata(filepath)
         for key in self.metadata_keys:
             value = tags[key]
@@ -297,30 +576,80 @@ class MetadataDisplayPanel(GridLayout):
             self.metadata_widgets[key].value_label.text = value
 
     def clear_metadata_labels(self):
+        self.cancel_summary()
         for key in self.metadata_keys:
             self.metadata_widgets[key].value_label.text = ""
 
+    def set_summary_labels(self, filepaths):
+        """
+        Summarize the metadata of several files in the background,
+        replacing any summary still being computed.
+        """
+        self.clear_metadata_labels()
+        self.summary_job = self.summarizer.submit(
+            filepaths,
+            on_update=run_on_main_thread(self.on_summary_update),
+            on_complete=run_on_main_thread(self.on_summary_update),
+        )
+
+    def on_summary_update(self, summary_job, display_values):
+        # results of a summary replaced since they were posted
+        if summary_job is not self.summary_job or summary_job.cancelled:
+            return
+        progress = ""
+        if summary_job.done < summary_job.total:
+            progress = " ({}/{})".format(summary_job.done, summary_job.total)
+        for key in self.metadata_keys:
+            self.metadata_widgets[key].value_label.text = display_values[key] + progress
+
+    def cancel_summary(self):
+        if self.summary_job is not None:
+            self.summary_job.cancel()
+            self.summary_job = None
+
 
 class AlbumCoverSetterWindow(Popup):
     title = "Test popup"
-    close_button = Button(text="Close", size_hint_y=None, height=50)
     anchor_x = "center"
     anchor_y = "center"
     auto_dismiss = False
 
-    def __init__(self, music_file_explorer, *args, **kwargs):
+    def __init__(
+        self,
+        music_file_explorer,
+        *args,
+        batch_writer,
+        metadata_display_panel=None,
+        batch_progress_panel=None,
+        journal_directory=None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
+        self.close_button = Button(text="Close", size_hint_y=None, height=50)
         self.close_button.on_release = self.dismiss
         root = BoxLayout()
         root.orientation = "vertical"
         root.size = self.size
-        chooser = ArtCoverExplorer(
-            metadata_key="cover", music_file_explorer=music_file_explorer
+        self.chooser = ArtCoverExplorer(
+            metadata_key="cover",
+            music_file_explorer=music_file_explorer,
+            selection_model=music_file_explorer.selection_model,
+            metadata_display_panel=metadata_display_panel,
+            batch_writer=batch_writer,
+            batch_progress_panel=batch_progress_panel,
+            journal_directory=journal_directory,
         )
-        root.add_widget(chooser)
+        root.add_widget(self.chooser)
         root.add_widget(self.close_button)
         self.add_widget(root)
 
+    def on_open(self):
+        # the pictures directory is only watched while the popup is shown
+        self.chooser.start_watching()
+
+    def on_dismiss(self):
+        self.chooser.stop_watching()
+
 
 class MutaEZGUIMain(BoxLayout):
     """
@@ -334,48 +663,93 @@ class MutaEZGUIMain(BoxLayout):
     """
 
     def __init__(self, **kwargs):
+        # "icons" or "list", see build_file_explorer
+        self.browser_mode = kwargs.pop("browser_mode", "icons")
+        # optional persistent index of the files' tags
+        self.tag_index = kwargs.pop("tag_index", None)
+        # BatchWriter running the tag writes of every input group in a worker pool
+        self.batch_writer = kwargs.pop("batch_writer")
+        # optional JournalDirectory, journaling every batch written
+        self.journal_directory = kwargs.pop("journal_directory", None)
+        # files selected in the file explorer, shared with the input groups
+        self.selection_model = SelectionModel()
+        load_styles()
         super().__init__(**kwargs)
         self.orientation = "horizontal"
         # panel for setting and displaying metadata
         self.metadata_panel = GridLayout(
             cols=1,
-            rows=8,
+            rows=11,
         )
         # input groups
-        self.metadata_display_panel = MetadataDisplayPanel(size_hint_y=None, height=240)
+        self.metadata_display_panel = MetadataDisplayPanel(
+            tag_cache=TagCache(
+                loader=self.tag_index.read_metadata if self.tag_index else read_metadata
+            ),
+            size_hint_y=None,
+            height=240,
+        )
+        self.batch_progress_panel = BatchProgressPanel(size_hint_y=None, height=40)
         self.artist_input_group = MutagenMetadataInputGroup(
             "artist",
             metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
             size_hint_y=None,
             height=50,
         )
         self.album_input_group = MutagenMetadataInputGroup(
             "album",
             metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
             size_hint_y=None,
             height=50,
         )
         self.title_input_group = MutagenMetadataInputGroup(
             "title",
             metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
             size_hint_y=None,
             height=50,
         )
         self.track_number_input_group = MutagenMetadataInputGroup(
             "track_number",
             metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
             size_hint_y=None,
             height=50,
         )
         self.recording_year_input_group = MutagenMetadataInputGroup(
             "recording_year",
             metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
             size_hint_y=None,
             height=50,
         )
-        self.file_selection_label = FileSelectionLabel()
-
-        self.chooser = FileExplorer(
+        self.filename_pattern_input_group = FilenamePatternInputGroup(
+            metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
+            size_hint_y=None,
+            height=50,
+        )
+        self.apply_all_button = ApplyAllMetadataButton(
             input_groups=[
                 self.artist_input_group,
                 self.album_input_group,
@@ -383,41 +757,230 @@ class MutaEZGUIMain(BoxLayout):
                 self.track_number_input_group,
                 self.recording_year_input_group,
             ],
-            metadata_display=self.metadata_display_panel,
-            file_selection_label=self.file_selection_label,
-        )
-        self.album_cover_setter_popup = AlbumCoverSetterWindow(
-            music_file_explorer=self.chooser
+            metadata_display_panel=self.metadata_display_panel,
+            batch_writer=self.batch_writer,
+            batch_progress_panel=self.batch_progress_panel,
+            journal_directory=self.journal_directory,
+            selection_model=self.selection_model,
+            text="Apply all",
+            size_hint_y=None,
+            height=50,
         )
+        self.file_selection_label = FileSelectionLabel()
+
+        self.chooser = self.build_file_explorer(self.browser_mode)
+        # built on first use, its file chooser lists a whole directory
+        self.album_cover_setter_popup = None
         self.album_cover_setter_button = Button(
             text="Set Cover", height=50, size_hint_y=None
         )
-        self.album_cover_setter_button.bind(on_press=self.album_cover_setter_popup.open)
-        self.album_cover_setter_popup.close_button.bind(
-            on_press=self.album_cover_setter_popup.dismiss
-        )
+        self.album_cover_setter_button.bind(on_press=self.open_album_cover_setter)
 
         self.metadata_panel.add_widget(self.artist_input_group)
         self.metadata_panel.add_widget(self.album_input_group)
         self.metadata_panel.add_widget(self.title_input_group)
         self.metadata_panel.add_widget(self.track_number_input_group)
         self.metadata_panel.add_widget(self.recording_year_input_group)
+        self.metadata_panel.add_widget(self.filename_pattern_input_group)
+        self.metadata_panel.add_widget(self.apply_all_button)
         self.metadata_panel.add_widget(self.album_cover_setter_button)
+        self.metadata_panel.add_widget(self.batch_progress_panel)
         self.metadata_panel.add_widget(self.file_selection_label)
         self.metadata_panel.add_widget(self.metadata_display_panel)
 
+        # file explorer, with a toggle between the icon view and the fast list view
+        self.browser_panel = BoxLayout(orientation="vertical")
+        self.browser_mode_button = ToggleButton(
+            text="Audio files list view",
+            state="down" if self.browser_mode == "list" else "normal",
+            size_hint_y=None,
+            height=36,
+        )
+        self.browser_mode_button.bind(state=self.on_browser_mode_button_state)
+        self.browser_panel.add_widget(self.browser_mode_button)
+        self.browser_panel.add_widget(self.chooser)
+
         self.add_widget(self.metadata_panel)
-        self.add_widget(self.chooser)
+        self.add_widget(self.browser_panel)
+
+    def open_album_cover_setter(self, *args):
+        if self.album_cover_setter_popup is None:
+            self.album_cover_setter_popup = AlbumCoverSetterWindow(
+                music_file_explorer=self.chooser,
+                metadata_display_panel=self.metadata_display_panel,
+                batch_writer=self.batch_writer,
+                batch_progress_panel=self.batch_progress_panel,
+            )
+        self.album_cover_setter_popup.open()
+
+    def offer_interrupted_batches(self):
+        """
+        Offer to resume or revert the journaled batches which didn't finish,
+        e.g. because the app crashed, or to discard their journals.
+        """
+        if not self.journal_directory:
+            return
+        journals = []
+        pending_count = 0
+        for path in self.journal_directory.get_interrupted():
+            journal = JobJournal(path, sync=self.journal_directory.sync)
+            pending_jobs = journal.get_pending_jobs()
+            if not pending_jobs:
+                # every file was written, the app stopped before finishing it
+                self.journal_directory.finish(journal)
+                continue
+            journals.append((journal, pending_jobs))
+            pending_count += len(pending_jobs)
+        if not journals:
+            return
+        content = BoxLayout(orientation="vertical")
+        content.add_widget(
+            Label(
+                text="{} interrupted batch(es), {} file(s) left to write.".format(
+                    len(journals), pending_count
+                )
+            )
+        )
+        buttons = BoxLayout(size_hint_y=None, height=50)
+        content.add_widget(buttons)
+        popup = Popup(
+            title="Interrupted batches",
+            content=content,
+            size_hint=(0.6, 0.4),
+            auto_dismiss=False,
+        )
+        actions = (
+            ("Resume", self.resume_batches),
+            ("Revert", self.revert_batches),
+            ("Discard", self.discard_batches),
+        )
+        for text, action in actions:
+            button = Button(text=text)
+            button.bind(
+                on_press=partial(self.on_batches_action, popup, action, journals)
+            )
+            buttons.add_widget(button)
+        popup.open()
+
+    def on_batches_action(self, popup, action, journals, *args):
+        popup.dismiss()
+        action(journals)
+
+    def resume_batches(self, journals):
+        """Write the files the interrupted batches left, in the same journals."""
+        for journal, pending_jobs in journals:
+            self.apply_all_button.submit_jobs(pending_jobs, journal=journal)
+
+    def revert_batches(self, journals):
+        """
+        Set back the tags the interrupted batches overwrote, then remove
+        their journals unless a file failed; reverting isn't journaled itself.
+        """
+        for journal, _ in journals:
+            self.apply_all_button.submit_jobs(
+                list(journal.iter_revert_jobs()),
+                on_finished=partial(self.on_batch_reverted, journal),
+            )
+
+    def on_batch_reverted(self, journal, batch_job):
+        if all(result.ok for result in batch_job.results):
+            self.journal_directory.discard(journal)
+
+    def discard_batches(self, journals):
+        for journal, _ in journals:
+            self.journal_directory.discard(journal)
+
+    def build_file_explorer(self, browser_mode, path=None):
+        """
+        Build the file explorer for the given mode:
+            - "icons": Kivy's icon view file chooser, listing all files;
+            - "list": virtualized list of the audio files, for large directories.
+        """
+        explorer_class = AudioFileExplorer if browser_mode == "list" else FileExplorer
+        explorer_kwargs = {"path": path} if path else {}
+        return explorer_class(
+            input_groups=[
+                self.artist_input_group,
+                self.album_input_group,
+                self.title_input_group,
+                self.track_number_input_group,
+                self.recording_year_input_group,
+                self.apply_all_button,
+            ],
+            metadata_display=self.metadata_display_panel,
+            file_selection_label=self.file_selection_label,
+            selection_model=self.selection_model,
+            **explorer_kwargs,
+        )
+
+    def on_browser_mode_button_state(self, instance, state):
+        self.set_browser_mode("list" if state == "down" else "icons")
+
+    def set_browser_mode(self, browser_mode):
+        if browser_mode == self.browser_mode:
+            return
+        self.browser_mode = browser_mode
+        previous_chooser = self.chooser
+        previous_chooser.unlink_selection_model()
+        previous_chooser.stop_watching()
+        self.chooser = self.build_file_explorer(
+            browser_mode, path=previous_chooser.path
+        )
+        self.selection_model.clear()
+        self.browser_panel.remove_widget(previous_chooser)
+        self.browser_panel.add_widget(self.chooser)
+        if self.album_cover_setter_popup is not None:
+            self.album_cover_setter_popup.chooser.music_file_explorer = self.chooser
 
 
 class MutaGUIApp(App):
-    """Mutagen GUI Kivy app object."""
+    """
+    Mutagen GUI Kivy app object.
+    With the MUTAGEN_EZ_STARTUP_TIME environment variable set, the app prints
+    its startup timings (imports, build, first frame) as JSON and quits
+    once the first frame is drawn, to track the time to first frame.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.measure_startup = bool(os.environ.get(STARTUP_TIME_ENV_VAR))
+        self.startup_timings = {"imports": time.perf_counter() - PROCESS_START}
 
     def build(self):
+        build_start = time.perf_counter()
         Window.size = (1000, 580)
-        MutaGUI = MutaEZGUIMain()
+        self.tag_index = TagIndex(os.path.join(self.user_data_dir, "tag_index.sqlite3"))
+        # files are written in locality order, a few per device at once
+        self.batch_writer = BatchWriter(
+            tag_index=self.tag_index, max_io_per_device=DEFAULT_MAX_IO_PER_DEVICE
+        )
+        MutaGUI = MutaEZGUIMain(
+            tag_index=self.tag_index,
+            batch_writer=self.batch_writer,
+            journal_directory=JournalDirectory(
+                os.path.join(self.user_data_dir, "journals")
+            ),
+        )
+        self.startup_timings["build"] = time.perf_counter() - build_start
+        if self.measure_startup:
+            Window.bind(on_draw=self.on_first_frame)
         return MutaGUI
 
+    def on_start(self):
+        if not self.measure_startup:
+            self.root.offer_interrupted_batches()
+
+    def on_stop(self):
+        # the files being written are finished, the journals of the batches
+        # cut short are offered for resuming on the next start
+        self.batch_writer.shutdown(wait=False)
+
+    def on_first_frame(self, *args):
+        Window.unbind(on_draw=self.on_first_frame)
+        self.startup_timings["first_frame"] = time.perf_counter() - PROCESS_START
+        print(json.dumps(self.startup_timings))
+        self.stop()
+
 
 if __name__ == "__main__":
     MutaGUIApp().run()
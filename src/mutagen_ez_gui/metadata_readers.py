@@ -0,0 +1,100 @@
+"""
+Reading of the metadata tags shown in the GUI's metadata display panel.
+Tags are read with the tag-only reader when possible,
+and with mutagen otherwise.
+"""
+
+import mutagen
+from formats import load_class
+from tag_reader import UnsupportedTags, read_tags
+
+METADATA_KEYS = ("artist", "album", "title", "date", "tracknumber")
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".ogg", ".oga", ".opus", ".m4a", ".mp4", ".wav")
+
+# metadata setters' input keys -> displayed metadata keys
+INPUT_METADATA_KEY_TO_METADATA_KEY = {
+    "artist": "artist",
+    "album": "album",
+    "title": "title",
+    "track_number": "tracknumber",
+    "recording_year": "date",
+}
+
+
+def is_audio_file(filepath):
+    return filepath.lower().endswith(AUDIO_EXTENSIONS)
+
+
+def read_metadata(filepath):
+    """
+    Read the displayed metadata tags of a file.
+    Returns a dict of metadata key -> value (a string, or a list of strings),
+    with "Unknown" for the tags which can't be read.
+    """
+    return read_file_info(filepath)[1]
+
+
+def read_file_info(filepath):
+    """
+    Read the format name (mutagen's file type, e.g. "MP3")
+    and the displayed metadata tags of a file.
+    """
+    try:
+        return read_tags(filepath)
+    except (UnsupportedTags, OSError):
+        # formats and tag features only mutagen handles
+        pass
+    return read_file_info_with_mutagen(filepath)
+
+
+def get_frame_values(filething, frame_id):
+    """Values of an ID3 frame as strings, or "Unknown" if it isn't set."""
+    frame = filething.get(frame_id)
+    if frame is None:
+        return "Unknown"
+    return [str(text) for text in frame.text]
+
+
+def read_file_info_with_mutagen(filepath):
+    """
+    Same as read_file_info, opening the file with mutagen,
+    which also parses its audio stream info.
+    """
+    # mutagen.File imports all the format modules anyway
+    HeaderNotFoundError = load_class("mutagen.mp3:HeaderNotFoundError")
+    _WaveID3 = load_class("mutagen.wave:_WaveID3")
+
+    filething = None
+    try:
+        filething = mutagen.File(filepath, easy=True)
+        # edge case:
+        # _WaveID3 doesn't seem to implement the mutagen easy tag functionality
+        if isinstance(filething.tags, _WaveID3):
+            artist = get_frame_values(filething, "TPE1")
+            album = get_frame_values(filething, "TALB")
+            title = get_frame_values(filething, "TIT2")
+            date = get_frame_values(filething, "TDRC")
+            tracknumber = get_frame_values(filething, "TRCK")
+        else:
+            artist = filething.get("artist", "Unknown")
+            album = filething.get("album", "Unknown")
+            title = filething.get("title", "Unknown")
+            date = filething.get("date", "Unknown")
+            tracknumber = filething.get("tracknumber", "Unknown")
+    except (HeaderNotFoundError, AttributeError):
+        artist = "Unknown"
+        album = "Unknown"
+        title = "Unknown"
+        date = "Unknown"
+        tracknumber = "Unknown"
+    tags = {
+        "artist": artist,
+        "album": album,
+        "title": title,
+        "date": date,
+        "tracknumber": tracknumber,
+    }
+    format_name = None
+    if filething is not None:
+        format_name = type(filething).__name__.removeprefix("Easy")
+    return format_name, tags
@@ -1,11 +1,34 @@
 import base64
+import logging
 
-from mutagen.flac import Picture
-from mutagen.id3 import APIC, TALB, TDRC, TIT2, TOPE, TPE1, TPE2, TRCK
-from mutagen.mp4 import MP4Cover
+from covers import MAX_COVER_BYTES, get_jpeg_info, is_same_cover
+from formats import ID3_FORMAT, MP4_FORMAT, is_instance, load_class, open_for_tagging
+from instrumentation import NULL_TIMER
+from mutagen import MutagenError
+
+# tag containers of the files handled by VorbisMetadataSetter,
+# mutagen's format modules are only imported for the formats actually opened
+VORBIS_COMMENT_FORMATS = (
+    "mutagen.oggvorbis:OggVCommentDict",
+    "mutagen.oggopus:OggOpusVComment",
+    "mutagen.flac:VCFLACDict",
+)
+
+# padding reserved for text tags when a file has to be rewritten,
+# on top of the room for a cover
+TEXT_PADDING = 16 * 1024
+
+logger = logging.getLogger(__name__)
 
 
 class BaseMetadataSetter:
+    # how a file was saved, see save_tags_to_file
+    IN_PLACE = "in_place"
+    REWRITE = "rewrite"
+    # size of the cover data in the tags relative to the image data,
+    # e.g. base64 encoded covers take a third more room
+    cover_size_ratio = 1
+
     input_metadata_key_to_target_tag_map = {
         "artist": "",
         "album": "",
@@ -15,28 +38,193 @@ class BaseMetadataSetter:
         "cover": "",
     }
 
-    def __init__(self, filething, filepath, input_metadata_key, *args, **kwargs):
-        if input_metadata_key not in self.input_metadata_key_to_target_tag_map.keys():
-            raise ValueError(
-                "Input metadata key not supported. Supported input names: {}".format(
-                    ",".join(self.input_metadata_key_to_target_tag_map.keys())
+    def __init__(self, filething, filepath, metadata_changes, *args, **kwargs):
+        """
+        metadata_changes maps input metadata keys (e.g. "artist", "cover")
+        to the values that should be saved in the file,
+        so that several tags can be set with a single open/save of the file.
+        A None value removes the tag, e.g. when reverting to a file without it,
+        and a dict value sets back the exact values of the tag's target tags,
+        see get_original_value.
+        The optional timer keyword argument (see instrumentation.FileTimer)
+        records the time spent setting the tags and saving the file.
+        """
+        for input_metadata_key in metadata_changes:
+            if input_metadata_key not in self.input_metadata_key_to_target_tag_map:
+                raise ValueError(
+                    "Input metadata key not supported. Supported input names: {}".format(
+                        ",".join(self.input_metadata_key_to_target_tag_map.keys())
+                    )
                 )
-            )
+        self.timer = kwargs.pop("timer", NULL_TIMER)
         super().__init__(*args, **kwargs)
         self.filething = filething
         self.filepath = filepath
-        self.input_metadata_key = input_metadata_key
+        self.metadata_changes = metadata_changes
+        self.changed_keys = list(metadata_changes)
+        # values of the changed tags before set_tags, see get_original_value
+        self.original_values = {}
+        self.write_mode = None
+
+    def set_tags(self):
+        """
+        Set the tags whose current values differ from the requested ones.
+        Returns the list of input metadata keys which were actually changed,
+        and keeps their previous values in original_values.
+        """
+        self.changed_keys = []
+        self.original_values = {}
+        for input_metadata_key, value in self.metadata_changes.items():
+            stage = "cover_embed" if input_metadata_key == "cover" else "mutate"
+            with self.timer.stage(stage):
+                if self.set_changed_tag(input_metadata_key, value):
+                    self.changed_keys.append(input_metadata_key)
+        return self.changed_keys
+
+    def set_changed_tag(self, input_metadata_key, value):
+        """Set a tag unless it already holds the value, returning whether it was set."""
+        original_value = self.get_original_value(input_metadata_key)
+        if value is None:
+            if original_value is None:
+                return False
+            self.remove_tag(input_metadata_key)
+        elif isinstance(value, dict):
+            if self.get_exact_values(input_metadata_key) == value:
+                return False
+            self.restore_tags(input_metadata_key, value)
+        elif input_metadata_key == "cover":
+            if is_same_cover(self.get_current_cover(), value):
+                return False
+            self.set_cover(value)
+        else:
+            if self.is_tag_unchanged(input_metadata_key, value):
+                return False
+            self.set_tag(input_metadata_key, value)
+        self.original_values[input_metadata_key] = original_value
+        return True
+
+    def get_original_value(self, input_metadata_key):
+        """
+        Current value of a tag, in a form which sets it back exactly when passed
+        in metadata_changes: the cover's image data, or the exact values
+        of all the target tags the setter writes (see get_exact_values),
+        or None when none of them is set.
+        """
+        if input_metadata_key == "cover":
+            cover = self.get_current_cover()
+            return None if cover is None else bytes(cover)
+        exact_values = self.get_exact_values(input_metadata_key)
+        if all(values is None for values in exact_values.values()):
+            return None
+        return exact_values
+
+    def get_target_keys(self, input_metadata_key):
+        """Keys of the tags set for an input metadata key."""
+        return [self.input_metadata_key_to_target_tag_map[input_metadata_key]]
+
+    def get_exact_values(self, input_metadata_key):
+        """
+        Map the target tags of an input metadata key to their values,
+        as JSON serializable lists, or None for the tags which aren't set.
+        """
+        tags = self.filething.tags
+        return {
+            key: [self.to_exact_value(key, value) for value in tags[key]]
+            if key in tags
+            else None
+            for key in self.get_target_keys(input_metadata_key)
+        }
+
+    def to_exact_value(self, key, value):
+        return str(value)
+
+    def restore_tags(self, input_metadata_key, exact_values):
+        """Set back values returned by get_exact_values, removing the unset tags."""
+        target_keys = self.get_target_keys(input_metadata_key)
+        for key, values in exact_values.items():
+            if key not in target_keys:
+                raise ValueError(
+                    "{} isn't a target tag of {}".format(key, input_metadata_key)
+                )
+            if values is None:
+                self.remove_target_tag(key)
+            else:
+                self.set_target_tag(key, values)
+
+    def set_target_tag(self, key, values):
+        self.filething.tags[key] = values
+
+    def remove_target_tag(self, key):
+        if key in self.filething.tags:
+            del self.filething.tags[key]
+
+    def is_tag_unchanged(self, input_metadata_key, value):
+        current_values = self.get_current_values(input_metadata_key)
+        return current_values == self.normalize_value(input_metadata_key, value)
+
+    def get_current_values(self, input_metadata_key):
+        key = self.input_metadata_key_to_target_tag_map[input_metadata_key]
+        return [
+            str(current_value) for current_value in self.filething.tags.get(key, [])
+        ]
 
-    def set_tag(self, value):
-        key = self.input_metadata_key_to_target_tag_map[self.input_metadata_key]
+    def normalize_value(self, input_metadata_key, value):
+        """Convert a value to set into the form returned by get_current_values."""
+        if isinstance(value, list):
+            return [str(item) for item in value]
+        return [str(value)]
+
+    def get_current_cover(self):
+        """Return the embedded cover's image data, or None if there's none."""
+        key = self.input_metadata_key_to_target_tag_map["cover"]
+        return self.filething.tags.get(key)
+
+    def set_tag(self, input_metadata_key, value):
+        key = self.input_metadata_key_to_target_tag_map[input_metadata_key]
         self.filething.tags[key] = value
 
     def set_cover(self, byteimage):
-        key = self.input_metadata_key_to_target_tag_map[self.input_metadata_key]
+        key = self.input_metadata_key_to_target_tag_map["cover"]
         self.filething.tags[key] = byteimage
 
+    def remove_tag(self, input_metadata_key):
+        key = self.input_metadata_key_to_target_tag_map[input_metadata_key]
+        if key in self.filething.tags:
+            del self.filething.tags[key]
+
+    def get_padding(self, padding_info):
+        """
+        Padding policy, called by mutagen while saving with a PaddingInfo
+        holding the padding left if the tags were written in place.
+        When the new tags fit, the existing padding is kept as it is,
+        so that only the tags are written. Otherwise the file has to be
+        rewritten anyway, and padding is reserved for later edits,
+        including embedding the largest cover we encode, to fit in place.
+        """
+        if padding_info.padding >= 0:
+            self.write_mode = self.IN_PLACE
+            return padding_info.padding
+        self.write_mode = self.REWRITE
+        return self.get_padding_reserve()
+
+    def get_padding_reserve(self):
+        return TEXT_PADDING + int(MAX_COVER_BYTES * self.cover_size_ratio)
+
     def save_tags_to_file(self):
-        self.filething.save(self.filepath)
+        """
+        Save the tags to the file, unless set_tags found nothing to change.
+        Returns whether the file was written; write_mode then tells whether
+        the tags were written in place or the file was rewritten.
+        """
+        if not self.changed_keys:
+            return False
+        # mutagen doesn't ask for padding when it has to create the tags
+        self.write_mode = self.REWRITE
+        with self.timer.stage("save"), self.timer.open(
+            self.filepath, "r+b"
+        ) as filething:
+            self.filething.save(filething, padding=self.get_padding)
+        return True
 
 
 class MP4MetadataSetter(BaseMetadataSetter):
@@ -55,17 +243,57 @@ class MP4MetadataSetter(BaseMetadataSetter):
         "cover": "covr",
     }
 
-    def set_tag(self, value):
-        key = self.input_metadata_key_to_target_tag_map[self.input_metadata_key]
+    def set_tag(self, input_metadata_key, value):
+        key = self.input_metadata_key_to_target_tag_map[input_metadata_key]
         # edge case: track number takes in a tuple of ints, not an int
-        # the second int is the number of total tracks
-        # setting to 0 for simplicity
+        # the second int is the number of total tracks, 0 when not given
         if key == "trkn":
-            value = [[int(value), 0]]
+            value = self.get_tracks(value)
         self.filething.tags[key] = value
 
+    @staticmethod
+    def get_tracks(value):
+        """
+        Parse track numbers, e.g. "5" or "5/12" like ID3's TRCK frame,
+        into (track number, total tracks) pairs.
+        """
+        tracks = []
+        for item in value if isinstance(value, list) else [value]:
+            number, _, total = str(item).partition("/")
+            tracks.append((int(number), int(total or 0)))
+        return tracks
+
+    def is_tag_unchanged(self, input_metadata_key, value):
+        if input_metadata_key != "track_number":
+            return super().is_tag_unchanged(input_metadata_key, value)
+        current_tracks = self.filething.tags.get("trkn", [])
+        requested_tracks = self.get_tracks(value)
+        # the total number of tracks is kept when the track number is
+        # already right and no total is given
+        return len(current_tracks) == len(requested_tracks) and all(
+            current_track[0] == number and total in (0, current_track[1])
+            for current_track, (number, total) in zip(current_tracks, requested_tracks)
+        )
+
+    def to_exact_value(self, key, value):
+        # the whole (track number, total tracks) pair
+        if key == "trkn":
+            return list(value)
+        return super().to_exact_value(key, value)
+
+    def set_target_tag(self, key, values):
+        if key == "trkn":
+            values = [tuple(value) for value in values]
+        super().set_target_tag(key, values)
+
+    def get_current_cover(self):
+        key = self.input_metadata_key_to_target_tag_map["cover"]
+        covers = self.filething.tags.get(key)
+        return bytes(covers[0]) if covers else None
+
     def set_cover(self, byteimage):
-        key = self.input_metadata_key_to_target_tag_map[self.input_metadata_key]
+        MP4Cover = load_class("mutagen.mp4:MP4Cover")
+        key = self.input_metadata_key_to_target_tag_map["cover"]
         mp4_cover = [MP4Cover(byteimage)]
         self.filething.tags[key] = mp4_cover
 
@@ -87,23 +315,35 @@ class VorbisMetadataSetter(BaseMetadataSetter):
         "recording_year": "date",
         "cover": "metadata_block_picture",
     }
+    # covers are base64 encoded
+    cover_size_ratio = 4 / 3
+
+    def get_current_cover(self):
+        Picture = load_class("mutagen.flac:Picture")
+        pictures = self.filething.tags.get("metadata_block_picture")
+        if not pictures:
+            return None
+        try:
+            return Picture(base64.b64decode(pictures[0])).data
+        except (ValueError, MutagenError):
+            return None
 
     def set_cover(self, byteimage):
-        print("setting image for .opus file")
+        Picture = load_class("mutagen.flac:Picture")
+        logger.debug("Setting Vorbis cover for %s", self.filepath)
         cover = Picture()
         cover.data = byteimage
         cover.type = 3
         cover.mime = "image/jpeg"
-        cover.width = 400
-        cover.height = 400
-        cover.depth = 24
+        # real dimensions of the encoded cover, which may be smaller than the max size
+        jpeg_info = get_jpeg_info(bytes(byteimage)) or (0, 0, 24)
+        cover.width, cover.height, cover.depth = jpeg_info
 
         cover_data = cover.write()
         encoded_data = base64.b64encode(cover_data)
         vcomment_value = encoded_data.decode("ascii")
 
         self.filething["metadata_block_picture"] = [vcomment_value]
-        # file_.save()
 
 
 class ID3MetadataSetter(BaseMetadataSetter):
@@ -113,25 +353,120 @@ class ID3MetadataSetter(BaseMetadataSetter):
     https://mutagen.readthedocs.io/en/latest/api/id3.html
     """
 
+    # ID3 frame ids, the frame classes are looked up in mutagen.id3
     input_metadata_key_to_id3_tag_map = {
-        "artist": [TPE1, TPE2, TOPE],
-        "album": TALB,
-        "title": TIT2,
-        "track_number": TRCK,
-        "recording_year": TDRC,
+        "artist": ["TPE1", "TPE2", "TOPE"],
+        "album": "TALB",
+        "title": "TIT2",
+        "track_number": "TRCK",
+        "recording_year": "TDRC",
     }
 
-    def set_tag(self, value):
-        mapped_ID3_tags = self.input_metadata_key_to_id3_tag_map[
-            self.input_metadata_key
-        ]
+    def get_target_keys(self, input_metadata_key):
+        mapped_ID3_tags = self.input_metadata_key_to_id3_tag_map[input_metadata_key]
         if not isinstance(mapped_ID3_tags, list):
             mapped_ID3_tags = [mapped_ID3_tags]
-        for tag in mapped_ID3_tags:
+        return mapped_ID3_tags
+
+    def get_frame_classes(self, input_metadata_key):
+        return [
+            load_class("mutagen.id3:" + frame_id)
+            for frame_id in self.get_target_keys(input_metadata_key)
+        ]
+
+    def get_exact_values(self, input_metadata_key):
+        exact_values = {}
+        for frame_id in self.get_target_keys(input_metadata_key):
+            frame = self.id3_tags.get(frame_id)
+            exact_values[frame_id] = (
+                None if frame is None else [str(text) for text in frame.text]
+            )
+        return exact_values
+
+    def set_target_tag(self, key, values):
+        self.id3_tags[key] = load_class("mutagen.id3:" + key)(encoding=3, text=values)
+
+    def remove_target_tag(self, key):
+        self.id3_tags.delall(key)
+
+    def set_tag(self, input_metadata_key, value):
+        for tag in self.get_frame_classes(input_metadata_key):
             filled_tag = tag(encoding=3, text=value)
             self.filething[filled_tag.__class__.__name__] = filled_tag
 
+    def get_current_values(self, input_metadata_key):
+        mapped_ID3_tags = self.input_metadata_key_to_id3_tag_map[input_metadata_key]
+        if isinstance(mapped_ID3_tags, list):
+            mapped_ID3_tags = mapped_ID3_tags[0]
+        current_frame = self.id3_tags.get(mapped_ID3_tags)
+        if current_frame is None:
+            return []
+        return [str(text) for text in current_frame.text]
+
+    def remove_tag(self, input_metadata_key):
+        if input_metadata_key == "cover":
+            for frame in self.id3_tags.getall("APIC"):
+                if frame.type == 3:
+                    del self.id3_tags[frame.HashKey]
+            return
+        for frame_id in self.get_target_keys(input_metadata_key):
+            self.remove_target_tag(frame_id)
+
+    @property
+    def id3_tags(self):
+        return (
+            self.filething
+            if is_instance(self.filething, ID3_FORMAT)
+            else self.filething.tags
+        )
+
+    def is_tag_unchanged(self, input_metadata_key, value):
+        # e.g. the artist is written to several frames, all of them have to match;
+        # values are compared as strings, so that e.g. TDRC timestamps are normalized
+        for tag in self.get_frame_classes(input_metadata_key):
+            current_frame = self.id3_tags.get(tag.__name__)
+            if current_frame is None:
+                return False
+            requested_text = tag(encoding=3, text=value).text
+            if [str(text) for text in current_frame.text] != [
+                str(text) for text in requested_text
+            ]:
+                return False
+        return True
+
+    def get_current_cover(self):
+        for frame in self.id3_tags.getall("APIC"):
+            if frame.type == 3:
+                return frame.data
+        return None
+
     def set_cover(self, byteimage):
-        print("setting image for ID3 file")
-        # byteimage = open(picture, 'rb').read()
-        self.filething["APIC"] = APIC(3, "image/jpeg", 3, "Front cover", byteimage)
+        APIC = load_class("mutagen.id3:APIC")
+        logger.debug("Setting ID3 cover for %s", self.filepath)
+        # replaces an existing front cover with the same description
+        self.id3_tags.add(APIC(3, "image/jpeg", 3, "Front cover", byteimage))
+
+
+def get_metadata_setter(filepath, metadata_changes, timer=NULL_TIMER):
+    """
+    Open the file with mutagen, guess its type
+    and return the appropriate metadata setter for the given changes.
+    The file is opened once (see formats.open_for_tagging),
+    and the parsed object is reused by the setter.
+    """
+    filething = open_for_tagging(filepath, timer)
+    if is_instance(filething, ID3_FORMAT):
+        return ID3MetadataSetter(filething, filepath, metadata_changes, timer=timer)
+    if filething.tags is None:
+        filething.add_tags()
+    if is_instance(filething, MP4_FORMAT):
+        return MP4MetadataSetter(filething, filepath, metadata_changes, timer=timer)
+    elif any(
+        is_instance(filething.tags, format_name)
+        for format_name in VORBIS_COMMENT_FORMATS
+    ):
+        return VorbisMetadataSetter(filething, filepath, metadata_changes, timer=timer)
+    elif is_instance(filething.tags, ID3_FORMAT):
+        # WAVE and other formats storing ID3 tags, e.g. MP3 with a misleading extension
+        return ID3MetadataSetter(filething, filepath, metadata_changes, timer=timer)
+    raise ValueError("Unsupported file type: {}".format(filepath))
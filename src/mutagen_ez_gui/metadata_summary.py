@@ -0,0 +1,157 @@
+"""
+Summary of the metadata of many files at once.
+The tags of the files are read in a worker pool, and merged into a summary
+showing, per tag, either the value common to all files or how many
+distinct values there are. Partial summaries are reported while the files
+are read, and the work can be cancelled when it's no longer needed,
+e.g. when the selection changes.
+This module doesn't depend on Kivy, the callbacks run in a background thread.
+"""
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from engine import DEFAULT_MAX_WORKERS
+from metadata_readers import METADATA_KEYS, read_metadata
+
+# minimum delay between two partial summaries, in seconds
+UPDATE_INTERVAL = 0.2
+
+
+def to_summary_value(value):
+    if isinstance(value, list):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+class MetadataSummary:
+    """Counts of the distinct values of each tag over a set of files."""
+
+    def __init__(self, metadata_keys=METADATA_KEYS):
+        self.metadata_keys = metadata_keys
+        self.value_counts = {key: Counter() for key in metadata_keys}
+        self.files = 0
+        self.failed = 0
+
+    def add(self, tags):
+        self.files += 1
+        for key in self.metadata_keys:
+            self.value_counts[key][to_summary_value(tags.get(key, ""))] += 1
+
+    def get_display_value(self, key):
+        """The value common to all files, or "<mixed: N distinct>"."""
+        value_counts = self.value_counts[key]
+        if len(value_counts) == 1:
+            return next(iter(value_counts))
+        if not value_counts:
+            return ""
+        return "<mixed: {} distinct>".format(len(value_counts))
+
+    def get_display_values(self):
+        return {key: self.get_display_value(key) for key in self.metadata_keys}
+
+
+class SummaryJob:
+    """Handle of a running summary, used to follow and cancel it."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.summary = MetadataSummary()
+        self.cancel_event = threading.Event()
+        self.finished_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """Stop reading files; no more callbacks are made after this."""
+        self.cancel_event.set()
+
+    def wait(self, timeout=None):
+        return self.finished_event.wait(timeout)
+
+
+class MetadataSummarizer:
+    """
+    Reads the tags of many files in a thread pool and summarizes them.
+    The loader is called with a file path and returns its tags,
+    e.g. a TagCache's get method, so that summaries share the display's cache.
+    """
+
+    def __init__(self, loader=read_metadata, max_workers=None):
+        self.loader = loader
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="metadata-summary"
+            )
+        return self._executor
+
+    def submit(self, filepaths, on_update=None, on_complete=None):
+        """
+        Start summarizing the tags of the given files in the background.
+        on_update(summary_job, display_values) is called with partial results
+        at most every UPDATE_INTERVAL seconds, and on_complete(summary_job,
+        display_values) once all files were read. The display values are
+        a snapshot, safe to use from another thread.
+        Neither callback is called once the job is cancelled.
+        """
+        filepaths = list(filepaths)
+        summary_job = SummaryJob(len(filepaths))
+        threading.Thread(
+            target=self._run,
+            args=(summary_job, filepaths, on_update, on_complete),
+            daemon=True,
+        ).start()
+        return summary_job
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def _run(self, summary_job, filepaths, on_update, on_complete):
+        try:
+            self._summarize(summary_job, filepaths, on_update)
+            if on_complete and not summary_job.cancelled:
+                on_complete(summary_job, summary_job.summary.get_display_values())
+        finally:
+            summary_job.finished_event.set()
+
+    def _summarize(self, summary_job, filepaths, on_update):
+        # only a few files are queued at once, so that a cancelled job
+        # doesn't leave thousands of reads in the pool
+        max_pending = self.max_workers * 2
+        pending = set()
+        filepaths = iter(filepaths)
+        last_update = time.monotonic()
+        while True:
+            if summary_job.cancelled:
+                for future in pending:
+                    future.cancel()
+                return
+            for filepath in filepaths:
+                pending.add(self.executor.submit(self.loader, filepath))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                summary_job.done += 1
+                try:
+                    summary_job.summary.add(future.result())
+                except Exception:
+                    summary_job.summary.failed += 1
+            now = time.monotonic()
+            if on_update and now - last_update >= UPDATE_INTERVAL:
+                last_update = now
+                on_update(summary_job, summary_job.summary.get_display_values())
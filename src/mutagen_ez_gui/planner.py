@@ -0,0 +1,349 @@
+"""
+Dry-run planning of tag writes.
+Planning a file opens it and sets the tags in memory like write_metadata,
+then runs mutagen's save against a DryRunFile, which reads the file
+but never writes it, to predict what saving would do:
+    - no_op: the file already holds the values, it wouldn't be written;
+    - in_place: the tags fit in the existing padding, only they are written;
+    - rewrite: the tags don't fit, all the data after them has to be moved;
+along with an estimate of the bytes written.
+Plans can be saved as JSON lines and executed later as they are
+(see iter_plan_jobs), e.g. to run heavy batches off-peak;
+files modified since they were planned aren't written.
+"""
+
+import base64
+import json
+import os
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from covers import cover_digest
+from engine import DEFAULT_MAX_WORKERS
+from formats import is_instance
+from metadata_setters import BaseMetadataSetter, get_metadata_setter
+
+NO_OP = "no_op"
+IN_PLACE = BaseMetadataSetter.IN_PLACE
+REWRITE = BaseMetadataSetter.REWRITE
+FAILED = "failed"
+ACTIONS = (NO_OP, IN_PLACE, REWRITE, FAILED)
+
+OGG_FORMAT = "mutagen.ogg:OggFileType"
+
+# plan records
+FILE = "file"
+COVER = "cover"
+
+
+class RewriteNeeded(Exception):
+    """Raised to stop a dry-run save as soon as it would rewrite the file."""
+
+    def __init__(self, estimated_bytes):
+        super().__init__(estimated_bytes)
+        self.estimated_bytes = estimated_bytes
+
+
+class DryRunFile:
+    """
+    File object given to mutagen's save instead of the file opened for writing.
+    Reads go to the file, opened read-only; writes are counted and dropped,
+    except the bytes written past its end (e.g. a chunk appended to a WAVE file),
+    which are kept so that reading them back returns them.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._file_size = os.fstat(fileobj.fileno()).st_size
+        # bytes written past the end of the file
+        self._appended = bytearray()
+        self.size = self._file_size
+        self.bytes_written = 0
+
+    @property
+    def name(self):
+        return self._fileobj.name
+
+    def read(self, size=-1):
+        position = self._fileobj.tell()
+        end = self.size if size is None or size < 0 else min(position + size, self.size)
+        if end <= position:
+            return b""
+        data = b""
+        if position < self._file_size:
+            data = self._fileobj.read(min(end, self._file_size) - position)
+        if end > self._file_size:
+            start = max(position, self._file_size) - self._file_size
+            stop = end - self._file_size
+            data += self._appended[start:stop]
+            self._fileobj.seek(end)
+        return bytes(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            return self._fileobj.seek(self.size + offset)
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if not data:
+            return 0
+        position = self._fileobj.tell()
+        end = position + len(data)
+        if end > self._file_size:
+            start = max(position, self._file_size) - self._file_size
+            stop = end - self._file_size
+            if len(self._appended) < start:
+                self._appended.extend(bytes(start - len(self._appended)))
+            # the part of the data past the end
+            skipped = len(data) - (stop - start)
+            self._appended[start:stop] = data[skipped:]
+            self.size = max(self.size, end)
+        self._fileobj.seek(end)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def truncate(self, size=None):
+        # e.g. ID3 truncates at the end of the file when there's no ID3v1 tag
+        if size is None:
+            size = self._fileobj.tell()
+        self.size = min(self.size, size)
+        kept = max(self.size - self._file_size, 0)
+        del self._appended[kept:]
+        return size
+
+
+def estimate_save(metadata_setter):
+    """
+    Predict what metadata_setter.save_tags_to_file would do,
+    once its tags were set, returning (IN_PLACE or REWRITE, estimated bytes).
+    The setter's padding policy decides, as it would when saving.
+    In place, the bytes mutagen writes are counted.
+    For a rewrite, the save is stopped when mutagen asks for the padding,
+    adding to the bytes written until then (e.g. the header of a WAVE chunk
+    appended to hold the tags): the file grows by the zeros it inserts,
+    the data after the tags is moved, and the tags are written - counted
+    as their growth, as their previous size isn't known, so the estimate
+    is a lower bound (checked against real saves by benchmarks/bench_planner.py).
+    Ogg pages after the tags are written once more, to be renumbered.
+    """
+    # mutagen doesn't ask for padding when it has to create the tags
+    metadata_setter.write_mode = REWRITE
+
+    def get_padding(padding_info):
+        padding = metadata_setter.get_padding(padding_info)
+        if metadata_setter.write_mode == REWRITE:
+            growth = max(padding - padding_info.padding, 0)
+            moved_bytes = padding_info.size
+            if is_instance(metadata_setter.filething, OGG_FORMAT):
+                moved_bytes *= 2
+            raise RewriteNeeded(moved_bytes + 2 * growth)
+        return padding
+
+    with open(metadata_setter.filepath, "rb") as fileobj:
+        dry_run_file = DryRunFile(fileobj)
+        try:
+            metadata_setter.filething.save(dry_run_file, padding=get_padding)
+        except RewriteNeeded as rewrite:
+            # plus e.g. the header of a chunk appended to hold the tags
+            return REWRITE, dry_run_file.bytes_written + rewrite.estimated_bytes
+    return metadata_setter.write_mode, dry_run_file.bytes_written
+
+
+@dataclass
+class FilePlan:
+    """Predicted outcome of writing metadata to a single file."""
+
+    filepath: str
+    action: str
+    metadata_changes: dict
+    changed_keys: list = field(default_factory=list)
+    estimated_bytes: int = 0
+    # signature of the file when it was planned
+    file_size: int = 0
+    mtime_ns: int = 0
+    error: str = ""
+
+    def is_current(self):
+        """Whether the file is unchanged since it was planned."""
+        try:
+            stat_result = os.stat(self.filepath)
+        except OSError:
+            return False
+        return (stat_result.st_size, stat_result.st_mtime_ns) == (
+            self.file_size,
+            self.mtime_ns,
+        )
+
+
+def plan_write(filepath, metadata_changes):
+    """
+    Plan writing the given tags to a file, without writing it.
+    Errors are reported in the returned plan instead of being raised,
+    like write_metadata does.
+    """
+    try:
+        stat_result = os.stat(filepath)
+        metadata_setter = get_metadata_setter(filepath, metadata_changes)
+        changed_keys = metadata_setter.set_tags()
+        action, estimated_bytes = NO_OP, 0
+        if changed_keys:
+            action, estimated_bytes = estimate_save(metadata_setter)
+    except Exception as exc:
+        return FilePlan(filepath, FAILED, metadata_changes, error=str(exc))
+    return FilePlan(
+        filepath,
+        action,
+        metadata_changes,
+        changed_keys=changed_keys,
+        estimated_bytes=estimated_bytes,
+        file_size=stat_result.st_size,
+        mtime_ns=stat_result.st_mtime_ns,
+    )
+
+
+def iter_plans(jobs, max_workers=None):
+    """
+    Lazily plan (filepath, metadata_changes) pairs in a thread pool,
+    yielding a FilePlan per file, in order.
+    At most a few files per worker are queued, so memory use stays constant
+    regardless of the number of files.
+    """
+    max_workers = max_workers or DEFAULT_MAX_WORKERS
+    max_pending = max_workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filepath, metadata_changes in jobs:
+            pending.append(executor.submit(plan_write, filepath, metadata_changes))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class PlanTotals:
+    """Number of files and estimated bytes written per action."""
+
+    def __init__(self):
+        self.files = Counter()
+        self.estimated_bytes = Counter()
+        # size of the files which would be rewritten
+        self.rewritten_file_bytes = 0
+
+    def add(self, file_plan):
+        self.files[file_plan.action] += 1
+        self.estimated_bytes[file_plan.action] += file_plan.estimated_bytes
+        if file_plan.action == REWRITE:
+            self.rewritten_file_bytes += file_plan.file_size
+
+    @property
+    def total_estimated_bytes(self):
+        return sum(self.estimated_bytes.values())
+
+    def to_dict(self):
+        return {
+            "files": {action: self.files[action] for action in ACTIONS},
+            "estimated_bytes": {
+                action: self.estimated_bytes[action] for action in (IN_PLACE, REWRITE)
+            },
+            "total_estimated_bytes": self.total_estimated_bytes,
+            "rewritten_file_bytes": self.rewritten_file_bytes,
+        }
+
+
+class PlanWriter:
+    """
+    Writes FilePlans to a JSON lines file object, one record per file.
+    Covers are stored once per distinct image, before the first file using
+    them, and referenced by content hash.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._cover_digests = set()
+
+    def _write_record(self, record):
+        self.fileobj.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _encode_changes(self, metadata_changes):
+        encoded_changes = {}
+        for input_metadata_key, value in metadata_changes.items():
+            if input_metadata_key == "cover" and value is not None:
+                digest = cover_digest(bytes(value)).hex()
+                if digest not in self._cover_digests:
+                    self._cover_digests.add(digest)
+                    self._write_record(
+                        {
+                            "event": COVER,
+                            "digest": digest,
+                            "data": base64.b64encode(value).decode("ascii"),
+                        }
+                    )
+                value = {COVER: digest}
+            encoded_changes[input_metadata_key] = value
+        return encoded_changes
+
+    def write(self, file_plan):
+        self._write_record(
+            {
+                "event": FILE,
+                "path": file_plan.filepath,
+                "action": file_plan.action,
+                "changes": self._encode_changes(file_plan.metadata_changes),
+                "changed_keys": file_plan.changed_keys,
+                "estimated_bytes": file_plan.estimated_bytes,
+                "file_size": file_plan.file_size,
+                "mtime_ns": file_plan.mtime_ns,
+                "error": file_plan.error,
+            }
+        )
+
+
+def read_plan(fileobj):
+    """Lazily yield the FilePlans of a plan written by PlanWriter."""
+    covers = {}
+    for line in fileobj:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record["event"] == COVER:
+            covers[record["digest"]] = base64.b64decode(record["data"])
+            continue
+        metadata_changes = {
+            input_metadata_key: covers[value[COVER]]
+            if isinstance(value, dict)
+            else value
+            for input_metadata_key, value in record["changes"].items()
+        }
+        yield FilePlan(
+            record["path"],
+            record["action"],
+            metadata_changes,
+            changed_keys=record["changed_keys"],
+            estimated_bytes=record["estimated_bytes"],
+            file_size=record["file_size"],
+            mtime_ns=record["mtime_ns"],
+            error=record["error"],
+        )
+
+
+def iter_plan_jobs(file_plans, on_stale=None):
+    """
+    Yield the (filepath, metadata_changes) pairs of the planned writes,
+    skipping the files planned as no-op or failed. Files modified since they
+    were planned are skipped too, and passed to on_stale(file_plan).
+    """
+    for file_plan in file_plans:
+        if file_plan.action not in (IN_PLACE, REWRITE):
+            continue
+        if not file_plan.is_current():
+            if on_stale is not None:
+                on_stale(file_plan)
+            continue
+        yield file_plan.filepath, file_plan.metadata_changes
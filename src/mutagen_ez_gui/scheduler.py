@@ -0,0 +1,460 @@
+"""
+Locality-aware scheduling of batch writes.
+On spinning disks and network mounts, writing files in whatever order they
+were selected, many at once, makes the disk seek (or the mount make a round
+trip) between files for almost every read and write. Batch writes are
+scheduled instead:
+    - iter_ordered_jobs sorts the files by device, directory, then inode
+      (which roughly follows their layout on most local file systems)
+      or name, within windows of jobs so lazy batches stay in constant memory;
+    - IOScheduler wraps the worker pool and dispatches at most a few files
+      of a device at once, in the order they were submitted. The other files
+      wait in the scheduler rather than in worker threads, so a slow device
+      doesn't hold up the workers writing to the others.
+PathSerializer runs the writes of a file one after the other, so batches
+submitted while an earlier one still writes the same files don't clash.
+The limit of every device adapts to the measured latency of its files,
+see AdaptiveLimit. The pool size still bounds the work done at once
+across all devices, e.g. parsing tags and embedding covers.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import CancelledError, Future
+from functools import partial
+
+INODE_ORDER = "inode"
+PATH_ORDER = "path"
+ORDERS = (INODE_ORDER, PATH_ORDER)
+
+# jobs sorted at once by iter_ordered_jobs
+DEFAULT_WINDOW = 1024
+DEFAULT_MAX_IO_PER_DEVICE = 8
+DEFAULT_INITIAL_IO_PER_DEVICE = 2
+# a round of files slower than their baseline by this factor on average
+# means they queue up on the device
+DEFAULT_LATENCY_TOLERANCE = 1.5
+# latencies of a kind of file run alone whose lowest is its baseline
+BASELINE_SAMPLES = 16
+MIN_ROUND_SAMPLES = 4
+# rounds after lowering a limit before raising it again
+HOLD_ROUNDS = 4
+# rounds between two measures of the baselines
+PROBE_ROUNDS = 16
+# device of the paths which can't be stat'ed, e.g. missing files,
+# whose writes fail straight away
+UNKNOWN_DEVICE = -1
+
+logger = logging.getLogger(__name__)
+
+
+def get_locality_key(filepath, order=INODE_ORDER):
+    """Sort key grouping a file with the files of its device and directory."""
+    directory, name = os.path.split(os.path.abspath(filepath))
+    try:
+        stat_result = os.stat(filepath)
+    except OSError:
+        return (UNKNOWN_DEVICE, directory, 0, name)
+    position = stat_result.st_ino if order == INODE_ORDER else 0
+    return (stat_result.st_dev, directory, position, name)
+
+
+def iter_ordered_jobs(jobs, order=INODE_ORDER, window=DEFAULT_WINDOW):
+    """
+    Lazily reorder (filepath, metadata_changes) pairs by locality,
+    sorting them `window` at a time (all at once if window is None).
+    Jobs of the same file keep their relative order.
+    """
+    iterator = iter(jobs)
+    while True:
+        batch = list(itertools.islice(iterator, window))
+        if not batch:
+            return
+        batch.sort(key=lambda job: get_locality_key(job[0], order))
+        yield from batch
+        if window is None:
+            return
+
+
+class AdaptiveLimit:
+    """
+    Number of files of a device processed at once, adapted to their latency.
+    The baseline latency of every kind of file (format, as they don't do
+    the same amount of I/O) is measured on files run alone on the device:
+    during a first probing round at the minimum limit, then every PROBE_ROUNDS
+    rounds or when a new kind of file comes, as the device's load may change.
+    The latency of every file is compared to the baseline of its kind,
+    and these slowdowns are averaged over rounds of about twice the limit's
+    files: after a round within tolerance the limit is raised by one (doubled
+    until the first slower round); after a slower round it's cut by a quarter,
+    as running more files at once
+    on a saturated device only makes each of them slower (and, on a spinning
+    disk, adds seeks between them).
+    """
+
+    def __init__(
+        self,
+        initial=DEFAULT_INITIAL_IO_PER_DEVICE,
+        minimum=1,
+        maximum=DEFAULT_MAX_IO_PER_DEVICE,
+        tolerance=DEFAULT_LATENCY_TOLERANCE,
+        adaptive=True,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.adaptive = adaptive
+        # limit applied after probing
+        self.target = max(minimum, min(initial, maximum))
+        self.limit = self.minimum if adaptive else self.target
+        self.probing = adaptive
+        self._probe_samples = 0
+        # kind -> latencies of files run alone
+        self._baselines = {}
+        # kind -> recent latencies, for the kinds without baseline yet
+        self._latencies = {}
+        self._unknown_kind = False
+        # slowdowns of the current round
+        self._round = []
+        self._rounds = 0
+        self._hold = 0
+        self._slow_start = True
+
+    def get_slowdown(self, latency, kind, concurrency):
+        if concurrency <= self.minimum:
+            if kind not in self._baselines:
+                self._baselines[kind] = deque(maxlen=BASELINE_SAMPLES)
+            self._baselines[kind].append(latency)
+            if self.probing:
+                self._probe_samples += 1
+        latencies = self._baselines.get(kind)
+        if latencies is None:
+            # compared to its best until it's probed
+            self._unknown_kind = True
+            if kind not in self._latencies:
+                self._latencies[kind] = deque(maxlen=BASELINE_SAMPLES)
+            latencies = self._latencies[kind]
+            latencies.append(latency)
+        baseline = min(latencies)
+        return latency / baseline if baseline > 0 else 1.0
+
+    def adjust(self, slowdown):
+        """New limit after a round with the given average slowdown."""
+        if slowdown > self.tolerance:
+            self._hold = HOLD_ROUNDS
+            self._slow_start = False
+            return max(self.minimum, self.limit * 3 // 4)
+        if self._hold:
+            self._hold -= 1
+            return self.limit
+        if self._slow_start:
+            return min(self.maximum, self.limit * 2)
+        return min(self.maximum, self.limit + 1)
+
+    def add_sample(self, latency, kind=None, concurrency=1):
+        """
+        Record the latency of a file run with at most `concurrency` files
+        of the device at once, returning whether the limit changed.
+        """
+        if not self.adaptive:
+            return False
+        self._round.append(self.get_slowdown(latency, kind, concurrency))
+        if self.probing:
+            # the files still running from before don't count
+            if self._probe_samples < MIN_ROUND_SAMPLES:
+                return False
+        elif len(self._round) < max(self.limit * 2, MIN_ROUND_SAMPLES):
+            return False
+        slowdown = sum(self._round) / len(self._round)
+        self._round.clear()
+        self._rounds += 1
+        previous_limit = self.limit
+        if self.probing:
+            self.probing = False
+            self.limit = self.target
+        elif self.limit > self.minimum and (
+            self._unknown_kind or self._rounds % PROBE_ROUNDS == 0
+        ):
+            self.target = self.adjust(slowdown)
+            self.limit = self.minimum
+            self.probing = True
+            self._probe_samples = 0
+            self._unknown_kind = False
+        else:
+            self.limit = self.target = self.adjust(slowdown)
+        if self.limit != previous_limit:
+            logger.debug(
+                "Concurrency limit %d -> %d (%.2fx slower than the baseline%s)",
+                previous_limit,
+                self.limit,
+                slowdown,
+                ", probing" if self.probing else "",
+            )
+            return True
+        return False
+
+
+def get_file_kind(filepath):
+    """Kind of a file for AdaptiveLimit, its extension."""
+    return os.path.splitext(filepath)[1].lower()
+
+
+def run_timed(function, *args, **kwargs):
+    """
+    Call a function, returning (elapsed seconds, its result).
+    Module level, so it can be pickled to a process pool.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+class IOScheduler:
+    """
+    Executor wrapper limiting the number of calls running at once per device.
+    submit(function, filepath, *args) has the signature of Executor.submit,
+    the first argument of the calls being the path of the file they do I/O on.
+    It returns a Future straight away, and the call is passed to the executor
+    once its device has a free slot; the future can be cancelled until then.
+    The limits are kept from one batch to the next.
+    """
+
+    def __init__(
+        self,
+        executor,
+        max_per_device=DEFAULT_MAX_IO_PER_DEVICE,
+        initial_per_device=DEFAULT_INITIAL_IO_PER_DEVICE,
+        adaptive=True,
+        tolerance=DEFAULT_LATENCY_TOLERANCE,
+    ):
+        self.executor = executor
+        self.max_per_device = max_per_device
+        self.initial_per_device = initial_per_device
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        # device -> AdaptiveLimit
+        self._limits = {}
+        # device -> calls waiting for a slot, in submission order
+        self._queues = {}
+        self._running = Counter()
+        # calls dispatched so far per device
+        self._dispatched = Counter()
+        self._devices_by_directory = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def get_device(self, filepath):
+        """Device of a file, stat'ing its directory once for all its files."""
+        directory = os.path.dirname(os.path.abspath(filepath))
+        device = self._devices_by_directory.get(directory)
+        if device is None:
+            try:
+                device = os.stat(directory).st_dev
+            except OSError:
+                device = UNKNOWN_DEVICE
+            self._devices_by_directory[directory] = device
+        return device
+
+    @property
+    def limits(self):
+        """Current limit per device."""
+        with self._lock:
+            return {device: limit.limit for device, limit in self._limits.items()}
+
+    def submit(self, function, filepath, *args, **kwargs):
+        device = self.get_device(filepath)
+        future = Future()
+        with self._lock:
+            if device not in self._limits:
+                self._limits[device] = AdaptiveLimit(
+                    self.initial_per_device,
+                    maximum=self.max_per_device,
+                    tolerance=self.tolerance,
+                    adaptive=self.adaptive,
+                )
+            self._queues.setdefault(device, deque()).append(
+                (future, function, filepath, args, kwargs)
+            )
+            ready = self._pop_ready(device)
+        self._dispatch(device, ready)
+        return future
+
+    def _pop_ready(self, device):
+        """
+        Pop the calls of a device which can start now, with the number of calls
+        running and dispatched when they start. Callers hold the lock.
+        """
+        queue = self._queues.get(device)
+        ready = []
+        while queue and self._running[device] < self._limits[device].limit:
+            call = queue.popleft()
+            # skips the calls cancelled while they waited
+            if call[0].set_running_or_notify_cancel():
+                self._running[device] += 1
+                self._dispatched[device] += 1
+                ready.append((call, (self._running[device], self._dispatched[device])))
+        if queue is not None and not queue:
+            del self._queues[device]
+        return ready
+
+    def _dispatch(self, device, calls):
+        for (future, function, filepath, args, kwargs), start in calls:
+            try:
+                executor_future = self.executor.submit(
+                    run_timed, function, filepath, *args, **kwargs
+                )
+            except Exception as exc:
+                # e.g. the executor was shut down
+                self._release(device)
+                future.set_exception(exc)
+                continue
+            executor_future.add_done_callback(
+                partial(self._on_call_done, device, filepath, start, future)
+            )
+
+    def _on_call_done(self, device, filepath, start, future, executor_future):
+        try:
+            latency, result = executor_future.result()
+        except BaseException as exc:
+            self._release(device)
+            future.set_exception(exc)
+            return
+        self._release(device, latency, get_file_kind(filepath), start)
+        future.set_result(result)
+
+    def _release(self, device, latency=None, kind=None, start=None):
+        with self._lock:
+            if latency is not None:
+                running, dispatched = start
+                # the calls running when it started, and those started since
+                concurrency = running + self._dispatched[device] - dispatched
+                self._limits[device].add_sample(latency, kind, concurrency)
+            self._running[device] -= 1
+            ready = self._pop_ready(device)
+            if not self._queues and not any(self._running.values()):
+                self._idle.notify_all()
+        self._dispatch(device, ready)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """
+        Shut the executor down, once the waiting calls were dispatched
+        if wait is set, or cancelling them with cancel_futures.
+        """
+        with self._lock:
+            waiting = []
+            if cancel_futures:
+                for queue in self._queues.values():
+                    waiting.extend(call[0] for call in queue)
+                self._queues.clear()
+            elif wait:
+                while self._queues:
+                    self._idle.wait()
+        for future in waiting:
+            future.cancel()
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class PathSerializer:
+    """
+    Executor wrapper running the calls of a file one after the other.
+    submit(function, filepath, *args) has the signature of IOScheduler.submit.
+    A call submitted while an earlier call of the same file is pending,
+    e.g. from another batch, is passed to the executor once that one is done,
+    so two calls never write a file at once, and they write it in the order
+    they were submitted. The future of such a call can be cancelled until then.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        # absolute path -> future done once the last call of the file is over
+        self._turns = {}
+        # futures of the calls waiting for an earlier call of their file
+        self._waiting = set()
+        # reentrant, as a failing submit may run the callbacks of other calls
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+    def submit(self, function, filepath, *args, **kwargs):
+        key = os.path.abspath(filepath)
+        with self._lock:
+            previous = self._turns.get(key)
+            if previous is None:
+                future = turn = self.executor.submit(
+                    function, filepath, *args, **kwargs
+                )
+            else:
+                # the call's future can be cancelled while it waits,
+                # its turn is only over once the previous one is
+                future, turn = Future(), Future()
+                self._waiting.add(future)
+            self._turns[key] = turn
+        turn.add_done_callback(partial(self._end_turn, key, turn))
+        if previous is not None:
+            previous.add_done_callback(
+                partial(self._start, future, turn, function, filepath, args, kwargs)
+            )
+        return future
+
+    def _start(self, future, turn, function, filepath, args, kwargs, previous):
+        with self._lock:
+            self._waiting.discard(future)
+        if not future.set_running_or_notify_cancel():
+            turn.set_result(None)
+            return
+        try:
+            executor_future = self.executor.submit(function, filepath, *args, **kwargs)
+        except Exception as exc:
+            # e.g. the executor was shut down
+            future.set_exception(exc)
+            turn.set_result(None)
+            return
+        executor_future.add_done_callback(partial(self._on_call_done, future, turn))
+
+    @staticmethod
+    def _on_call_done(future, turn, executor_future):
+        if executor_future.cancelled():
+            future.set_exception(CancelledError())
+        elif executor_future.exception() is not None:
+            future.set_exception(executor_future.exception())
+        else:
+            future.set_result(executor_future.result())
+        turn.set_result(None)
+
+    def _end_turn(self, key, turn, _):
+        with self._lock:
+            if self._turns.get(key) is turn:
+                del self._turns[key]
+                if not self._turns:
+                    self._idle.notify_all()
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """
+        Shut the executor down, once the calls waiting for an earlier call
+        of their file were passed to it if wait is set, or cancelling them
+        with cancel_futures.
+        """
+        with self._lock:
+            waiting = list(self._waiting) if cancel_futures else []
+        for future in waiting:
+            future.cancel()
+        if wait and not cancel_futures:
+            with self._lock:
+                while self._turns:
+                    self._idle.wait()
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,131 @@
+"""
+Model of the files selected in the GUI.
+A single instance is shared by reference between the file explorer
+and the input groups, and updated incrementally, so that selecting one more file
+among thousands doesn't cost work proportional to the whole selection.
+"""
+
+import os
+from collections import Counter
+
+
+def format_size(size):
+    if size < 1024:
+        return "{} B".format(size)
+    for unit in ("KB", "MB", "GB", "TB"):
+        size /= 1024
+        if size < 1024 or unit == "TB":
+            return "{:.1f} {}".format(size, unit)
+
+
+class SelectionModel:
+    """
+    Ordered set of selected file paths.
+    Keeps a summary of the selection (file count, total size, count per format)
+    up to date as paths are added and removed, and notifies bound listeners.
+    """
+
+    def __init__(self):
+        # path -> (size, format)
+        self._entries = {}
+        self.total_size = 0
+        self.format_counts = Counter()
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    @property
+    def single_path(self):
+        """The selected path if exactly one file is selected, otherwise None."""
+        if len(self._entries) != 1:
+            return None
+        return next(iter(self._entries))
+
+    def bind(self, listener):
+        """Register a callable, called with the model after every change."""
+        self._listeners.append(listener)
+
+    def unbind(self, listener):
+        self._listeners.remove(listener)
+
+    def add(self, path, size=None):
+        if self._add(path, size):
+            self._notify()
+
+    def remove(self, path):
+        if self._remove(path):
+            self._notify()
+
+    def clear(self):
+        if not self._entries:
+            return
+        self._entries.clear()
+        self.total_size = 0
+        self.format_counts.clear()
+        self._notify()
+
+    def replace(self, paths):
+        """
+        Make the selection match the given paths,
+        only adding and removing the paths which differ.
+        """
+        paths = dict.fromkeys(paths)
+        changed = False
+        for path in [path for path in self._entries if path not in paths]:
+            changed = self._remove(path) or changed
+        for path in paths:
+            changed = self._add(path) or changed
+        if changed:
+            self._notify()
+
+    def summary(self):
+        """Human readable summary, e.g. "3 files, 24.1 MB (2 MP3, 1 FLAC)"."""
+        count = len(self._entries)
+        if count == 0:
+            return ""
+        if count == 1:
+            return "{} ({})".format(
+                os.path.basename(self.single_path), format_size(self.total_size)
+            )
+        formats = ", ".join(
+            "{} {}".format(format_count, file_format)
+            for file_format, format_count in self.format_counts.most_common()
+        )
+        text = "{} files, {}".format(count, format_size(self.total_size))
+        return "{} ({})".format(text, formats) if formats else text
+
+    def _add(self, path, size=None):
+        if path in self._entries:
+            return False
+        if size is None:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                size = 0
+        file_format = os.path.splitext(path)[1].lstrip(".").upper() or "?"
+        self._entries[path] = (size, file_format)
+        self.total_size += size
+        self.format_counts[file_format] += 1
+        return True
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return False
+        size, file_format = entry
+        self.total_size -= size
+        self.format_counts[file_format] -= 1
+        if not self.format_counts[file_format]:
+            del self.format_counts[file_format]
+        return True
+
+    def _notify(self):
+        for listener in self._listeners:
+            listener(self)
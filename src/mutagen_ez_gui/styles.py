@@ -28,9 +28,9 @@ file_chooser_file_icon_entry_styles = """
             size: root.size
             source: 'atlas://data/images/defaulttheme/filechooser_selected'
 
-    Image:
+    CoverThumbnail:
         size: '48dp', '48dp'
-        source: 'assets/folder-img.png'
+        audio_path: ctx.path
         pos: root.x + dp(50), root.y + dp(60)
     Label:
         text: ctx.name
@@ -49,3 +49,41 @@ file_chooser_file_icon_entry_styles = """
         pos: root.x + dp(22), root.y
         halign: 'center'
 """
+
+audio_file_browser_styles = """
+<BrowserRecycleView>:
+    RecycleBoxLayout:
+        default_size: None, dp(28)
+        default_size_hint: 1, None
+        size_hint_y: None
+        height: self.minimum_height
+        orientation: 'vertical'
+
+<BrowserEntry>:
+    orientation: 'horizontal'
+    padding: dp(6), 0
+    canvas.before:
+        Color:
+            rgba: (0.3, 0.45, 0.7, 1) if self.selected else (0, 0, 0, 0)
+        Rectangle:
+            pos: self.pos
+            size: self.size
+    CoverThumbnail:
+        audio_path: '' if root.is_dir else root.path
+        audio_mtime_ns: root.mtime_ns
+        size_hint_x: None
+        width: dp(24)
+    Label:
+        text: root.name
+        bold: root.is_dir
+        text_size: self.size
+        halign: 'left'
+        valign: 'middle'
+        shorten: True
+    Label:
+        text: root.size_text
+        size_hint_x: None
+        width: dp(90)
+        font_size: '11sp'
+        color: .8, .8, .8, 1
+"""
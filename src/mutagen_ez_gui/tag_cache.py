@@ -0,0 +1,92 @@
+"""
+In-memory LRU cache of the metadata read from files.
+Entries are keyed by the file path and validated against the file's
+modification time and size, so a repeated read of an unchanged file
+only costs a stat() call instead of a full parse.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from metadata_readers import read_metadata
+
+
+class TagCache:
+    """
+    Bounded LRU cache of file path -> metadata tags.
+    Each entry stores the (st_mtime_ns, st_size) signature the tags were read at;
+    an entry whose signature doesn't match the file anymore is treated as a miss.
+    When the cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size=2048, loader=read_metadata):
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1")
+        self.max_size = max_size
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_signature(filepath):
+        try:
+            stat_result = os.stat(filepath)
+        except OSError:
+            return None
+        return (stat_result.st_mtime_ns, stat_result.st_size)
+
+    def get(self, filepath):
+        """Return the tags of the file, reading them only if not cached."""
+        signature = self.get_signature(filepath)
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and signature is not None and entry[0] == signature:
+                self._entries.move_to_end(filepath)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        tags = self.loader(filepath)
+        if signature is not None:
+            self.put(filepath, tags, signature)
+        return tags
+
+    def put(self, filepath, tags, signature=None):
+        """Store the tags of the file, e.g. right after writing them."""
+        signature = signature or self.get_signature(filepath)
+        if signature is None:
+            self.invalidate(filepath)
+            return
+        with self._lock:
+            self._entries[filepath] = (signature, tags)
+            self._entries.move_to_end(filepath)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, filepath):
+        with self._lock:
+            self._entries.pop(filepath, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        """Counters useful for tuning the cache size."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
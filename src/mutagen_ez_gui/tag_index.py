@@ -0,0 +1,257 @@
+"""
+Persistent SQLite index of the displayed metadata tags of audio files.
+The index stores each file's absolute path, modification time, size, format
+and the tags shown in the metadata display panel, so that tags can be looked up
+without touching the files.
+Directory scans are incremental: only files whose mtime or size changed
+since the last scan are parsed again, using a pool of workers.
+"""
+
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from engine import DEFAULT_MAX_WORKERS, get_executor_class
+from metadata_readers import METADATA_KEYS, is_audio_file, read_file_info
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT,
+    artist TEXT,
+    album TEXT,
+    title TEXT,
+    date TEXT,
+    tracknumber TEXT
+)
+"""
+UNKNOWN = "Unknown"
+
+
+@dataclass
+class ScanResult:
+    """Counts of what an incremental scan did to the index."""
+
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    failed: int = 0
+
+
+def to_index_value(value):
+    """Convert a displayed tag value to the string stored in the index."""
+    if isinstance(value, list):
+        value = ", ".join(str(item) for item in value)
+    return None if value == UNKNOWN else value
+
+
+def get_index_path(filepath):
+    """
+    Path a file is indexed under, absolute like the paths scan stores,
+    so that a file given by a relative path isn't indexed twice.
+    """
+    return os.path.abspath(filepath)
+
+
+def read_index_entry(filepath):
+    """Stat and parse a file, returning a row ready to be stored in the index."""
+    stat_result = os.stat(filepath)
+    format_name, tags = read_file_info(filepath)
+    return (
+        get_index_path(filepath),
+        stat_result.st_mtime_ns,
+        stat_result.st_size,
+        format_name,
+        *(to_index_value(tags[key]) for key in METADATA_KEYS),
+    )
+
+
+def iter_audio_files(root):
+    """Recursively yield (path, stat result) of the audio files under root."""
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file() and is_audio_file(entry.name):
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+
+class TagIndex:
+    """
+    SQLite-backed index of file tags.
+    Safe to use from several threads - each thread gets its own connection.
+    """
+
+    columns = ("path", "mtime_ns", "size", "format") + METADATA_KEYS
+
+    def __init__(self, database_path, max_workers=None, use_processes=False):
+        self.database_path = database_path
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.use_processes = use_processes
+        self._local = threading.local()
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def get(self, filepath):
+        """Return the indexed row of a file as a dict, or None if not indexed."""
+        row = self.connection.execute(
+            "SELECT {} FROM files WHERE path = ?".format(", ".join(self.columns)),
+            (get_index_path(filepath),),
+        ).fetchone()
+        return dict(zip(self.columns, row)) if row else None
+
+    def get_metadata(self, filepath):
+        """
+        Return the indexed tags of a file in the display panel's format,
+        or None if the file isn't indexed or changed since it was indexed.
+        """
+        row = self.get(filepath)
+        if row is None:
+            return None
+        try:
+            stat_result = os.stat(filepath)
+        except OSError:
+            return None
+        if (stat_result.st_mtime_ns, stat_result.st_size) != (
+            row["mtime_ns"],
+            row["size"],
+        ):
+            return None
+        return {key: row[key] or UNKNOWN for key in METADATA_KEYS}
+
+    def read_metadata(self, filepath):
+        """
+        Return the tags of a file from the index,
+        parsing the file and indexing it only when it's missing or stale.
+        """
+        tags = self.get_metadata(filepath)
+        if tags is not None:
+            return tags
+        try:
+            entry = read_index_entry(filepath)
+        except OSError:
+            return {key: UNKNOWN for key in METADATA_KEYS}
+        self._store([entry])
+        return {key: value or UNKNOWN for key, value in zip(METADATA_KEYS, entry[4:])}
+
+    def query(self, **filters):
+        """
+        Yield indexed rows as dicts, filtered by exact column values,
+        e.g. index.query(album="Abbey Road").
+        """
+        unknown_columns = set(filters) - set(self.columns)
+        if unknown_columns:
+            raise ValueError(
+                "Unknown index columns: {}".format(", ".join(sorted(unknown_columns)))
+            )
+        sql = "SELECT {} FROM files".format(", ".join(self.columns))
+        if filters:
+            sql += " WHERE " + " AND ".join("{} = ?".format(key) for key in filters)
+        for row in self.connection.execute(
+            sql + " ORDER BY path", tuple(filters.values())
+        ):
+            yield dict(zip(self.columns, row))
+
+    def update_file(self, filepath):
+        """
+        Parse a file and store its current tags in the index,
+        e.g. after they were written. Only the tags are parsed, see tag_reader.py.
+        """
+        self._store([read_index_entry(filepath)])
+
+    def remove(self, filepath):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM files WHERE path = ?", (get_index_path(filepath),)
+            )
+
+    def scan(self, root, on_progress=None):
+        """
+        Incrementally index all audio files under the root directory.
+        Only new files and files whose mtime or size changed are parsed,
+        in parallel; files which disappeared are removed from the index.
+        on_progress(done, total) is called as changed files are parsed.
+        """
+        root = get_index_path(root)
+        result = ScanResult()
+        indexed = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.connection.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE path >= ? AND path < ?",
+                (root + os.sep, root + chr(ord(os.sep) + 1)),
+            )
+        }
+        to_parse = []
+        for filepath, stat_result in iter_audio_files(root):
+            signature = indexed.pop(filepath, None)
+            if signature is None:
+                result.added += 1
+                to_parse.append(filepath)
+            elif signature != (stat_result.st_mtime_ns, stat_result.st_size):
+                result.updated += 1
+                to_parse.append(filepath)
+            else:
+                result.unchanged += 1
+        entries = []
+        executor_class = get_executor_class(self.use_processes)
+        with executor_class(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(read_index_entry, path) for path in to_parse]
+            for done, future in enumerate(futures, start=1):
+                try:
+                    entries.append(future.result())
+                except Exception:
+                    result.failed += 1
+                if len(entries) >= 500:
+                    self._store(entries)
+                    entries = []
+                if on_progress:
+                    on_progress(done, len(futures))
+        self._store(entries)
+        if indexed:
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM files WHERE path = ?",
+                    ((path,) for path in indexed),
+                )
+            result.removed = len(indexed)
+        return result
+
+    def _store(self, entries):
+        if not entries:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+                    ", ".join(self.columns), ", ".join("?" * len(self.columns))
+                ),
+                entries,
+            )
@@ -0,0 +1,429 @@
+"""
+Tag-only reader of the displayed metadata tags.
+mutagen.File also parses the audio stream info (e.g. an MPEG frame sync search
+for MP3 files, the whole atom tree for MP4 files), while the metadata display
+only needs a few text tags. This reader only parses the tag structures:
+    - MP3: the ID3v2 header and text frames;
+    - FLAC: the VORBIS_COMMENT metadata block;
+    - Ogg Vorbis/Opus: the comment header packet;
+    - MP4: the moov/udta/meta/ilst atom;
+    - WAV: the "id3 " chunk.
+Files are accessed through memoryview slices, over an mmap for large files,
+so only the byte ranges holding the tags are actually read.
+Files using features this reader doesn't handle (e.g. compressed ID3 frames,
+ID3v1 tags) raise UnsupportedTags, so callers can fall back to mutagen.
+"""
+
+import mmap
+import os
+import re
+import struct
+
+from formats import CONTAINER_MAGIC_NUMBERS
+
+# files at least this large are mapped instead of read whole
+MMAP_THRESHOLD = 64 * 1024
+
+UNKNOWN = "Unknown"
+
+ID3_KEY_TO_FRAME_ID = {
+    "artist": b"TPE1",
+    "album": b"TALB",
+    "title": b"TIT2",
+    "date": b"TDRC",
+    "tracknumber": b"TRCK",
+}
+# ID3v2.3 date frames, which mutagen converts to TDRC
+ID3_OLD_DATE_FRAME_IDS = (b"TYER", b"TDAT", b"TIME")
+ID3_FRAME_IDS = frozenset(ID3_KEY_TO_FRAME_ID.values()) | set(ID3_OLD_DATE_FRAME_IDS)
+# compression, encryption, grouping, unsynchronisation, data length indicator
+ID3_UNSUPPORTED_FRAME_FLAGS = {3: 0x00E0, 4: 0x004F}
+ID3_TEXT_ENCODINGS = {
+    0: ("latin1", b"\x00"),
+    1: ("utf16", b"\x00\x00"),
+    2: ("utf_16_be", b"\x00\x00"),
+    3: ("utf8", b"\x00"),
+}
+ID3_FRAME_ID_PATTERN = re.compile(rb"[A-Z0-9]{4}\Z")
+# dates mutagen's ID3TimeStamp keeps as they are
+ID3_DATE_PATTERN = re.compile(r"[0-9]{4}(-[0-9]{2}(-[0-9]{2})?)?\Z")
+ID3V1_SEARCH_SIZE = 128 + len(b"APE")
+
+MP4_KEY_TO_ATOM_NAME = {
+    "artist": b"\xa9ART",
+    "album": b"\xa9alb",
+    "title": b"\xa9nam",
+    "date": b"\xa9day",
+    "tracknumber": b"trkn",
+}
+MP4_ATOM_NAME_TO_KEY = {name: key for key, name in MP4_KEY_TO_ATOM_NAME.items()}
+# implicit and UTF-8 data atoms
+MP4_TEXT_DATA_TYPES = (0, 1)
+
+# longest Vorbis comment field name looked at
+VORBIS_MAX_KEY_SIZE = 64
+
+
+class UnsupportedTags(ValueError):
+    """The file's tags can't be read without mutagen."""
+
+
+def unknown_tags():
+    return {key: UNKNOWN for key in ID3_KEY_TO_FRAME_ID}
+
+
+def read_tags(filepath):
+    """
+    Read the format name and the displayed metadata tags of a file,
+    in the same shape as metadata_readers.read_file_info.
+    Raises UnsupportedTags if the file's format or tags need mutagen.
+    """
+    reader = EXTENSION_TO_READER.get(os.path.splitext(filepath)[1].lower())
+    if reader is None:
+        raise UnsupportedTags("Unsupported file type: {}".format(filepath))
+    with open(filepath, "rb") as fileobj:
+        size = os.fstat(fileobj.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            return read_view(reader, memoryview(fileobj.read()))
+        mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return read_view(reader, memoryview(mapping))
+        finally:
+            try:
+                mapping.close()
+            except BufferError:
+                # a slice still references the mapping,
+                # it's closed when garbage collected
+                pass
+
+
+def read_view(reader, view):
+    try:
+        return reader(view)
+    except (struct.error, IndexError, ValueError) as exc:
+        # malformed or truncated structures, mutagen knows best
+        if isinstance(exc, UnsupportedTags):
+            raise
+        raise UnsupportedTags(str(exc)) from None
+
+
+def read_syncsafe_int(view, offset):
+    value = 0
+    (data,) = struct.unpack_from("4s", view, offset)
+    for byte in data:
+        if byte & 0x80:
+            raise UnsupportedTags("Invalid syncsafe integer")
+        value = (value << 7) | byte
+    return value
+
+
+def find_aligned(data, terminator, step):
+    index = data.find(terminator)
+    while index != -1 and index % step:
+        index = data.find(terminator, index + 1)
+    return index
+
+
+def decode_id3_text(data, version):
+    """Decode a text frame's payload into its list of values, like mutagen."""
+    if not data:
+        return []
+    encoding = data[0]
+    if encoding not in ID3_TEXT_ENCODINGS:
+        raise UnsupportedTags("Unknown text encoding {}".format(encoding))
+    codec, terminator = ID3_TEXT_ENCODINGS[encoding]
+    data = data[1:]
+    if len(terminator) == 2 and len(data) % 2:
+        raise UnsupportedTags("Odd length UTF-16 text")
+    values = []
+    while data:
+        index = find_aligned(data, terminator, len(terminator))
+        if index == -1:
+            value, data = data, b""
+        else:
+            value_end = index + len(terminator)
+            value, data = data[:index], data[value_end:]
+        values.append(value.decode(codec))
+        # older versions didn't support several values, zero padding isn't one
+        if version < 4 and not data.strip(b"\x00"):
+            data = b""
+    return values
+
+
+def read_id3_frames(view, offset=0):
+    """
+    Read the text frames of the displayed tags from an ID3v2 tag.
+    Returns a dict of frame id -> list of values, and the offset after the tag.
+    """
+    if struct.unpack_from("3s", view, offset)[0] != b"ID3":
+        raise UnsupportedTags("No ID3 header")
+    version, flags = view[offset + 3], view[offset + 5]
+    # unsynchronisation and extended headers are rare, leave them to mutagen
+    if version not in (3, 4) or flags & 0xC0:
+        raise UnsupportedTags("Unsupported ID3 version or flags")
+    end = offset + 10 + read_syncsafe_int(view, offset + 6)
+    if end > len(view):
+        raise UnsupportedTags("Truncated ID3 tag")
+    if version == 4 and flags & 0x10:
+        end += 10
+    frames = {}
+    position = offset + 10
+    while position + 10 <= end:
+        (frame_id,) = struct.unpack_from("4s", view, position)
+        if frame_id[0] == 0:
+            # padding
+            break
+        if not ID3_FRAME_ID_PATTERN.match(frame_id):
+            raise UnsupportedTags("Invalid ID3 frame id {!r}".format(frame_id))
+        if version == 4:
+            frame_size = read_syncsafe_int(view, position + 4)
+        else:
+            (frame_size,) = struct.unpack_from(">I", view, position + 4)
+        (frame_flags,) = struct.unpack_from(">H", view, position + 8)
+        data_start = position + 10
+        position = data_start + frame_size
+        if position > end:
+            raise UnsupportedTags("Truncated ID3 frame")
+        # mutagen drops empty frames
+        if frame_id not in ID3_FRAME_IDS or frame_size == 0:
+            continue
+        if frame_flags & ID3_UNSUPPORTED_FRAME_FLAGS[version] or frame_id in frames:
+            raise UnsupportedTags("Unsupported ID3 frame {!r}".format(frame_id))
+        frames[frame_id] = decode_id3_text(bytes(view[data_start:position]), version)
+    return update_id3_date_frames(frames), end
+
+
+def update_id3_date_frames(frames):
+    """
+    Convert ID3v2.3 year frames to TDRC as mutagen does,
+    leaving anything but plain dates to mutagen.
+    """
+    years = frames.pop(b"TYER", None)
+    if frames.pop(b"TDAT", None) or frames.pop(b"TIME", None):
+        raise UnsupportedTags("ID3v2.3 TDAT or TIME frame")
+    dates = frames.get(b"TDRC")
+    if dates is None and years:
+        dates = frames[b"TDRC"] = [year for year in years if year]
+    for date in dates or ():
+        if not ID3_DATE_PATTERN.match(date):
+            raise UnsupportedTags("Date needing normalization")
+    return frames
+
+
+def read_mp3_tags(view):
+    if bytes(view[-ID3V1_SEARCH_SIZE:]).find(b"TAG") != -1:
+        # mutagen merges ID3v1 tags in
+        raise UnsupportedTags("ID3v1 tag")
+    frames, audio_start = {}, 0
+    if view[:3] == b"ID3":
+        frames, audio_start = read_id3_frames(view)
+    (header,) = struct.unpack_from("12s", view, audio_start)
+    if header.startswith(CONTAINER_MAGIC_NUMBERS) or header[4:8] == b"ftyp":
+        raise UnsupportedTags("Not an MP3 file")
+    tags = unknown_tags()
+    for key, frame_id in ID3_KEY_TO_FRAME_ID.items():
+        if frame_id in frames:
+            tags[key] = frames[frame_id]
+    return "MP3", tags
+
+
+def read_wave_tags(view):
+    if view[:4] != b"RIFF" or view[8:12] != b"WAVE":
+        raise UnsupportedTags("Not a WAVE file")
+    tags = unknown_tags()
+    position = 12
+    while position + 8 <= len(view):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", view, position)
+        if chunk_id in (b"id3 ", b"ID3 "):
+            frames, _ = read_id3_frames(view, position + 8)
+            for key, frame_id in ID3_KEY_TO_FRAME_ID.items():
+                if frame_id in frames:
+                    tags[key] = frames[frame_id]
+            break
+        position += 8 + chunk_size + chunk_size % 2
+    return "WAVE", tags
+
+
+def read_vorbis_comment(view, tags):
+    """Add the displayed tags of a Vorbis comment to the tags dict."""
+    (vendor_size,) = struct.unpack_from("<I", view, 0)
+    position = 4 + vendor_size
+    (count,) = struct.unpack_from("<I", view, position)
+    position += 4
+    values = {}
+    for _ in range(count):
+        (size,) = struct.unpack_from("<I", view, position)
+        position += 4
+        end = position + size
+        if end > len(view):
+            raise UnsupportedTags("Truncated Vorbis comment")
+        # only look at the field name, e.g. embedded pictures aren't copied
+        head_end = min(end, position + VORBIS_MAX_KEY_SIZE)
+        head = bytes(view[position:head_end])
+        separator = head.find(b"=")
+        if separator > 0:
+            key = head[:separator].decode("ascii", "replace").lower()
+            if key in tags:
+                value_start = position + separator + 1
+                values.setdefault(key, []).append(
+                    str(view[value_start:end], "utf-8", "replace")
+                )
+        position = end
+    tags.update(values)
+    return tags
+
+
+def read_flac_tags(view):
+    position = 0
+    if view[:3] == b"ID3":
+        position = 10 + read_syncsafe_int(view, 6)
+    if struct.unpack_from("4s", view, position)[0] != b"fLaC":
+        raise UnsupportedTags("Not a FLAC file")
+    position += 4
+    tags = unknown_tags()
+    while position + 4 <= len(view):
+        block_header = view[position]
+        (block_size,) = struct.unpack_from(">I", view, position)
+        block_size &= 0xFFFFFF
+        position += 4
+        block_end = position + block_size
+        if block_header & 0x7F == 4:
+            return "FLAC", read_vorbis_comment(view[position:block_end], tags)
+        if block_header & 0x80:
+            # last metadata block
+            break
+        position = block_end
+    return "FLAC", tags
+
+
+def iter_ogg_pages(view):
+    """Yield (serial, lacing values, data offset) of the pages of an Ogg stream."""
+    position = 0
+    while position + 27 <= len(view):
+        capture_pattern, serial, segments = struct.unpack_from(
+            "<4s10xI8xB", view, position
+        )
+        if capture_pattern != b"OggS":
+            raise UnsupportedTags("Invalid Ogg page")
+        lacing_start = position + 27
+        data_start = lacing_start + segments
+        lacing_values = view[lacing_start:data_start]
+        yield serial, lacing_values, data_start
+        position = data_start + sum(lacing_values)
+
+
+def read_ogg_packets(view, count):
+    """
+    Return the first packets of the first logical stream of an Ogg file.
+    Packets contained in a single page are zero-copy slices of the view.
+    """
+    packets = []
+    pieces = []
+    first_serial = None
+    for serial, lacing_values, position in iter_ogg_pages(view):
+        if first_serial is None:
+            first_serial = serial
+        elif serial != first_serial:
+            continue
+        piece_start = position
+        for lacing_value in lacing_values:
+            position += lacing_value
+            if lacing_value < 255:
+                pieces.append(view[piece_start:position])
+                if len(pieces) == 1:
+                    packets.append(pieces[0])
+                else:
+                    packets.append(memoryview(b"".join(pieces)))
+                if len(packets) == count:
+                    return packets
+                pieces = []
+                piece_start = position
+        if piece_start < position:
+            pieces.append(view[piece_start:position])
+    raise UnsupportedTags("Truncated Ogg stream")
+
+
+def read_ogg_tags(view):
+    header, comment = read_ogg_packets(view, 2)
+    if header[:7] == b"\x01vorbis" and comment[:7] == b"\x03vorbis":
+        return "OggVorbis", read_vorbis_comment(comment[7:], unknown_tags())
+    if header[:8] == b"OpusHead" and comment[:8] == b"OpusTags":
+        return "OggOpus", read_vorbis_comment(comment[8:], unknown_tags())
+    raise UnsupportedTags("Not an Ogg Vorbis or Opus file")
+
+
+def find_mp4_atom(view, name, start, end):
+    """Return the (data start, end) of the first atom with the name in a range."""
+    position = start
+    while position + 8 <= end:
+        size, atom_name = struct.unpack_from(">I4s", view, position)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", view, position + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size or position + size > end:
+            raise UnsupportedTags("Invalid MP4 atom size")
+        if atom_name == name:
+            return position + header_size, position + size
+        position += size
+    return None
+
+
+def read_mp4_tags(view):
+    if view[4:8] != b"ftyp":
+        raise UnsupportedTags("Not an MP4 file")
+    tags = unknown_tags()
+    atom = (0, len(view))
+    # the meta atom's children follow its version and flags
+    for name, skip in ((b"moov", 0), (b"udta", 0), (b"meta", 4), (b"ilst", 0)):
+        atom = find_mp4_atom(view, name, atom[0], atom[1])
+        if atom is None:
+            return "MP4", tags
+        atom = (atom[0] + skip, atom[1])
+    position, ilst_end = atom
+    seen = set()
+    while position + 8 <= ilst_end:
+        size, atom_name = struct.unpack_from(">I4s", view, position)
+        if size < 8 or position + size > ilst_end:
+            raise UnsupportedTags("Invalid MP4 atom size")
+        key = MP4_ATOM_NAME_TO_KEY.get(atom_name)
+        if key is not None:
+            if key in seen:
+                raise UnsupportedTags("Duplicated MP4 atom")
+            seen.add(key)
+            tags[key] = read_mp4_values(view, atom_name, position + 8, position + size)
+        position += size
+    return "MP4", tags
+
+
+def read_mp4_values(view, atom_name, position, end):
+    values = []
+    while position < end:
+        size, name, data_type = struct.unpack_from(">I4sI", view, position)
+        if name != b"data" or size < 16 or position + size > end:
+            raise UnsupportedTags("Invalid MP4 data atom")
+        data_start, data_end = position + 16, position + size
+        data = view[data_start:data_end]
+        if atom_name == b"trkn":
+            track, total = struct.unpack_from(">2H", data, 2)
+            values.append("{}/{}".format(track, total) if total else str(track))
+        elif data_type & 0xFFFFFF in MP4_TEXT_DATA_TYPES:
+            values.append(str(data, "utf-8"))
+        else:
+            raise UnsupportedTags("Unsupported MP4 data type")
+        position += size
+    return values
+
+
+EXTENSION_TO_READER = {
+    ".mp3": read_mp3_tags,
+    ".flac": read_flac_tags,
+    ".ogg": read_ogg_tags,
+    ".oga": read_ogg_tags,
+    ".opus": read_ogg_tags,
+    ".m4a": read_mp4_tags,
+    ".mp4": read_mp4_tags,
+    ".wav": read_wave_tags,
+}
@@ -0,0 +1,319 @@
+"""
+Thumbnails of the covers embedded in audio files, shown by the file browsers.
+Covers are extracted and scaled down by a small pool of worker threads,
+most recently requested first, so that the rows scrolled into view
+are served before the ones scrolled past.
+Thumbnails are stored in a size-bounded on-disk cache keyed by the file's path,
+mtime and size, so revisiting a directory doesn't parse its files again.
+Files without a cover are cached too, as empty entries.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from covers import encode_cover
+from metadata_setters import get_metadata_setter
+from mutagen import MutagenError
+
+THUMBNAIL_SIZE = (96, 96)
+THUMBNAIL_QUALITY = 80
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024
+# decoding covers is CPU bound, and the GUI thread needs its share
+DEFAULT_MAX_WORKERS = 2
+THUMBNAIL_EXTENSION = ".jpg"
+# counted for every entry on top of its size, so that the empty entries
+# of files without cover don't pile up either
+ENTRY_OVERHEAD_BYTES = 512
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_cache_directory():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "mutagen_ez_gui", "thumbnails")
+
+
+def read_embedded_cover(filepath):
+    """
+    Return the image data of the cover embedded in an audio file, or None.
+    Reads the front cover the metadata setters write (ID3 APIC, MP4 covr,
+    Vorbis metadata_block_picture), falling back to FLAC's native pictures.
+    """
+    metadata_setter = get_metadata_setter(filepath, {})
+    cover = metadata_setter.get_current_cover()
+    if cover is None:
+        pictures = getattr(metadata_setter.filething, "pictures", None)
+        if pictures:
+            cover = pictures[0].data
+    return None if cover is None else bytes(cover)
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """Scale cover image data down to a JPEG thumbnail."""
+    return encode_cover(io.BytesIO(data), size, quality)
+
+
+class ThumbnailCache:
+    """
+    On-disk LRU cache of cover thumbnails, bounded by the total size of the files.
+    An entry is a JPEG file named after the hash of
+    (file path, st_mtime_ns, st_size, thumbnail size), so an entry of a file
+    which changed is never hit again, and ages out of the cache.
+    The directory is only listed when the cache is first used.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        # entry name -> size, least recently used first
+        self._entries = None
+        # file path -> its latest entry name, see invalidate
+        self._names_by_path = {}
+        self._lock = threading.Lock()
+
+    def _load_entries(self):
+        """List the existing entries, ordered by their last use. Callers hold the lock."""
+        if self._entries is not None:
+            return
+        entries = []
+        try:
+            with os.scandir(self.directory) as iterator:
+                for entry in iterator:
+                    if entry.name.endswith(THUMBNAIL_EXTENSION):
+                        stat_result = entry.stat()
+                        entries.append(
+                            (stat_result.st_mtime_ns, entry.name, stat_result.st_size)
+                        )
+        except FileNotFoundError:
+            pass
+        entries.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in entries)
+        self.total_bytes = sum(self._entries.values())
+
+    @staticmethod
+    def get_entry_name(filepath, stat_result, size=THUMBNAIL_SIZE):
+        key = "\0".join(
+            (
+                os.path.abspath(filepath),
+                str(stat_result.st_mtime_ns),
+                str(stat_result.st_size),
+                "{}x{}".format(*size),
+            )
+        )
+        digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+        return digest + THUMBNAIL_EXTENSION
+
+    def get_entry_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lookup(self, filepath, name):
+        """
+        Return (True, thumbnail path or None if the file has no cover) on a hit,
+        (False, None) on a miss.
+        """
+        with self._lock:
+            self._load_entries()
+            size = self._entries.get(name)
+            if size is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(name)
+            self._names_by_path[os.path.abspath(filepath)] = name
+            self.hits += 1
+        entry_path = self.get_entry_path(name)
+        try:
+            # the mtime of the entries records their last use, across runs
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(name)
+            return False, None
+        return True, entry_path if size else None
+
+    def put(self, filepath, name, thumbnail):
+        """Store a thumbnail (b"" for a file without cover), returning its path."""
+        os.makedirs(self.directory, exist_ok=True)
+        # written aside and renamed, so a reader never sees a partial thumbnail
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as thumbnail_file:
+            thumbnail_file.write(thumbnail)
+        entry_path = self.get_entry_path(name)
+        os.replace(temporary_path, entry_path)
+        with self._lock:
+            self._load_entries()
+            self._forget(name)
+            self._entries[name] = len(thumbnail)
+            self.total_bytes += len(thumbnail)
+            self._names_by_path[os.path.abspath(filepath)] = name
+            evicted = self._evict()
+        for evicted_name in evicted:
+            try:
+                os.remove(self.get_entry_path(evicted_name))
+            except FileNotFoundError:
+                pass
+        return entry_path if thumbnail else None
+
+    def _forget(self, name):
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        """
+        Drop the least recently used entries until the cache fits in max_bytes,
+        returning their names.
+        """
+        evicted = []
+        while (
+            self._entries
+            and self.total_bytes + len(self._entries) * ENTRY_OVERHEAD_BYTES
+            > self.max_bytes
+        ):
+            name, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def invalidate(self, filepath):
+        """Remove the latest thumbnail of a file, e.g. after its cover changed."""
+        with self._lock:
+            name = self._names_by_path.pop(os.path.abspath(filepath), None)
+            if name is None or self._entries is None:
+                return
+            self._forget(name)
+        try:
+            os.remove(self.get_entry_path(name))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._load_entries()
+            names = list(self._entries)
+            self._entries.clear()
+            self._names_by_path.clear()
+            self.total_bytes = 0
+        for name in names:
+            try:
+                os.remove(self.get_entry_path(name))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries or ()),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ThumbnailLoader:
+    """
+    Loads thumbnails in a pool of worker threads.
+    Pending requests are served last in first out, and can be cancelled,
+    e.g. when a browser row is recycled for another file before its turn.
+    Callbacks are called from the worker threads
+    with (file path, thumbnail path or None).
+    """
+
+    def __init__(self, cache, size=THUMBNAIL_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+        self.cache = cache
+        self.size = size
+        self.max_workers = max_workers
+        # file path -> callbacks, most recently requested last
+        self._pending = OrderedDict()
+        self._running = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def request(self, filepath, callback):
+        with self._lock:
+            self._pending.setdefault(filepath, []).append(callback)
+            self._pending.move_to_end(filepath)
+            if self._running >= self.max_workers:
+                return
+            self._running += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="thumbnails"
+                )
+        self._executor.submit(self._work)
+
+    def cancel(self, filepath, callback):
+        """Drop a pending request, no-op if it's already being loaded."""
+        with self._lock:
+            callbacks = self._pending.get(filepath)
+            if callbacks and callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self._pending[filepath]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running -= 1
+                    return
+                filepath, callbacks = self._pending.popitem(last=True)
+            try:
+                thumbnail_path = self.get_thumbnail(filepath)
+            except Exception:
+                logger.exception("Couldn't load the thumbnail of %s", filepath)
+                thumbnail_path = None
+            for callback in callbacks:
+                callback(filepath, thumbnail_path)
+
+    def get_thumbnail(self, filepath):
+        """Return the path of a file's cover thumbnail, or None if it has no cover."""
+        try:
+            stat_result = os.stat(filepath)
+        except OSError:
+            return None
+        name = self.cache.get_entry_name(filepath, stat_result, self.size)
+        found, thumbnail_path = self.cache.lookup(filepath, name)
+        if found:
+            return thumbnail_path
+        try:
+            cover = read_embedded_cover(filepath)
+        except (OSError, ValueError, MutagenError) as error:
+            # not cached, the file may be readable later
+            logger.debug("Couldn't read the cover of %s: %s", filepath, error)
+            return None
+        thumbnail = b""
+        if cover is not None:
+            try:
+                thumbnail = make_thumbnail(cover, self.size)
+            except (OSError, ValueError) as error:
+                # PIL.UnidentifiedImageError is an OSError
+                logger.debug("Couldn't decode the cover of %s: %s", filepath, error)
+        return self.cache.put(filepath, name, thumbnail)
+
+    def shutdown(self):
+        with self._lock:
+            self._pending.clear()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+# loader shared by the file browsers
+thumbnail_loader = ThumbnailLoader(ThumbnailCache(get_default_cache_directory()))
@@ -0,0 +1,341 @@
+"""
+Watching a directory for files changed by other programs.
+Changes are batched: a batch is posted once no change happened for `latency`
+seconds (or at most every `max_latency` seconds while changes keep coming),
+and the changes of a path within a batch are coalesced, e.g. a file created
+then written is reported once as added, and a temporary file created then
+removed isn't reported at all.
+On Linux, changes are read from inotify (through ctypes, no extra dependency),
+elsewhere the directory is polled: its mtime tells when files were added or
+removed, and the files are only stat'ed every `scan_interval` seconds
+to notice files modified in place.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+
+DEFAULT_LATENCY = 0.2
+DEFAULT_MAX_LATENCY = 1.0
+
+# inotify event masks, see inotify(7)
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+# files written in place are reported once they're closed, not on every write
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# struct inotify_event, followed by a null padded name of `len` bytes
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_BUFFER_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryChanges:
+    """
+    Coalesced changes of the files of a directory.
+    `rescan` is set when the changes couldn't be tracked,
+    e.g. the kernel's event queue overflowed or the directory was moved,
+    and the whole directory has to be listed again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rescan = False
+        # path -> ADDED, REMOVED or MODIFIED, in the order of the first change
+        self._kinds = {}
+
+    def __bool__(self):
+        return self.rescan or bool(self._kinds)
+
+    def __repr__(self):
+        return "DirectoryChanges({!r}, added={}, removed={}, modified={}{})".format(
+            self.directory,
+            len(self.added),
+            len(self.removed),
+            len(self.modified),
+            ", rescan" if self.rescan else "",
+        )
+
+    def add(self, path, kind):
+        """Record a change of a path, merged with its earlier changes."""
+        previous = self._kinds.get(path)
+        if previous is None:
+            self._kinds[path] = kind
+        elif previous == ADDED:
+            # added then modified is still added, added then removed never existed
+            if kind == REMOVED:
+                del self._kinds[path]
+        elif previous == REMOVED:
+            # e.g. replaced by renaming a temporary file over it
+            if kind != REMOVED:
+                self._kinds[path] = MODIFIED
+        elif kind == REMOVED:
+            self._kinds[path] = REMOVED
+
+    def get_paths(self, kind):
+        return [path for path, path_kind in self._kinds.items() if path_kind == kind]
+
+    @property
+    def added(self):
+        return self.get_paths(ADDED)
+
+    @property
+    def removed(self):
+        return self.get_paths(REMOVED)
+
+    @property
+    def modified(self):
+        return self.get_paths(MODIFIED)
+
+
+class DirectoryWatcher:
+    """
+    Base class of the watchers, running in a daemon thread.
+    The callback is called from the watcher's thread with DirectoryChanges.
+    """
+
+    def __init__(
+        self,
+        directory,
+        callback,
+        latency=DEFAULT_LATENCY,
+        max_latency=DEFAULT_MAX_LATENCY,
+    ):
+        self.directory = os.path.abspath(directory)
+        self.callback = callback
+        self.latency = latency
+        self.max_latency = max_latency
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name="watcher {}".format(self.directory),
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching; the callback may still be running with a last batch."""
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _run(self):
+        raise NotImplementedError
+
+    def _flush(self, changes):
+        if changes and not self.stopped:
+            try:
+                self.callback(changes)
+            except Exception:
+                logger.exception("Directory changes callback failed")
+        return DirectoryChanges(self.directory)
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    return libc
+
+
+_libc = None
+_libc_loaded = False
+
+
+def get_libc():
+    """Return the C library if it supports inotify, or None."""
+    global _libc, _libc_loaded
+    if not _libc_loaded:
+        _libc = _load_libc()
+        _libc_loaded = True
+    return _libc
+
+
+class InotifyWatcher(DirectoryWatcher):
+    """Watcher reading the directory's changes from inotify."""
+
+    # how often the thread checks whether it was stopped, when no change comes
+    stop_check_interval = 0.5
+
+    def __init__(self, directory, callback, **kwargs):
+        super().__init__(directory, callback, **kwargs)
+        libc = get_libc()
+        if libc is None:
+            raise OSError("inotify isn't available")
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        path = os.fsencode(self.directory)
+        if libc.inotify_add_watch(self._fd, path, WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), self.directory)
+
+    def _read_events(self, changes):
+        try:
+            data = os.read(self._fd, INOTIFY_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            name_start = offset + INOTIFY_EVENT.size
+            offset = name_start + name_length
+            name = data[name_start:offset].rstrip(b"\0")
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                changes.rescan = True
+                continue
+            if not name:
+                continue
+            path = os.path.join(self.directory, os.fsdecode(name))
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                changes.add(path, ADDED)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.add(path, REMOVED)
+            elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+                changes.add(path, MODIFIED)
+
+    def _run(self):
+        changes = DirectoryChanges(self.directory)
+        # time of the first and of the latest change of the pending batch
+        first_change = last_change = None
+        try:
+            while not self.stopped:
+                timeout = self.stop_check_interval
+                if first_change is not None:
+                    timeout = (
+                        min(last_change + self.latency, first_change + self.max_latency)
+                        - time.monotonic()
+                    )
+                if timeout > 0:
+                    readable, _, _ = select.select([self._fd], [], [], timeout)
+                    if readable:
+                        self._read_events(changes)
+                        last_change = time.monotonic()
+                        if first_change is None:
+                            first_change = last_change
+                        continue
+                if first_change is not None:
+                    changes = self._flush(changes)
+                    first_change = last_change = None
+        finally:
+            os.close(self._fd)
+
+
+def snapshot_directory(directory):
+    """Map the paths of the directory's entries to their (mtime, size)."""
+    snapshot = {}
+    try:
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                try:
+                    stat_result = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.path] = (stat_result.st_mtime_ns, stat_result.st_size)
+    except OSError:
+        pass
+    return snapshot
+
+
+class PollingWatcher(DirectoryWatcher):
+    """
+    Watcher comparing snapshots of the directory.
+    The directory's mtime is checked every `interval` seconds,
+    and the files are only listed and stat'ed when it changed,
+    or every `scan_interval` seconds.
+    """
+
+    def __init__(self, directory, callback, interval=1.0, scan_interval=5.0, **kwargs):
+        super().__init__(directory, callback, **kwargs)
+        self.interval = interval
+        self.scan_interval = scan_interval
+
+    def get_directory_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def _run(self):
+        directory_mtime = self.get_directory_mtime()
+        snapshot = snapshot_directory(self.directory)
+        last_scan = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            current_mtime = self.get_directory_mtime()
+            if (
+                current_mtime == directory_mtime
+                and time.monotonic() - last_scan < self.scan_interval
+            ):
+                continue
+            directory_mtime = current_mtime
+            current_snapshot = snapshot_directory(self.directory)
+            last_scan = time.monotonic()
+            changes = DirectoryChanges(self.directory)
+            for path, signature in current_snapshot.items():
+                previous_signature = snapshot.get(path)
+                if previous_signature is None:
+                    changes.add(path, ADDED)
+                elif previous_signature != signature:
+                    changes.add(path, MODIFIED)
+            for path in snapshot.keys() - current_snapshot.keys():
+                changes.add(path, REMOVED)
+            snapshot = current_snapshot
+            self._flush(changes)
+
+
+def watch_directory(directory, callback, **kwargs):
+    """
+    Start watching a directory with inotify, or by polling if it's unavailable,
+    returning the watcher, to be stopped with its stop method.
+    """
+    try:
+        watcher = InotifyWatcher(directory, callback, **kwargs)
+    except OSError as error:
+        logger.debug("Polling %s for changes: %s", directory, error)
+        watcher = PollingWatcher(directory, callback, **kwargs)
+    return watcher.start()